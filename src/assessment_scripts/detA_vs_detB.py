@@ -1,14 +1,14 @@
-from lib2to3.pgen2.token import LEFTSHIFTEQUAL
 import os, sys
 import time
 import argparse
 import yaml
+import numpy as np
 import pandas as pd
-import geopandas as gpd
 
 from logzero import logger
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
+from scipy.spatial import cKDTree
 
 # the following lines allow us to import modules from within this file's parent folder
 from inspect import getsourcefile
@@ -16,7 +16,8 @@ current_path = os.path.abspath(getsourcefile(lambda:0))
 current_dir = os.path.dirname(current_path)
 parent_dir = current_dir[:current_dir.rfind(os.path.sep)]
 sys.path.insert(0, parent_dir)
-from lib.misc import geohash, clip, tag, assess
+from lib.instrumentation import PROFILERS, InstrumentationSettings, instrumented_run, begin, end
+from lib.misc import check_schemas, load_gdf, write_gdf, kdtree_pairs
 
 
 class RequiredInputFiles(BaseModel):
@@ -38,6 +39,7 @@ class RequiredOutputFiles(BaseModel):
     matched_run_B_detections: str
     unmatched_run_A_detections: str
     unmatched_run_B_detections: str
+    pairs: Optional[str] = None
 
 class RequiredSettings(BaseModel):
 
@@ -57,27 +59,7 @@ class Configuration(BaseModel):
     input_files: RequiredInputFiles
     output_files: RequiredOutputFiles
     settings: RequiredSettings
-
-def file_loader(files):
-
-    acc_gdf = gpd.GeoDataFrame() # accumulator
-
-    crs = None # init
-    for _file in files:
-        # TODO: check schema  
-        tmp_gdf = gpd.read_file(_file) 
-        if crs is None:
-            crs = tmp_gdf.crs
-        else:
-            if tmp_gdf.crs != crs:
-                logger.critical("Input datasets have mismatching CRS. Exiting.")
-                sys.exit(1)
-        acc_gdf = pd.concat([acc_gdf, tmp_gdf])
-
-    gdf = gpd.GeoDataFrame(acc_gdf)
-    gdf = gdf.set_crs(crs)
-
-    return gdf.reset_index(drop=True)
+    instrumentation: InstrumentationSettings = InstrumentationSettings()
 
 # def add_geohash(gdf, prefix=None, suffix=None):
 
@@ -100,7 +82,57 @@ def file_loader(files):
 #     return out_gdf
     
 
-def main(config_file):
+def match_runs(gdf_A, gdf_B, tolerance_m, return_pairs=False):
+    """
+        Splits the detections of run A and run B into matched and unmatched ones: a detection is matched if the centroid 
+        of any detection of the other run lies within tolerance_m of its own centroid.
+        Returns a dict: 'A_matched', 'A_unmatched', 'B_matched', 'B_unmatched' -> GeoDataFrame holding the columns of the input 
+        GeoDataFrame and the centroids of the detections, 
+        + 'pairs' -> DataFrame listing the matching pairs (A_idx, B_idx = index labels of detections, distance), if return_pairs.
+    """
+
+    logger.info("> Pre-processing data...")
+    centroids = {k: v.geometry.centroid for k, v in dict(A=gdf_A, B=gdf_B).items()}
+    coords = {k: np.column_stack([v.x.values, v.y.values]) for k, v in centroids.items()}
+    logger.info("< ...done.")
+
+    logger.info("> Finding matches...")
+    if return_pairs:
+        # every pair is needed anyway, matched detections are the ones belonging to some pair
+        A_idx, B_idx, distance = kdtree_pairs(coords['A'], coords['B'], tolerance_m)
+        is_matched = {'A': np.isin(np.arange(len(gdf_A)), A_idx), 'B': np.isin(np.arange(len(gdf_B)), B_idx)}
+    else:
+        # the nearest partner within tolerance is enough (distance = inf if there is none)
+        upper_bound = np.nextafter(tolerance_m, np.inf)
+        trees = {k: cKDTree(v) for k, v in coords.items()}
+        is_matched = {
+            'A': trees['B'].query(coords['A'], k=1, distance_upper_bound=upper_bound)[0] <= tolerance_m if len(gdf_B) > 0 else np.zeros(len(gdf_A), dtype=bool),
+            'B': trees['A'].query(coords['B'], k=1, distance_upper_bound=upper_bound)[0] <= tolerance_m if len(gdf_A) > 0 else np.zeros(len(gdf_B), dtype=bool),
+        }
+    logger.info("< ...done.")
+
+    out = {}
+    for k, v in dict(A=gdf_A, B=gdf_B).items():
+        _gdf = v.copy()
+        _gdf[_gdf.geometry.name] = centroids[k]
+        out[f'{k}_matched'] = _gdf[is_matched[k]]
+        out[f'{k}_unmatched'] = _gdf[~is_matched[k]]
+
+    if return_pairs:
+        out['pairs'] = pd.DataFrame({
+            'A_idx': gdf_A.index.values[A_idx],
+            'B_idx': gdf_B.index.values[B_idx],
+            'distance': distance
+        })
+
+    return out
+
+
+def main(config_file, report_file=None, profiler=None, trace_memory=False):
+    """
+        - report_file, profiler, trace_memory = cf. lib.instrumentation.start_run(); they override the 'instrumentation' section 
+          of the configuration file
+    """
 
     tic = time.time()
     logger.info("Starting...")
@@ -114,90 +146,74 @@ def main(config_file):
     parsed_cfg = Configuration(**cfg)
     logger.info("< ...done.")
 
+    instrumentation = parsed_cfg.instrumentation
+    with instrumented_run(
+        'detA_vs_detB', 
+        report_file=report_file or instrumentation.report_file, 
+        profiler=profiler or instrumentation.profiler, 
+        trace_memory=trace_memory or instrumentation.trace_memory,
+        config_file=os.path.abspath(config_file)
+    ):
+        compare_runs(parsed_cfg)
+    
+    toc = time.time()
+    logger.info(f"...done in {toc-tic:.2f} seconds.")
+
+
+def compare_runs(parsed_cfg):
+
     logger.info("> Loading data...")
+    begin("Loading data")
     
     gdf = {}
 
+    logger.info("-> Checking input datasets schemas...")
+    # run A and run B detections must share the same CRS
+    check_schemas(parsed_cfg.input_files.run_A_detections + parsed_cfg.input_files.run_B_detections)
+    logger.info("<- ...done.")
+
     logger.info("-> Detections from run A...")
-    gdf['A'] = file_loader(parsed_cfg.input_files.run_A_detections)
+    gdf['A'] = load_gdf(parsed_cfg.input_files.run_A_detections)
     logger.info("<- ...done.")
 
     logger.info("-> Detections from run B...")
-    gdf['B'] = file_loader(parsed_cfg.input_files.run_B_detections)
-    logger.info("<- ...done.")
- 
-    logger.info("-> Checking whether input datasets share the same CRS...")
-    assert gdf['A'].crs == gdf['B'].crs
+    gdf['B'] = load_gdf(parsed_cfg.input_files.run_B_detections)
     logger.info("<- ...done.")
 
+    end(rows=len(gdf['A']) + len(gdf['B']))
     logger.info("< ...done.")
 
-    logger.info("> Pre-processing data...")
-
-    _gdf = {}
-    for k, v in gdf.items():
-        tmp = v.copy()
-        tmp['geometry'] = tmp['geometry'].centroid.buffer(parsed_cfg.settings.tolerance_in_meters / 2.0)
-        tmp = tmp.reset_index()
-        tmp = tmp.rename(columns={"index": 'idx'})
-        _gdf[k] = tmp.copy()
-        del tmp
-
-    logger.info("< ..done.")
-
-    logger.info("> Finding matches...")
-    ljoin = gpd.sjoin(_gdf["A"], _gdf["B"], how='left',  op='intersects', lsuffix='x', rsuffix='y')
-    rjoin = gpd.sjoin(_gdf["A"], _gdf["B"], how='right', op='intersects', lsuffix='x', rsuffix='y')
-    
-
-    _gdf['A_matched'] = ljoin[ljoin.idx_y.notnull()].copy()
-    _gdf['A_unmatched'] = ljoin[ljoin.idx_y.isna()].copy()
-
-    _gdf['B_matched'] = rjoin[rjoin.idx_x.notnull()].copy()
-    _gdf['B_unmatched'] = rjoin[rjoin.idx_x.isna()].copy()
-    logger.info("< ...done.")
-
-    logger.info("> Dropping duplicates...")
-
-    _gdf['A_matched'].drop_duplicates(subset=gdf['A'].columns.tolist(), inplace=True)
-    _gdf['A_unmatched'].drop_duplicates(subset=gdf['A'].columns.tolist(), inplace=True)
-    _gdf['B_matched'].drop_duplicates(subset=gdf['B'].columns.tolist(), inplace=True)
-    _gdf['B_unmatched'].drop_duplicates(subset=gdf['B'].columns.tolist(), inplace=True)
-
-    logger.info("< ...done.")
-
-    logger.info("> Checking counts...")
-    assert len(_gdf['A_matched']) + len(_gdf['A_unmatched']) == len(gdf['A'])
-    assert len(_gdf['B_matched']) + len(_gdf['B_unmatched']) == len(gdf['B'])
-    logger.info("< ...done.")
-
+    tolerance_m = parsed_cfg.settings.tolerance_in_meters
+    begin("Matching runs")
+    _gdf = match_runs(gdf['A'], gdf['B'], tolerance_m, return_pairs=parsed_cfg.output_files.pairs is not None)
+    end(rows=len(gdf['A']) + len(gdf['B']))
 
     logger.info(f"Run A detections split as follows: {len(_gdf['A_matched'])} (matched) + {len(_gdf['A_unmatched'])} (unmatched) = {len(gdf['A'])}")
     logger.info(f"Run B detections split as follows: {len(_gdf['B_matched'])} (matched) + {len(_gdf['B_unmatched'])} (unmatched) = {len(gdf['B'])}")
 
     logger.info("> Generating output files...")
-
-    # Extracting centroids
-    for k, v in _gdf.items():
-        v['geometry'] = v['geometry'].centroid
-
-    _gdf['A_matched'][gdf['A'].columns].to_file(parsed_cfg.output_files.matched_run_A_detections, driver='GPKG')
-    _gdf['B_matched'][gdf['B'].columns].to_file(parsed_cfg.output_files.matched_run_B_detections, driver='GPKG')
-    _gdf['A_unmatched'][gdf['A'].columns].to_file(parsed_cfg.output_files.unmatched_run_A_detections, driver='GPKG')
-    _gdf['B_unmatched'][gdf['B'].columns].to_file(parsed_cfg.output_files.unmatched_run_B_detections, driver='GPKG')
+    begin("Generating output files")
+    write_gdf(_gdf['A_matched'], parsed_cfg.output_files.matched_run_A_detections)
+    write_gdf(_gdf['B_matched'], parsed_cfg.output_files.matched_run_B_detections)
+    write_gdf(_gdf['A_unmatched'], parsed_cfg.output_files.unmatched_run_A_detections)
+    write_gdf(_gdf['B_unmatched'], parsed_cfg.output_files.unmatched_run_B_detections)
+    if parsed_cfg.output_files.pairs is not None:
+        _gdf['pairs'].to_csv(parsed_cfg.output_files.pairs, index=False)
+    end(rows=len(gdf['A']) + len(gdf['B']))
     
     logger.info("< ...done. The following files were generated:")
     for out_file in parsed_cfg.output_files:
-        logger.info(out_file[1])
-    
-    toc = time.time()
-    logger.info(f"...done in {toc-tic:.2f} seconds.")
+        if out_file[1] is not None:
+            logger.info(out_file[1])
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="This script finds matched between detections coming from two different runs.")
     parser.add_argument('config_file', type=str, help='a YAML config file')
+    parser.add_argument('--report-file', dest='report_file', type=str, default=None, help='JSON file the run report (per stage timings, memory and throughput) is written to')
+    parser.add_argument('--profiler', dest='profiler', type=str, default=None, choices=PROFILERS, help='profiles the run; the profile is written next to the report file')
+    parser.add_argument('--trace-memory', dest='trace_memory', action='store_true', help='traces the memory allocated by each stage (slower)')
     args = parser.parse_args()
 
-    main(args.config_file)
\ No newline at end of file
+    main(args.config_file, report_file=args.report_file, profiler=args.profiler, trace_memory=args.trace_memory)
\ No newline at end of file
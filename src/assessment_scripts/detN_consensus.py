@@ -0,0 +1,197 @@
+import os, sys
+import time
+import argparse
+import yaml
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from logzero import logger
+from pydantic import BaseModel
+from typing import Dict, List
+from scipy.spatial import cKDTree
+
+# the following lines allow us to import modules from within this file's parent folder
+from inspect import getsourcefile
+current_path = os.path.abspath(getsourcefile(lambda:0))
+current_dir = os.path.dirname(current_path)
+parent_dir = current_dir[:current_dir.rfind(os.path.sep)]
+sys.path.insert(0, parent_dir)
+from lib.instrumentation import PROFILERS, InstrumentationSettings, instrumented_run, begin, end
+from lib.misc import check_schemas, load_gdf, write_gdf, xy, csgraph_components
+
+
+class RequiredInputFiles(BaseModel):
+
+    class Config:
+        # cf. https://pydantic-docs.helpmanual.io/usage/model_config/
+        extra = 'forbid'
+
+    runs: Dict[str, List[str]]
+
+class RequiredOutputFiles(BaseModel):
+
+    class Config:
+        # cf. https://pydantic-docs.helpmanual.io/usage/model_config/
+        extra = 'forbid'
+
+    consensus: str
+
+class RequiredSettings(BaseModel):
+
+    class Config:
+        # cf. https://pydantic-docs.helpmanual.io/usage/model_config/
+        extra = 'forbid'
+
+    tolerance_in_meters: float
+
+class Configuration(BaseModel):
+
+    class Config:
+        # cf. https://pydantic-docs.helpmanual.io/usage/model_config/
+        extra = 'forbid'
+
+    input_files: RequiredInputFiles
+    output_files: RequiredOutputFiles
+    settings: RequiredSettings
+    instrumentation: InstrumentationSettings = InstrumentationSettings()
+
+
+def consensus(gdfs, tolerance_m):
+    """
+        Finds the detections of several runs which agree with each other, i.e. the centroids of which lie within tolerance_m.
+        - gdfs = dict: run name -> GeoDataFrame of the detections of that run
+        Returns one GeoDataFrame holding the detections of every run (centroids), along with the following columns:
+        - run = the name of the run the detection stems from
+        - agree_<run> = True if the detection has a partner within tolerance_m among the detections of <run> (always True for its own run)
+        - n_runs = number of runs agreeing with the detection (its own run included)
+        - cluster_id, cluster_n_runs = cross-run cluster (chain of agreeing detections) the detection belongs to and number of runs found in it
+    """
+
+    runs = list(gdfs.keys())
+    reserved_columns = ['run', 'n_runs', 'cluster_id', 'cluster_n_runs'] + [f"agree_{run}" for run in runs]
+    for run, gdf in gdfs.items():
+        assert not any([col in gdf.columns for col in reserved_columns]), f"Detections of run '{run}' cannot include the following columns: {reserved_columns}"
+
+    logger.info("> Indexing detections...")
+    gdf = gpd.GeoDataFrame(
+        pd.concat([_gdf.assign(run=run) for run, _gdf in gdfs.items()], ignore_index=True),
+        geometry=gdfs[runs[0]].geometry.name, crs=gdfs[runs[0]].crs
+    )
+    gdf[gdf.geometry.name] = gdf.geometry.centroid
+    run_idx = np.repeat(np.arange(len(runs)), [len(_gdf) for _gdf in gdfs.values()])
+    n_dets = len(gdf)
+    tree = cKDTree(xy(gdf)) if n_dets > 0 else None
+    logger.info("< ...done.")
+
+    logger.info("> Finding cross-run pairs...")
+    # every run is indexed once: one query over all the detections, pairs within the same run are discarded
+    pairs = tree.query_pairs(tolerance_m, output_type='ndarray') if n_dets > 0 else np.empty((0, 2), dtype=np.int64)
+    src, dst = pairs[:, 0], pairs[:, 1]
+    cross_run = run_idx[src] != run_idx[dst]
+    src, dst = src[cross_run], dst[cross_run]
+    logger.info(f"< ...done: {len(src)} pairs found.")
+
+    logger.info("> Computing agreements...")
+    agree = np.zeros((n_dets, len(runs)), dtype=bool)
+    agree[np.arange(n_dets), run_idx] = True
+    agree[src, run_idx[dst]] = True
+    agree[dst, run_idx[src]] = True
+
+    cluster_id = csgraph_components(n_dets, src, dst)
+    # runs found in each cluster
+    cluster_runs = np.zeros((cluster_id.max() + 1 if n_dets > 0 else 0, len(runs)), dtype=bool)
+    cluster_runs[cluster_id, run_idx] = True
+
+    for i, run in enumerate(runs):
+        gdf[f"agree_{run}"] = agree[:, i]
+    gdf['n_runs'] = agree.sum(axis=1)
+    gdf['cluster_id'] = cluster_id
+    gdf['cluster_n_runs'] = cluster_runs.sum(axis=1)[cluster_id]
+    logger.info("< ...done.")
+
+    return gdf
+
+
+def main(config_file, report_file=None, profiler=None, trace_memory=False):
+    """
+        - report_file, profiler, trace_memory = cf. lib.instrumentation.start_run(); they override the 'instrumentation' section
+          of the configuration file
+    """
+
+    tic = time.time()
+    logger.info("Starting...")
+
+    logger.info("> Loading configuration file...")
+    with open(config_file) as fp:
+        cfg = yaml.load(fp, Loader=yaml.FullLoader)
+    logger.info("< ...done.")
+
+    logger.info("> Parsing configuration...")
+    parsed_cfg = Configuration(**cfg)
+    logger.info("< ...done.")
+
+    instrumentation = parsed_cfg.instrumentation
+    with instrumented_run(
+        'detN_consensus',
+        report_file=report_file or instrumentation.report_file,
+        profiler=profiler or instrumentation.profiler,
+        trace_memory=trace_memory or instrumentation.trace_memory,
+        config_file=os.path.abspath(config_file)
+    ):
+        compare_runs(parsed_cfg)
+
+    toc = time.time()
+    logger.info(f"...done in {toc-tic:.2f} seconds.")
+
+
+def compare_runs(parsed_cfg):
+
+    runs = parsed_cfg.input_files.runs
+    assert len(runs) >= 2, "At least two runs must be provided."
+
+    logger.info("> Loading data...")
+    begin("Loading data")
+
+    logger.info("-> Checking input datasets schemas...")
+    # the detections of every run must share the same CRS
+    check_schemas([file for files in runs.values() for file in files])
+    logger.info("<- ...done.")
+
+    gdfs = {}
+    for run, files in runs.items():
+        logger.info(f"-> Detections from run {run}...")
+        gdfs[run] = load_gdf(files)
+        logger.info("<- ...done.")
+
+    n_dets = sum([len(gdf) for gdf in gdfs.values()])
+    end(rows=n_dets)
+    logger.info("< ...done.")
+
+    begin("Finding consensus")
+    consensus_gdf = consensus(gdfs, parsed_cfg.settings.tolerance_in_meters)
+    end(rows=n_dets)
+
+    for run in runs.keys():
+        counts = consensus_gdf.loc[consensus_gdf.run == run, 'n_runs'].value_counts().sort_index()
+        logger.info(f"Run {run} detections agreed on by n runs: " + ", ".join([f"n = {k}: {v}" for k, v in counts.items()]))
+
+    logger.info("> Generating output files...")
+    begin("Generating output files")
+    write_gdf(consensus_gdf, parsed_cfg.output_files.consensus)
+    end(rows=n_dets)
+
+    logger.info("< ...done. The following files were generated:")
+    logger.info(parsed_cfg.output_files.consensus)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="This script finds the detections which several runs agree on.")
+    parser.add_argument('config_file', type=str, help='a YAML config file')
+    parser.add_argument('--report-file', dest='report_file', type=str, default=None, help='JSON file the run report (per stage timings, memory and throughput) is written to')
+    parser.add_argument('--profiler', dest='profiler', type=str, default=None, choices=PROFILERS, help='profiles the run; the profile is written next to the report file')
+    parser.add_argument('--trace-memory', dest='trace_memory', action='store_true', help='traces the memory allocated by each stage (slower)')
+    args = parser.parse_args()
+
+    main(args.config_file, report_file=args.report_file, profiler=args.profiler, trace_memory=args.trace_memory)
@@ -1,13 +1,18 @@
 import os, sys
 import time
 import argparse
+import logging
+import tempfile
 import yaml
+import numpy as np
 import pandas as pd
-import geopandas as gpd
 
 from logzero import logger
+from scipy.spatial import cKDTree
+from tqdm.auto import tqdm
+from shapely.geometry import box
 from pydantic import BaseModel
-from typing import List
+from typing import List, Literal, Optional, Union
 
 # the following lines allow us to import modules from within this file's parent folder
 from inspect import getsourcefile
@@ -15,7 +20,9 @@ current_path = os.path.abspath(getsourcefile(lambda:0))
 current_dir = os.path.dirname(current_path)
 parent_dir = current_dir[:current_dir.rfind(os.path.sep)]
 sys.path.insert(0, parent_dir)
-from lib.misc import geohash, clip, tag, assess
+from lib.misc import check_schemas, load_gdf, read_gdf, write_gdf, GdfWriter, xy, geohash_encode, morton_encode, assign_sectors, tag, parallel_tag, tag_sweep, assess, assess_by, tile_grid, tag_tile, reconcile_tiles, finalize_tile, NO_GROUP_KEY, FID_BITS, charge_sums, add_charge_sums, assess_charge_sums
+from lib.instrumentation import PROFILERS, InstrumentationSettings, instrumented_run, begin, end
+from lib.gt_cache import gt_cache_key, read_gt_cache, write_gt_cache
 
 
 class RequiredInputFiles(BaseModel):
@@ -45,7 +52,15 @@ class RequiredSettings(BaseModel):
         extra = 'forbid'
 
     gt_sectors_buffer_size_in_meters: float
-    tolerance_in_meters: float
+    tolerance_in_meters: Union[float, List[float]]
+    matching_method: Literal['sjoin', 'kdtree'] = 'sjoin'
+    spatial_key: Literal['geohash', 'morton'] = 'geohash'
+    sector_overlap_policy: Literal['duplicate', 'first', 'nearest_centroid'] = 'duplicate'
+    extra_metrics_by: List[str] = []
+    prune_input_columns: bool = False
+    tile_size_in_meters: Optional[float] = None
+    tagging_workers: int = 1
+    gt_cache_dir: Optional[str] = None
 
 class Configuration(BaseModel):
 
@@ -56,32 +71,20 @@ class Configuration(BaseModel):
     input_files: RequiredInputFiles
     output_files: RequiredOutputFiles
     settings: RequiredSettings
+    instrumentation: InstrumentationSettings = InstrumentationSettings()
 
-def file_loader(files):
+def add_geohash(gdf, prefix=None, suffix=None, spatial_key='geohash'):
 
-    acc_gdf = gpd.GeoDataFrame() # accumulator
-
-    crs = None # init
-    for _file in files:
-        # TODO: check schema  
-        tmp_gdf = gpd.read_file(_file) 
-        if crs is None:
-            crs = tmp_gdf.crs
-        else:
-            if tmp_gdf.crs != crs:
-                logger.critical("Input datasets have mismatching CRS. Exiting.")
-                sys.exit(1)
-        acc_gdf = pd.concat([acc_gdf, tmp_gdf])
-
-    gdf = gpd.GeoDataFrame(acc_gdf)
-    gdf = gdf.set_crs(crs)
-
-    return gdf.reset_index(drop=True)
+    out_gdf = gdf.copy()
 
-def add_geohash(gdf, prefix=None, suffix=None):
+    if spatial_key == 'morton':
+        # Morton keys are computed in the projected CRS => no reprojection is needed
+        assert prefix is None and suffix is None, "Morton keys cannot be prefixed nor suffixed."
+        out_gdf['geohash'] = morton_encode(gdf.geometry.x.values, gdf.geometry.y.values)
+        return out_gdf
 
-    out_gdf = gdf.copy()
-    out_gdf['geohash'] = gdf.to_crs(epsg=4326).apply(geohash, axis=1)
+    lonlat = xy(gdf[['geometry']].to_crs(epsg=4326))
+    out_gdf['geohash'] = geohash_encode(lonlat[:, 0], lonlat[:, 1], precision=16)
 
     if prefix is not None:
         out_gdf['geohash'] = prefix + out_gdf['geohash'].astype(str)
@@ -94,16 +97,17 @@ def add_geohash(gdf, prefix=None, suffix=None):
 def drop_duplicates(gdf):
     
     out_gdf = gdf.copy()
-    out_gdf.drop_duplicates(subset='geohash', inplace=True)
+    # points lying in overlapping sectors may have been duplicated on purpose, hence the 'sector' column
+    out_gdf.drop_duplicates(subset=['geohash', 'sector'], inplace=True)
 
     return out_gdf
     
 
-def main(config_file):
+# settings which GT pre-processing depends on
+GT_SETTINGS = ['gt_sectors_buffer_size_in_meters', 'spatial_key', 'sector_overlap_policy', 'extra_metrics_by', 'prune_input_columns', 'tile_size_in_meters']
+
+def load_configuration(config_file):
 
-    tic = time.time()
-    logger.info("Starting...")
-   
     logger.info("> Loading configuration file...")
     with open(config_file) as fp:
         cfg = yaml.load(fp, Loader=yaml.FullLoader)#[os.path.basename(__file__)]
@@ -113,25 +117,83 @@ def main(config_file):
     parsed_cfg = Configuration(**cfg)
     logger.info("< ...done.")
 
-    logger.info("> Loading data...")
+    return parsed_cfg
+
+def gt_key(parsed_cfg):
+    """
+        Configurations sharing the same key share the same pre-processed GT data, as well.
+    """
+
+    settings = parsed_cfg.settings.model_dump(include=set(GT_SETTINGS))
+
+    return yaml.dump(
+        dict(
+            gt_sectors=parsed_cfg.input_files.gt_sectors, 
+            gt_trees=parsed_cfg.input_files.gt_trees, 
+            settings=settings
+        ), 
+        sort_keys=True
+    )
+
+def prepare_gt(parsed_cfg):
+    """
+        Loads and pre-processes GT data. The output dict can be reused to assess any detections 
+        the configuration of which has the same gt_key().
+    """
+
+    extra_metrics_by = parsed_cfg.settings.extra_metrics_by
+    buffer_size_m = parsed_cfg.settings.gt_sectors_buffer_size_in_meters
+
+    logger.info("> Loading GT data...")
+    begin("Loading GT data")
     
     logger.info("-> GT sectors")
-    gt_sectors_gdf = file_loader(parsed_cfg.input_files.gt_sectors)
-    logger.info("<- ...done.")
-
-    logger.info("-> GT trees")
-    gt_trees_gdf = file_loader(parsed_cfg.input_files.gt_trees)
+    gt_sectors_gdf = load_gdf(parsed_cfg.input_files.gt_sectors, columns=extra_metrics_by, required_columns=['sector'])
     logger.info("<- ...done.")
 
-    logger.info("-> Detections")
-    dets_gdf = file_loader(parsed_cfg.input_files.detections)
-    logger.info("<- ...done.")
+    # GT sectors attributes which metrics are reported on are copied to GT trees and detections, along with the sector;
+    # the other ones must be shared by GT trees and detections
+    sector_columns = ['sector'] + [col for col in extra_metrics_by if col in gt_sectors_gdf.columns and col != 'sector']
+    tree_columns = [col for col in extra_metrics_by if col not in sector_columns]
+    # GT trees and detections lying outside of the buffered GT sectors are not even read
+    bbox = gt_sectors_gdf.total_bounds + np.array([-1, -1, 1, 1]) * buffer_size_m
+
+    # pre-processed GT trees are cached across runs, cf. lib.gt_cache
+    cache_dir = parsed_cfg.settings.gt_cache_dir
+    cache_key = None
+    cached = None
+    if cache_dir is not None and parsed_cfg.settings.tile_size_in_meters is not None:
+        logger.warning("The GT cache is not used by tiled assessments.")
+    elif cache_dir is not None:
+        logger.info("-> Looking up GT cache...")
+        cache_key = gt_cache_key(
+            dict(gt_sectors=parsed_cfg.input_files.gt_sectors, gt_trees=parsed_cfg.input_files.gt_trees),
+            parsed_cfg.settings.model_dump(include=set(GT_SETTINGS)),
+            'det_vs_gt'
+        )
+        cached = read_gt_cache(cache_dir, cache_key)
+        logger.info(f"<- ...done: cache {'hit' if cached is not None else 'miss'} ({cache_key}).")
+
+    if cached is not None:
+        gt_trees_gdf, gt_xy = cached
+    elif parsed_cfg.settings.tile_size_in_meters is None:
+        logger.info("-> GT trees")
+        gt_trees_gdf = load_gdf(
+            parsed_cfg.input_files.gt_trees, 
+            columns=[] if parsed_cfg.settings.prune_input_columns else None, 
+            required_columns=tree_columns, 
+            bbox=bbox, 
+            geometry_types=['Point'], 
+            crs=gt_sectors_gdf.crs
+        )
+        logger.info("<- ...done.")
     
+    end(rows=len(gt_trees_gdf) if parsed_cfg.settings.tile_size_in_meters is None else len(gt_sectors_gdf))
     logger.info("< ...done.")
 
-    logger.info("> Pre-processing data...")
+    logger.info("> Pre-processing GT data...")
+    begin("Pre-processing GT data")
 
-    buffer_size_m = parsed_cfg.settings.gt_sectors_buffer_size_in_meters
     logger.info(f"-> Adding buffer to GT sectors. Size = {buffer_size_m} m")
 
     buffered_gt_sectors_gdf = gt_sectors_gdf.copy()
@@ -139,40 +201,218 @@ def main(config_file):
 
     logger.info("<- ...done.")
 
-    logger.info("-> Geohashing GT trees...")
-    GT_PREFIX= 'gt_'
-    gt_trees_gdf = add_geohash(gt_trees_gdf, prefix=GT_PREFIX)
+    gt = dict(
+        sectors=gt_sectors_gdf,
+        buffered_sectors=buffered_gt_sectors_gdf,
+        sector_columns=sector_columns,
+        tree_columns=tree_columns,
+        bbox=bbox,
+        trees=None,
+        kdtree=None
+    )
+
+    if parsed_cfg.settings.tile_size_in_meters is not None:
+        # GT trees are read tile by tile, cf. assess_detections_tiled()
+        buffered_gt_sectors_gdf.sindex
+        end(rows=len(gt_sectors_gdf))
+        logger.info("< ...done.")
+        return gt
+
+    if cached is not None:
+        # GT trees are already assigned to sectors, geohashed and deduplicated; the KD-tree is built on memory-mapped coordinates,
+        # the spatial index on demand
+        buffered_gt_sectors_gdf.sindex
+        gt_kdtree = cKDTree(gt_xy)
+        end(rows=len(gt_trees_gdf))
+        logger.info("< ...done.")
+        gt['trees'] = gt_trees_gdf
+        gt['kdtree'] = gt_kdtree
+        return gt
+
+    overlap_policy = parsed_cfg.settings.sector_overlap_policy
+    logger.info(f"-> Assigning GT trees to buffered GT sectors (overlap policy: {overlap_policy})...")
+    gt_trees_gdf = assign_sectors(gt_trees_gdf, buffered_gt_sectors_gdf, overlap_policy=overlap_policy, columns=sector_columns)
+    logger.info("<- ...done.")
+
+    spatial_key = parsed_cfg.settings.spatial_key
+    logger.info(f"-> Geohashing GT trees (spatial key: {spatial_key})...")
+    GT_PREFIX = 'gt_' if spatial_key == 'geohash' else None
+    gt_trees_gdf = add_geohash(gt_trees_gdf, prefix=GT_PREFIX, spatial_key=spatial_key)
     logger.info("<- ...done.")
 
     logger.info("-> Dropping duplicates in GT trees...")
     gt_trees_gdf = drop_duplicates(gt_trees_gdf)
     logger.info("<- ...done.")
 
-    logger.info("-> Geohashing detections...")
-    DETS_PREFIX = "dt_"
-    dets_gdf = add_geohash(dets_gdf, prefix=DETS_PREFIX)
+    logger.info("-> Building spatial indices...")
+    buffered_gt_sectors_gdf.sindex
+    gt_trees_gdf.sindex
+    gt_kdtree = cKDTree(xy(gt_trees_gdf))
     logger.info("<- ...done.")
 
-    logger.info("-> Dropping duplicates in detections...")
-    dets_gdf = drop_duplicates(dets_gdf)
+    if cache_key is not None:
+        logger.info("-> Writing GT cache...")
+        write_gt_cache(cache_dir, cache_key, gt_trees_gdf)
+        logger.info("<- ...done.")
+
+    end(rows=len(gt_trees_gdf))
+    logger.info("< ...done.")
+
+    gt['trees'] = gt_trees_gdf
+    gt['kdtree'] = gt_kdtree
+
+    return gt
+
+def assess_detections(parsed_cfg, gt):
+    """
+        Assesses the detections listed in the configuration against pre-processed GT data (cf. prepare_gt()), 
+        then generates output files. Returns the metrics DataFrame.
+    """
+
+    if parsed_cfg.settings.tile_size_in_meters is not None:
+        return assess_detections_tiled(parsed_cfg, gt)
+
+    logger.info("> Loading detections...")
+    begin("Loading detections")
+    dets_gdf = load_gdf(
+        parsed_cfg.input_files.detections, 
+        columns=[] if parsed_cfg.settings.prune_input_columns else None, 
+        required_columns=gt['tree_columns'], 
+        bbox=gt['bbox'], 
+        geometry_types=['Point'], 
+        crs=gt['sectors'].crs,
+        # input order, whichever the order in which drivers return features within bbox (ex.: spatial index order, in GPKG files)
+        order_column='_rank'
+    ).drop(columns=['_rank'])
+    end(rows=len(dets_gdf))
+    logger.info("< ...done.")
+
+    logger.info("> Pre-processing detections...")
+    begin("Pre-processing detections")
+
+    overlap_policy = parsed_cfg.settings.sector_overlap_policy
+    logger.info(f"-> Assigning detections to buffered GT sectors (overlap policy: {overlap_policy})...")
+    dets_gdf = assign_sectors(dets_gdf, gt['buffered_sectors'], overlap_policy=overlap_policy, columns=gt['sector_columns'])
     logger.info("<- ...done.")
-    
-    logger.info("-> Clipping GT trees using buffered GT sectors...")
-    gt_trees_gdf = clip(gt_trees_gdf, buffered_gt_sectors_gdf)
+
+    spatial_key = parsed_cfg.settings.spatial_key
+    logger.info(f"-> Geohashing detections (spatial key: {spatial_key})...")
+    DETS_PREFIX = "dt_" if spatial_key == 'geohash' else None
+    dets_gdf = add_geohash(dets_gdf, prefix=DETS_PREFIX, spatial_key=spatial_key)
     logger.info("<- ...done.")
 
-    logger.info("-> Clipping detections using buffered GT sectors...")
-    dets_gdf = clip(dets_gdf, buffered_gt_sectors_gdf)
+    logger.info("-> Dropping duplicates in detections...")
+    dets_gdf = drop_duplicates(dets_gdf)
     logger.info("<- ...done.")
+    end(rows=len(dets_gdf))
     logger.info("< ...done.")
 
     logger.info("> Assessing detections...")
+    begin("Assessing detections")
     logger.info("-> Tagging GT trees and detections (True Positives, False Positives, False Negatives)...")
     tolerance_m = parsed_cfg.settings.tolerance_in_meters
-    tagged_gt_gdf, tagged_dets_gdf = tag(gt=gt_trees_gdf, dets=dets_gdf, tol_m=tolerance_m, gt_prefix=GT_PREFIX, dets_prefix=DETS_PREFIX)
+    matching_method = parsed_cfg.settings.matching_method
+    logger.info(f"--> Matching method: {matching_method}")
+
+    if isinstance(tolerance_m, list):
+        logger.info("<- ...done.")
+        return assess_detections_sweep(parsed_cfg, gt, dets_gdf)
+
+    begin("Tagging GT trees and detections")
+    n_workers = parsed_cfg.settings.tagging_workers
+    if n_workers > 1:
+        logger.info(f"--> Tagging workers: {n_workers}")
+        tagged_gt_gdf, tagged_dets_gdf = parallel_tag(
+            gt=gt['trees'], 
+            dets=dets_gdf, 
+            tol_m=tolerance_m, 
+            n_workers=n_workers,
+            matching_method=matching_method
+        )
+    else:
+        tagged_gt_gdf, tagged_dets_gdf = tag(
+            gt=gt['trees'], 
+            dets=dets_gdf, 
+            tol_m=tolerance_m, 
+            matching_method=matching_method,
+            gt_kdtree=gt['kdtree']
+        )
+    end(rows=len(tagged_gt_gdf) + len(tagged_dets_gdf))
     logger.info("<- ...done.")
 
     logger.info("-> Computing metrics...")
+    begin("Computing metrics")
+    metrics_df, extra_metrics_dfs = compute_metrics(tagged_gt_gdf, tagged_dets_gdf, parsed_cfg, gt)
+    end(rows=len(tagged_gt_gdf) + len(tagged_dets_gdf))
+    logger.info("<- ...done.")
+    end()
+    logger.info("< ...done.")
+
+    logger.info("> Generating output files...")
+    begin("Generating output files")
+    write_gdf(tagged_gt_gdf, parsed_cfg.output_files.tagged_gt_trees)
+    write_gdf(tagged_dets_gdf, parsed_cfg.output_files.tagged_detections)
+    write_metrics(metrics_df, extra_metrics_dfs, parsed_cfg)
+    end(rows=len(tagged_gt_gdf) + len(tagged_dets_gdf))
+
+    return metrics_df
+
+def assess_detections_sweep(parsed_cfg, gt, dets_gdf):
+    """
+        Same as assess_detections(), for a list of tolerances: pairs are only found once, at the largest tolerance (cf. tag_sweep()). 
+        Metrics are indexed by tolerance, then by sector; tagged files refer to the largest tolerance.
+    """
+
+    tolerances = sorted(set(parsed_cfg.settings.tolerance_in_meters))
+    matching_method = parsed_cfg.settings.matching_method
+
+    if parsed_cfg.settings.tagging_workers > 1:
+        logger.warning("Tolerance sweeps are run by one single process: the tagging_workers setting is ignored.")
+
+    logger.info(f"-> Tagging GT trees and detections and computing metrics, tolerance by tolerance ({tolerances} m)...")
+    begin("Tagging GT trees and detections and computing metrics, tolerance by tolerance")
+    metrics_dfs = []
+    extra_metrics_dfs = {col: [] for col in parsed_cfg.settings.extra_metrics_by}
+    for tolerance_m, tagged_gt_gdf, tagged_dets_gdf in tag_sweep(
+        gt=gt['trees'], 
+        dets=dets_gdf, 
+        tolerances=tolerances, 
+        matching_method=matching_method, 
+        gt_kdtree=gt['kdtree']
+    ):
+        logger.info(f"--> Tolerance = {tolerance_m} m")
+        _metrics_df, _extra_metrics_dfs = compute_metrics(tagged_gt_gdf, tagged_dets_gdf, parsed_cfg, gt)
+        metrics_dfs.append(_metrics_df)
+        metrics_dfs[-1].insert(0, 'tolerance_in_meters', tolerance_m)
+        for col, df in _extra_metrics_dfs.items():
+            extra_metrics_dfs[col].append(df)
+            extra_metrics_dfs[col][-1].insert(0, 'tolerance_in_meters', tolerance_m)
+        logger.info("<-- ...done.")
+    end(rows=len(tolerances) * (len(tagged_gt_gdf) + len(tagged_dets_gdf)))
+    logger.info("<- ...done.")
+    end()
+    logger.info("< ...done.")
+
+    metrics_df = pd.concat(metrics_dfs)
+    extra_metrics_dfs = {col: pd.concat(dfs) for col, dfs in extra_metrics_dfs.items()}
+
+    if matching_method == 'sjoin':
+        # same output as assess_detections()
+        tagged_dets_gdf['geometry'] = tagged_dets_gdf.geometry.buffer(tolerance_m)
+
+    logger.info("> Generating output files...")
+    begin("Generating output files")
+    write_gdf(tagged_gt_gdf, parsed_cfg.output_files.tagged_gt_trees)
+    write_gdf(tagged_dets_gdf, parsed_cfg.output_files.tagged_detections)
+    write_metrics(metrics_df, extra_metrics_dfs, parsed_cfg)
+    end(rows=len(tagged_gt_gdf) + len(tagged_dets_gdf))
+
+    return metrics_df
+
+def compute_metrics(tagged_gt_gdf, tagged_dets_gdf, parsed_cfg, gt):
+    """
+        Returns global and per sector metrics (one DataFrame), then per <extra_metrics_by column> metrics (a dict of DataFrames).
+    """
 
     metrics_df = pd.DataFrame()
 
@@ -185,25 +425,203 @@ def main(config_file):
     logger.info("<-- ...done.")
 
     logger.info("--> Per sector metrics")
-    for sector in sorted(gt_sectors_gdf.sector.unique()):
-        metrics = assess(
-            tagged_gt = tagged_gt_gdf[tagged_gt_gdf.sector == sector],
-            tagged_dets = tagged_dets_gdf[tagged_dets_gdf.sector == sector],
-        )
-        tmp_df = pd.DataFrame.from_records([{'sector': sector, **metrics}])
-        metrics_df = pd.concat([metrics_df, tmp_df])
-
+    per_sector_metrics_df = assess_by(
+        tagged_gt=tagged_gt_gdf, 
+        tagged_dets=tagged_dets_gdf, 
+        by='sector', 
+        keys=sorted(gt['sectors'].sector.unique())
+    )
+    metrics_df = pd.concat([metrics_df, per_sector_metrics_df.reset_index()])
     logger.info("<-- ...done.")
-    logger.info("<- ...done.")
-    logger.info("< ...done.")
 
-    logger.info("> Generating output files...")
-    tagged_gt_gdf.astype({'TP_charge': 'str', 'FN_charge': 'str'}).to_file(parsed_cfg.output_files.tagged_gt_trees, driver='GPKG')
-    tagged_dets_gdf.astype({'TP_charge': 'str', 'FP_charge': 'str'}).to_file(parsed_cfg.output_files.tagged_detections, driver='GPKG')
+    extra_metrics_dfs = {}
+    for col in parsed_cfg.settings.extra_metrics_by:
+        logger.info(f"--> Per {col} metrics")
+        extra_metrics_dfs[col] = assess_by(tagged_gt=tagged_gt_gdf, tagged_dets=tagged_dets_gdf, by=col).reset_index()
+        logger.info("<-- ...done.")
+
+    return metrics_df, extra_metrics_dfs
+
+def write_metrics(metrics_df, extra_metrics_dfs, parsed_cfg):
+
     metrics_df.to_csv(parsed_cfg.output_files.metrics, sep=',', index=False)
+    extra_metrics_files = []
+    for col, df in extra_metrics_dfs.items():
+        root, ext = os.path.splitext(parsed_cfg.output_files.metrics)
+        extra_metrics_files.append(f"{root}_by_{col}{ext}")
+        df.to_csv(extra_metrics_files[-1], sep=',', index=False)
     logger.info("< ...done. The following files were generated:")
     for out_file in parsed_cfg.output_files:
         logger.info(out_file[1])
+    for out_file in extra_metrics_files:
+        logger.info(out_file)
+
+
+def hide_progress_bars():
+    # progress bars are shown along with progress logs only (ex.: batchEv.py silences both, unless --verbose)
+    return logger.getEffectiveLevel() > logging.INFO
+
+def load_tile(files, schemas, tile, halo, parsed_cfg, gt, prefix=None):
+    """
+        Reads and pre-processes the GT trees or detections lying within a tile, augmented by a halo. 
+        Rows are sorted as in the non tiled mode (i.e. by sector, then by input order), the rank of each row being held by the '_rank' column.
+    """
+
+    gdf = load_gdf(
+        files, 
+        columns=[] if parsed_cfg.settings.prune_input_columns else None, 
+        required_columns=gt['tree_columns'], 
+        bbox=(tile[0] - halo, tile[1] - halo, tile[2] + halo, tile[3] + halo), 
+        order_column='_rank',
+        schemas=schemas
+    )
+    gdf = assign_sectors(
+        gdf, 
+        gt['buffered_sectors'], 
+        overlap_policy=parsed_cfg.settings.sector_overlap_policy, 
+        columns=gt['sector_columns'] + ['_sector_idx']
+    )
+    gdf['_rank'] = (gdf._sector_idx.values.astype(np.int64) << 48) | gdf._rank.values
+    gdf = add_geohash(gdf.drop(columns=['_sector_idx']), prefix=prefix, spatial_key=parsed_cfg.settings.spatial_key)
+    gdf = drop_duplicates(gdf)
+
+    return gdf
+
+def assess_detections_tiled(parsed_cfg, gt):
+    """
+        Same as assess_detections(), reading GT trees and detections tile by tile. Components crossing tile edges 
+        are reconciled so that tagged items and metrics are the same as in the non tiled mode. 
+        Tagged items are written tile by tile, hence the memory footprint depends on the tile size, not on the dataset size; 
+        output rows are sorted by tile, though.
+    """
+
+    tile_size_m = parsed_cfg.settings.tile_size_in_meters
+    tolerance_m = parsed_cfg.settings.tolerance_in_meters
+    if isinstance(tolerance_m, list):
+        raise ValueError("Tolerance sweeps (i.e. lists of tolerances) are not supported in tiled mode.")
+    spatial_key = parsed_cfg.settings.spatial_key
+    GT_PREFIX = 'gt_' if spatial_key == 'geohash' else None
+    DETS_PREFIX = 'dt_' if spatial_key == 'geohash' else None
+
+    assert len(gt['buffered_sectors']) < 2**15, "Too many GT sectors."
+    gt = dict(gt, buffered_sectors=gt['buffered_sectors'].assign(_sector_idx=np.arange(len(gt['buffered_sectors']))))
+
+    files = dict(gt=parsed_cfg.input_files.gt_trees, dets=parsed_cfg.input_files.detections)
+    # ranks pack the sector index (bits 48+) on top of the file index and the feature id (cf. load_tile(), lib.misc.load_gdf())
+    assert all([len(v) < 2**(48 - FID_BITS) for v in files.values()]), f"Too many input files (tiled assessments support {2**(48 - FID_BITS) - 1} at most)."
+    # schemas are checked once and for all
+    schemas = {
+        k: check_schemas(v, required_columns=gt['tree_columns'], geometry_types=['Point'], crs=gt['sectors'].crs) for k, v in files.items()
+    }
+
+    # tiles not intersecting any buffered GT sector do not contain any (assessed) GT tree nor detection
+    tiles = [tile for tile in tile_grid(gt['bbox'], tile_size_m) if len(gt['buffered_sectors'].sindex.query(box(*tile))) > 0]
+    logger.info(f"> Tagging GT trees and detections tile by tile ({len(tiles)} tiles of {tile_size_m} m)...")
+    begin("Tagging GT trees and detections tile by tile")
+    n_rows = 0
+    
+    out_dir = os.path.dirname(os.path.abspath(parsed_cfg.output_files.tagged_detections))
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+
+        open_components = []
+        open_links = []
+        group_keys = []
+        for tile_idx, tile in enumerate(tqdm(tiles, disable=hide_progress_bars())):
+            # a halo as wide as the tolerance allows us to find all the matches of the tile detections
+            gt_trees_gdf = load_tile(files['gt'], schemas['gt'], tile, tolerance_m, parsed_cfg, gt, prefix=GT_PREFIX)
+            dets_gdf = load_tile(files['dets'], schemas['dets'], tile, tolerance_m, parsed_cfg, gt, prefix=DETS_PREFIX)
+
+            tagged = tag_tile(
+                gt_trees_gdf.drop(columns=['_rank']), 
+                dets_gdf, 
+                tile, 
+                tolerance_m, 
+                dets_order='_rank', 
+                matching_method=parsed_cfg.settings.matching_method
+            )
+            write_gdf(tagged['gt'], os.path.join(tmp_dir, f"gt_{tile_idx}.parquet"))
+            write_gdf(tagged['dets'].drop(columns=['_rank']), os.path.join(tmp_dir, f"dets_{tile_idx}.parquet"))
+            open_components.append(tagged['open_components'].assign(tile=tile_idx).set_index('tile', append=True).swaplevel())
+            open_links.append(tagged['open_links'].assign(tile=tile_idx))
+            group_keys.append(tagged['group_keys'])
+            n_rows += len(tagged['gt']) + len(tagged['dets'])
+
+        end(rows=n_rows)
+        logger.info("< ...done.")
+
+        logger.info("> Reconciling components crossing tile edges...")
+        begin("Reconciling components crossing tile edges")
+        reconciled_components = reconcile_tiles(pd.concat(open_components), pd.concat(open_links, ignore_index=True))
+        reconciled_group_keys = np.unique(reconciled_components.group_key.values)
+        group_keys = np.sort(np.concatenate(group_keys + [reconciled_group_keys[reconciled_group_keys != NO_GROUP_KEY]]))
+        end(rows=len(reconciled_components))
+        logger.info("< ...done.")
+
+        logger.info("> Generating tagged files and computing metrics, tile by tile...")
+        begin("Generating tagged files and computing metrics, tile by tile")
+        by_columns = [['sector']] + [[col] for col in parsed_cfg.settings.extra_metrics_by]
+        dets_sums = {col[0]: None for col in by_columns}
+        gt_sums = {col[0]: None for col in by_columns}
+        with GdfWriter(parsed_cfg.output_files.tagged_gt_trees) as gt_writer, GdfWriter(parsed_cfg.output_files.tagged_detections) as dets_writer:
+            for tile_idx in tqdm(range(len(tiles)), disable=hide_progress_bars()):
+                tagged_gt_gdf, tagged_dets_gdf = finalize_tile(
+                    read_gdf(os.path.join(tmp_dir, f"gt_{tile_idx}.parquet")),
+                    read_gdf(os.path.join(tmp_dir, f"dets_{tile_idx}.parquet")),
+                    tile_idx,
+                    reconciled_components,
+                    group_keys
+                )
+                gt_writer.write(tagged_gt_gdf)
+                dets_writer.write(tagged_dets_gdf)
+                for by in by_columns:
+                    dets_sums[by[0]] = add_charge_sums(dets_sums[by[0]], charge_sums(tagged_dets_gdf, by, ['TP_charge_num', 'FP_charge_num']))
+                    gt_sums[by[0]] = add_charge_sums(gt_sums[by[0]], charge_sums(tagged_gt_gdf, by, ['TP_charge_num', 'FN_charge_num']))
+        end(rows=n_rows)
+        logger.info("< ...done.")
+
+    logger.info("> Computing metrics...")
+    begin("Computing metrics")
+    # global metrics = sum over sectors (points belonging to several sectors are counted once per sector, as in assess())
+    all_dets_sums = pd.concat({'ALL': dets_sums['sector'].groupby(level='charge_den').sum()}, names=['sector'])
+    all_gt_sums = pd.concat({'ALL': gt_sums['sector'].groupby(level='charge_den').sum()}, names=['sector'])
+    metrics_df = pd.concat([
+        assess_charge_sums(all_dets_sums, all_gt_sums, by='sector').reset_index(),
+        assess_charge_sums(dets_sums['sector'], gt_sums['sector'], by='sector', keys=sorted(gt['sectors'].sector.unique())).reset_index()
+    ])
+
+    extra_metrics_dfs = {}
+    for col in parsed_cfg.settings.extra_metrics_by:
+        extra_metrics_dfs[col] = assess_charge_sums(dets_sums[col], gt_sums[col], by=col).reset_index()
+    end()
+    logger.info("< ...done.")
+
+    logger.info("> Generating metrics files...")
+    begin("Generating metrics files")
+    write_metrics(metrics_df, extra_metrics_dfs, parsed_cfg)
+    end()
+
+    return metrics_df
+
+
+def main(config_file, report_file=None, profiler=None, trace_memory=False):
+    """
+        - report_file, profiler, trace_memory = (optional) override the 'instrumentation' section of the configuration file, cf. instrumented_run()
+    """
+
+    tic = time.time()
+    logger.info("Starting...")
+
+    parsed_cfg = load_configuration(config_file)
+    instrumentation = parsed_cfg.instrumentation
+    with instrumented_run(
+        'det_vs_gt', 
+        report_file=report_file or instrumentation.report_file, 
+        profiler=profiler or instrumentation.profiler, 
+        trace_memory=trace_memory or instrumentation.trace_memory,
+        config_file=os.path.abspath(config_file)
+    ):
+        gt = prepare_gt(parsed_cfg)
+        metrics_df = assess_detections(parsed_cfg, gt)
     
     toc = time.time()
     logger.info(f"...done in {toc-tic:.2f} seconds.")
@@ -217,6 +635,9 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="This script assesses the quality of detections with respect to ground-truth data.")
     parser.add_argument('config_file', type=str, help='a YAML config file')
+    parser.add_argument('--report-file', dest='report_file', type=str, default=None, help='JSON file the run report (per stage timings, memory and throughput) is written to')
+    parser.add_argument('--profiler', dest='profiler', type=str, default=None, choices=PROFILERS, help='profiles the run; the profile is written next to the report file')
+    parser.add_argument('--trace-memory', dest='trace_memory', action='store_true', help='traces the memory allocated by each stage (slower)')
     args = parser.parse_args()
 
-    main(args.config_file)
\ No newline at end of file
+    main(args.config_file, report_file=args.report_file, profiler=args.profiler, trace_memory=args.trace_memory)
\ No newline at end of file
@@ -2,12 +2,13 @@ import os, sys
 import time
 import argparse
 import yaml
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
 from logzero import logger
 from pydantic import BaseModel
-from typing import List
+from typing import List, Literal, Optional
 
 # the following lines allow us to import modules from within this file's parent folder
 from inspect import getsourcefile
@@ -15,7 +16,9 @@ current_path = os.path.abspath(getsourcefile(lambda:0))
 current_dir = os.path.dirname(current_path)
 parent_dir = current_dir[:current_dir.rfind(os.path.sep)]
 sys.path.insert(0, parent_dir)
-from lib.misc import geohash, clip, legacy_tag, legacy_assess
+from lib.instrumentation import PROFILERS, InstrumentationSettings, instrumented_run, begin, end
+from lib.misc import load_gdf, write_gdf, xy, geohash_encode, morton_encode, assign_sectors, legacy_tag, legacy_assess, legacy_assess_by
+from lib.gt_cache import gt_cache_key, read_gt_cache, write_gt_cache
 
 
 class RequiredInputFiles(BaseModel):
@@ -45,6 +48,9 @@ class RequiredSettings(BaseModel):
 
     gt_sectors_buffer_size_in_meters: float
     tolerance_in_meters: float
+    spatial_key: Literal['geohash', 'morton'] = 'geohash'
+    sector_overlap_policy: Literal['duplicate', 'first', 'nearest_centroid'] = 'duplicate'
+    gt_cache_dir: Optional[str] = None
 
 class Configuration(BaseModel):
 
@@ -55,29 +61,26 @@ class Configuration(BaseModel):
     input_files: RequiredInputFiles
     output_files: RequiredOutputFiles
     settings: RequiredSettings
+    instrumentation: InstrumentationSettings = InstrumentationSettings()
 
-def file_loader(files):
-
-    acc_gdf = gpd.GeoDataFrame() # accumulator
-    for _file in files:
-        # TODO: check CRS and schema  
-        tmp_gdf = gpd.read_file(_file) 
-        acc_gdf = pd.concat([acc_gdf, tmp_gdf])
-
-    gdf = gpd.GeoDataFrame(acc_gdf)
-    return gdf.reset_index(drop=True)
-
-def add_geohash(gdf):
+def add_geohash(gdf, spatial_key='geohash'):
 
     out_gdf = gdf.copy()
-    out_gdf['geohash'] = gdf.to_crs(epsg=4326).apply(geohash, axis=1)
+
+    if spatial_key == 'geohash':
+        lonlat = xy(gdf[['geometry']].to_crs(epsg=4326))
+        out_gdf['geohash'] = geohash_encode(lonlat[:, 0], lonlat[:, 1], precision=16)
+    else:
+        # Morton keys are computed in the projected CRS => no reprojection is needed
+        out_gdf['geohash'] = morton_encode(gdf.geometry.x.values, gdf.geometry.y.values)
 
     return out_gdf
 
 def drop_duplicates(gdf):
     
     out_gdf = gdf.copy()
-    out_gdf.drop_duplicates(subset='geohash', inplace=True)
+    # points lying in overlapping sectors may have been duplicated on purpose, hence the 'sector' column
+    out_gdf.drop_duplicates(subset=['geohash', 'sector'], inplace=True)
 
     return out_gdf
     
@@ -89,6 +92,9 @@ if __name__ == "__main__":
     
     parser = argparse.ArgumentParser(description="This script assesses the quality of detections with respect to ground-truth data.")
     parser.add_argument('config_file', type=str, help='a YAML config file')
+    parser.add_argument('--report-file', dest='report_file', type=str, default=None, help='JSON file the run report (per stage timings, memory and throughput) is written to')
+    parser.add_argument('--profiler', dest='profiler', type=str, default=None, choices=PROFILERS, help='profiles the run; the profile is written next to the report file')
+    parser.add_argument('--trace-memory', dest='trace_memory', action='store_true', help='traces the memory allocated by each stage (slower)')
     args = parser.parse_args()
 
     logger.info("> Loading configuration file...")
@@ -100,86 +106,137 @@ if __name__ == "__main__":
     parsed_cfg = Configuration(**cfg)
     logger.info("< ...done.")
 
-    logger.info("> Loading data...")
-    
-    logger.info("-> GT sectors")
-    gt_sectors_gdf = file_loader(parsed_cfg.input_files.gt_sectors)
-    logger.info("<- ...done.")
-
-    logger.info("-> GT trees")
-    gt_trees_gdf = file_loader(parsed_cfg.input_files.gt_trees)
-    logger.info("<- ...done.")
-
-    logger.info("-> Detections")
-    dets_gdf = file_loader(parsed_cfg.input_files.detections)
-    logger.info("<- ...done.")
-    
-    logger.info("< ...done.")
-
-    logger.info("> Pre-processing data...")
-
-    buffer_size_m = parsed_cfg.settings.gt_sectors_buffer_size_in_meters
-    logger.info(f"-> Adding buffer to GT sectors. Size = {buffer_size_m} m")
-
-    buffered_gt_sectors_gdf = gt_sectors_gdf.copy()
-    buffered_gt_sectors_gdf['geometry'] = buffered_gt_sectors_gdf.geometry.buffer(buffer_size_m)
-
-    logger.info("<- ...done.")
-
-    logger.info("-> Geohashing GT trees...")
-    gt_trees_gdf = add_geohash(gt_trees_gdf)
-    logger.info("<- ...done.")
-
-    logger.info("-> Dropping duplicates in GT trees...")
-    gt_trees_gdf = drop_duplicates(gt_trees_gdf)
-    logger.info("<- ...done.")
-
-    logger.info("-> Geohashing detections...")
-    dets_gdf = add_geohash(dets_gdf)
-    logger.info("<- ...done.")
-
-    logger.info("-> Dropping duplicates in detections...")
-    dets_gdf = drop_duplicates(dets_gdf)
-    logger.info("<- ...done.")
-    
-    logger.info("-> Clipping GT trees using buffered GT sectors...")
-    gt_trees_gdf = clip(gt_trees_gdf, buffered_gt_sectors_gdf)
-    logger.info("<- ...done.")
-
-    logger.info("-> Clipping detections using buffered GT sectors...")
-    dets_gdf = clip(dets_gdf, buffered_gt_sectors_gdf)
-    logger.info("<- ...done.")
-    logger.info("< ...done.")
-
-    logger.info("> Assessing detections...")
-    logger.info("-> Tagging GT trees and detections (True Positives, False Positives, False Negatives)...")
-    tolerance_m = parsed_cfg.settings.tolerance_in_meters
-    tagged_gt_gdf, tagged_dets_gdf = legacy_tag(gt=gt_trees_gdf, preds=dets_gdf, tol=tolerance_m)
-    logger.info("<- ...done.")
-
-    logger.info("-> Computing metrics...")
-    logger.info("--> Global metrics")
-    metrics = legacy_assess(tagged_gt_gdf, tagged_dets_gdf)
-    print(",".join([f"{k}={v:.3f}" for k, v in metrics.items()]))
-    logger.info("<-- ...done.")
-
-    logger.info("--> Per sector metrics")
-    for sector in sorted(gt_sectors_gdf.sector.unique()):
-        metrics = legacy_assess(
-            tagged_gt = tagged_gt_gdf[tagged_gt_gdf.sector == sector],
-            tagged_dets = tagged_dets_gdf[tagged_dets_gdf.sector == sector],
+    # command line arguments override the 'instrumentation' section of the configuration file
+    with instrumented_run(
+        'legacy_det_vs_gt', 
+        report_file=args.report_file or parsed_cfg.instrumentation.report_file, 
+        profiler=args.profiler or parsed_cfg.instrumentation.profiler, 
+        trace_memory=args.trace_memory or parsed_cfg.instrumentation.trace_memory,
+        config_file=os.path.abspath(args.config_file)
+    ):
+        logger.info("> Loading data...")
+        begin("Loading data")
+
+        buffer_size_m = parsed_cfg.settings.gt_sectors_buffer_size_in_meters
+
+        logger.info("-> GT sectors")
+        gt_sectors_gdf = load_gdf(parsed_cfg.input_files.gt_sectors, columns=[], required_columns=['sector'])
+        logger.info("<- ...done.")
+
+        # GT trees and detections lying outside of the buffered GT sectors are not even read
+        bbox = gt_sectors_gdf.total_bounds + np.array([-1, -1, 1, 1]) * buffer_size_m
+
+        # pre-processed GT trees are cached across runs, cf. lib.gt_cache
+        cache_dir = parsed_cfg.settings.gt_cache_dir
+        cached = None
+        if cache_dir is not None:
+            logger.info("-> Looking up GT cache...")
+            cache_key = gt_cache_key(
+                dict(gt_sectors=parsed_cfg.input_files.gt_sectors, gt_trees=parsed_cfg.input_files.gt_trees),
+                parsed_cfg.settings.model_dump(include={'gt_sectors_buffer_size_in_meters', 'spatial_key', 'sector_overlap_policy'}),
+                'legacy_det_vs_gt'
+            )
+            cached = read_gt_cache(cache_dir, cache_key)
+            logger.info(f"<- ...done: cache {'hit' if cached is not None else 'miss'} ({cache_key}).")
+
+        if cached is not None:
+            gt_trees_gdf, _ = cached
+        else:
+            logger.info("-> GT trees")
+            gt_trees_gdf = load_gdf(parsed_cfg.input_files.gt_trees, bbox=bbox, geometry_types=['Point'], crs=gt_sectors_gdf.crs)
+            logger.info("<- ...done.")
+
+        logger.info("-> Detections")
+        dets_gdf = load_gdf(parsed_cfg.input_files.detections, bbox=bbox, geometry_types=['Point'], crs=gt_sectors_gdf.crs)
+        logger.info("<- ...done.")
+
+        end(rows=len(gt_trees_gdf) + len(dets_gdf))
+        logger.info("< ...done.")
+
+        logger.info("> Pre-processing data...")
+        begin("Pre-processing data")
+
+        logger.info(f"-> Adding buffer to GT sectors. Size = {buffer_size_m} m")
+
+        buffered_gt_sectors_gdf = gt_sectors_gdf.copy()
+        buffered_gt_sectors_gdf['geometry'] = buffered_gt_sectors_gdf.geometry.buffer(buffer_size_m)
+
+        logger.info("<- ...done.")
+
+        overlap_policy = parsed_cfg.settings.sector_overlap_policy
+        if cached is None:
+            logger.info(f"-> Assigning GT trees to buffered GT sectors (overlap policy: {overlap_policy})...")
+            gt_trees_gdf = assign_sectors(gt_trees_gdf, buffered_gt_sectors_gdf, overlap_policy=overlap_policy)
+            logger.info("<- ...done.")
+
+        logger.info(f"-> Assigning detections to buffered GT sectors (overlap policy: {overlap_policy})...")
+        dets_gdf = assign_sectors(dets_gdf, buffered_gt_sectors_gdf, overlap_policy=overlap_policy)
+        logger.info("<- ...done.")
+
+        spatial_key = parsed_cfg.settings.spatial_key
+        if cached is None:
+            logger.info(f"-> Geohashing GT trees (spatial key: {spatial_key})...")
+            gt_trees_gdf = add_geohash(gt_trees_gdf, spatial_key=spatial_key)
+            logger.info("<- ...done.")
+
+            logger.info("-> Dropping duplicates in GT trees...")
+            gt_trees_gdf = drop_duplicates(gt_trees_gdf)
+            logger.info("<- ...done.")
+
+        if cache_dir is not None and cached is None:
+            logger.info("-> Writing GT cache...")
+            write_gt_cache(cache_dir, cache_key, gt_trees_gdf)
+            logger.info("<- ...done.")
+
+        logger.info(f"-> Geohashing detections (spatial key: {spatial_key})...")
+        dets_gdf = add_geohash(dets_gdf, spatial_key=spatial_key)
+        logger.info("<- ...done.")
+
+        logger.info("-> Dropping duplicates in detections...")
+        dets_gdf = drop_duplicates(dets_gdf)
+        logger.info("<- ...done.")
+        end(rows=len(gt_trees_gdf) + len(dets_gdf))
+        logger.info("< ...done.")
+
+        logger.info("> Assessing detections...")
+        begin("Assessing detections")
+        logger.info("-> Tagging GT trees and detections (True Positives, False Positives, False Negatives)...")
+        begin("Tagging GT trees and detections")
+        tolerance_m = parsed_cfg.settings.tolerance_in_meters
+        tagged_gt_gdf, tagged_dets_gdf = legacy_tag(gt=gt_trees_gdf, preds=dets_gdf, tol=tolerance_m)
+        end(rows=len(tagged_gt_gdf) + len(tagged_dets_gdf))
+        logger.info("<- ...done.")
+
+        logger.info("-> Computing metrics...")
+        begin("Computing metrics")
+        logger.info("--> Global metrics")
+        metrics = legacy_assess(tagged_gt_gdf, tagged_dets_gdf)
+        print(",".join([f"{k}={v:.3f}" for k, v in metrics.items()]))
+        logger.info("<-- ...done.")
+
+        logger.info("--> Per sector metrics")
+        per_sector_metrics_df = legacy_assess_by(
+            tagged_gt=tagged_gt_gdf, 
+            tagged_dets=tagged_dets_gdf, 
+            by='sector', 
+            keys=sorted(gt_sectors_gdf.sector.unique())
         )
-        print(",".join([f"sector={sector}"] + [f"{k}={v:.3f}" for k, v in metrics.items()]))
-    logger.info("<-- ...done.")
-    logger.info("<- ...done.")
-    logger.info("< ...done.")
-
-    logger.info("> Generating output files...")
-    tagged_gt_gdf.to_file(parsed_cfg.output_files.tagged_gt_trees, driver='GPKG')
-    tagged_dets_gdf.to_file(parsed_cfg.output_files.tagged_detections, driver='GPKG')
-    logger.info("< ...done. The following files were generated:")
-    for out_file in parsed_cfg.output_files:
-        logger.info(out_file[1])
+        for sector, metrics in per_sector_metrics_df.iterrows():
+            print(",".join([f"sector={sector}"] + [f"{k}={v:.3f}" for k, v in metrics.items()]))
+        logger.info("<-- ...done.")
+        end(rows=len(tagged_gt_gdf) + len(tagged_dets_gdf))
+        logger.info("<- ...done.")
+        end()
+        logger.info("< ...done.")
+
+        logger.info("> Generating output files...")
+        begin("Generating output files")
+        write_gdf(tagged_gt_gdf, parsed_cfg.output_files.tagged_gt_trees)
+        write_gdf(tagged_dets_gdf, parsed_cfg.output_files.tagged_detections)
+        end(rows=len(tagged_gt_gdf) + len(tagged_dets_gdf))
+        logger.info("< ...done. The following files were generated:")
+        for out_file in parsed_cfg.output_files:
+            logger.info(out_file[1])
     
     toc = time.time()
     logger.info(f"...done in {toc-tic:.2f} seconds.")
@@ -1,4 +1,17 @@
 import os, sys
+import glob
+import time
+import argparse
+import logging
+import tempfile
+import traceback
+import multiprocessing
+import pandas as pd
+import logzero
+
+from contextlib import contextmanager
+from functools import partial
+from logzero import logger
 
 # the following lines allow us to import modules from within this file's parent folder
 from inspect import getsourcefile
@@ -8,25 +21,216 @@ parent_dir = current_dir[:current_dir.rfind(os.path.sep)]
 sys.path.insert(0, parent_dir)
 
 from assessment_scripts import det_vs_gt
-from tkinter import Tk 
-from tkinter.filedialog import askdirectory
+
+
+# pre-processed GT data of the last GT dataset seen by the current (worker) process; 
+# only one dataset is kept, in order to bound memory
+_gt_cache = {}
+
+@contextmanager
+def log_level(verbose):
+    """
+        Silences the progress logs of det_vs_gt.py (warnings and errors excepted) unless verbose is True.
+    """
+
+    level = logger.level
+    if not verbose:
+        logzero.loglevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        logzero.loglevel(level)
+
+def list_config_files(inputs):
+
+    config_files = []
+    for _input in inputs:
+        if os.path.isdir(_input):
+            # all the .yaml files found in the folder
+            config_files += sorted(glob.glob(os.path.join(_input, '*.yaml')))
+        else:
+            config_files += sorted(glob.glob(_input))
+
+    # duplicates are dropped, order is preserved
+    return list(dict.fromkeys(config_files))
+
+def init_worker(max_memory_mb, verbose):
+    """
+        - max_memory_mb = limit of the address space of the worker process, in MB; 
+          exceeding it results in a MemoryError, which is reported as the failure of the current configuration
+    """
+
+    if not verbose:
+        logzero.loglevel(logging.WARNING)
+
+    if max_memory_mb is not None:
+        try:
+            import resource
+            max_memory_bytes = int(max_memory_mb * 1024**2)
+            resource.setrlimit(resource.RLIMIT_AS, (max_memory_bytes, max_memory_bytes))
+        except (ImportError, ValueError) as e:
+            logger.warning(f"Cannot limit memory per worker on this platform ({e}).")
+
+def load_configuration(config_file, gt_cache_dir=None):
+    """
+        - gt_cache_dir = (optional) GT cache folder (cf. lib.gt_cache), used by the configurations which do not set their own one
+    """
+
+    parsed_cfg = det_vs_gt.load_configuration(config_file)
+    if gt_cache_dir is not None and parsed_cfg.settings.gt_cache_dir is None:
+        parsed_cfg.settings.gt_cache_dir = gt_cache_dir
+
+    return parsed_cfg
+
+def prepare_gt_caches(config_files, gt_cache_dir, verbose=False):
+    """
+        Pre-processes each distinct GT dataset once, in the main process, so that worker processes read pre-processed GT data 
+        from the GT cache instead of pre-processing them again. Failures are left to run_config() to report.
+    """
+
+    prepared = set()
+    for config_file in config_files:
+        try:
+            with log_level(verbose):
+                parsed_cfg = load_configuration(config_file, gt_cache_dir)
+            key = det_vs_gt.gt_key(parsed_cfg)
+            # tiled assessments read GT trees tile by tile, hence they do not use the GT cache
+            if key in prepared or parsed_cfg.settings.tile_size_in_meters is not None:
+                continue
+            prepared.add(key)
+            logger.info(f"Pre-processing the GT data of {config_file}...")
+            with log_level(verbose):
+                det_vs_gt.prepare_gt(parsed_cfg)
+        except (Exception, SystemExit):
+            # failures are reported by run_config()
+            continue
+
+def run_config(config_file, gt_cache_dir=None):
+    """
+        Assesses the detections of one configuration file. Any failure is caught and reported, so that it does not affect other configurations.
+    """
+
+    tic = time.time()
+
+    try:
+        parsed_cfg = load_configuration(config_file, gt_cache_dir)
+        key = det_vs_gt.gt_key(parsed_cfg)
+        if key not in _gt_cache:
+            _gt_cache.clear()
+            _gt_cache[key] = det_vs_gt.prepare_gt(parsed_cfg)
+        metrics_df = det_vs_gt.assess_detections(parsed_cfg, _gt_cache[key])
+        error = None
+    except (Exception, SystemExit) as e:
+        _gt_cache.clear()
+        metrics_df = None
+        error = "".join(traceback.format_exception_only(type(e), e)).strip()
+        logger.debug(traceback.format_exc())
+
+    return dict(config_file=config_file, metrics_df=metrics_df, error=error, elapsed_time=time.time()-tic)
+
+def log_result(result):
+
+    status = 'OK' if result['error'] is None else f"FAILED: {result['error']}"
+    logger.info(f"{result['config_file']}: {status} ({result['elapsed_time']:.2f} seconds)")
+
+def run_batch(config_files, n_workers=1, max_memory_mb=None, max_tasks_per_worker=None, verbose=False, gt_cache_dir=None):
+    """
+        - gt_cache_dir = (optional) GT cache folder shared by the configurations which do not set their own one; with several workers, 
+          a temporary one is used if none is provided, so that each distinct GT dataset is pre-processed once, by the main process
+    """
+
+    # configurations sharing the same GT data are made adjacent, hence workers re-use their cached GT data as much as possible
+    keys = {}
+    for config_file in config_files:
+        try:
+            with log_level(verbose):
+                keys[config_file] = det_vs_gt.gt_key(det_vs_gt.load_configuration(config_file))
+        except (Exception, SystemExit):
+            keys[config_file] = '' # errors will be reported by run_config
+    sorted_config_files = sorted(config_files, key=lambda x: keys[x])
+
+    results = []
+    if n_workers == 1:
+        # GT data are pre-processed once per distinct GT dataset, as configurations sharing them are adjacent
+        for config_file in sorted_config_files:
+            with log_level(verbose):
+                result = run_config(config_file, gt_cache_dir)
+            log_result(result)
+            results.append(result)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gt_cache_dir = tmp_dir if gt_cache_dir is None else gt_cache_dir
+            prepare_gt_caches(sorted_config_files, gt_cache_dir, verbose=verbose)
+            with multiprocessing.Pool(
+                processes=n_workers, 
+                initializer=init_worker, 
+                initargs=(max_memory_mb, verbose), 
+                maxtasksperchild=max_tasks_per_worker
+            ) as pool:
+                for result in pool.imap_unordered(partial(run_config, gt_cache_dir=gt_cache_dir), sorted_config_files):
+                    log_result(result)
+                    results.append(result)
+
+    # results are sorted back, according to the input order
+    position = {config_file: i for i, config_file in enumerate(config_files)}
+    results = sorted(results, key=lambda x: position[x['config_file']])
+
+    metrics_dfs = [result['metrics_df'].assign(config_file=result['config_file']) for result in results if result['error'] is None]
+    metrics_df = pd.concat(metrics_dfs) if len(metrics_dfs) > 0 else pd.DataFrame(columns=['config_file'])
+    metrics_df = metrics_df[['config_file'] + [col for col in metrics_df.columns if col != 'config_file']]
+    
+    status_df = pd.DataFrame.from_records(
+        [{'config_file': result['config_file'], 'error': result['error'], 'elapsed_time': result['elapsed_time']} for result in results]
+    )
+
+    return metrics_df, status_df
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="This script assesses detections with respect to ground-truth data, for a batch of det_vs_gt.py configuration files.")
+    parser.add_argument('inputs', type=str, nargs='*', help='folders including configuration files (*.yaml) and/or glob patterns (ex.: "configs/*_config.yaml"); if none is provided, a folder is prompted for')
+    parser.add_argument('--workers', dest='n_workers', type=int, default=1, help='number of worker processes (default: 1)')
+    parser.add_argument('--max-memory-per-worker', dest='max_memory_mb', type=float, default=None, help='memory limit per worker process, in MB (Unix only)')
+    parser.add_argument('--max-tasks-per-worker', dest='max_tasks_per_worker', type=int, default=None, help='worker processes are replaced after this number of configuration files')
+    parser.add_argument('--output-file', dest='out_file', type=str, default='batch_metrics.csv', help='CSV file collecting the metrics of all configuration files (default: batch_metrics.csv)')
+    parser.add_argument('--gt-cache-dir', dest='gt_cache_dir', type=str, default=None, help='GT cache folder, used by the config files which do not set their own one (cf. the gt_cache_dir setting); with several workers, a temporary one is used by default')
+    parser.add_argument('--verbose', dest='verbose', action='store_true', help='log the progress of each config file')
+    args = parser.parse_args()
+
+    inputs = args.inputs
+    if len(inputs) == 0:
+        from tkinter import Tk 
+        from tkinter.filedialog import askdirectory
  
-Tk().withdraw() # we don't want a full GUI, so keep the root window from appearing 
-yamlFolderPath = askdirectory() # show an "Open" dialog box and return the path to the selected file 
+        Tk().withdraw() # we don't want a full GUI, so keep the root window from appearing 
+        inputs = [askdirectory()] # show an "Open" dialog box and return the path to the selected folder
+
+    tic = time.time()
 
-configFileList = []
+    configFileList = list_config_files(inputs)
+    print("{} config files found.".format(str(len(configFileList))))
 
-# List all files in selected folder.
-for fileName in os.listdir(yamlFolderPath):
-    # If the file name ends with the correct extension, 
-    # it is added to the list of files to use later.
-    if fileName.endswith(".yaml"):
-        toAppend = yamlFolderPath + "\\" + fileName
-        configFileList.append(toAppend)
+    metrics_df, status_df = run_batch(
+        configFileList, 
+        n_workers=args.n_workers, 
+        max_memory_mb=args.max_memory_mb, 
+        max_tasks_per_worker=args.max_tasks_per_worker,
+        verbose=args.verbose,
+        gt_cache_dir=args.gt_cache_dir
+    )
 
-print("{} config files found in selected folder.".format(str(len(configFileList))))
+    metrics_df.to_csv(args.out_file, sep=',', index=False)
+    out_root, out_ext = os.path.splitext(args.out_file)
+    status_file = f"{out_root}_status{out_ext}"
+    status_df.to_csv(status_file, sep=',', index=False)
 
-for config in configFileList:
-    det_vs_gt.main(config)
+    failures = status_df[status_df.error.notnull()]
+    for failure in failures.itertuples():
+        logger.error(f"{failure.config_file}: {failure.error}")
 
-print("Batch evaluation successfully completed on {} config files.".format(str(len(configFileList))))
\ No newline at end of file
+    toc = time.time()
+    print("Batch evaluation completed in {:.2f} seconds: {} succeeded, {} failed.".format(toc-tic, len(status_df)-len(failures), len(failures)))
+    print("The following files were written:")
+    print(args.out_file)
+    print(status_file)
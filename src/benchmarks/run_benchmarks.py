@@ -0,0 +1,232 @@
+import os, sys
+import gc
+import json
+import time
+import argparse
+import logging
+import platform
+import datetime
+import subprocess
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+import logzero
+
+from importlib.metadata import version, PackageNotFoundError
+
+# the following lines allow us to import modules from within this file's parent folder
+from inspect import getsourcefile
+current_path = os.path.abspath(getsourcefile(lambda:0))
+current_dir = os.path.dirname(current_path)
+parent_dir = current_dir[:current_dir.rfind(os.path.sep)]
+sys.path.insert(0, parent_dir)
+
+from lib.misc import assign_sectors, tag, legacy_tag, ckdnearest, clip
+from assessment_scripts import det_vs_gt, detA_vs_detB, detN_consensus
+from data_transformers import ts_txt_to_gpkg, gis_to_las
+from benchmarks.synthetic import LAYOUTS, make_dataset, write_terrascan_txt
+
+
+TOLERANCE_M = 1.0
+BUFFER_SIZE_M = 1.0
+PACKAGES = ['numpy', 'pandas', 'geopandas', 'shapely', 'scipy', 'pyogrio', 'pyarrow', 'laspy']
+
+# benchmarked functions log their progress through logzero's default logger, which is silenced unless --verbose is set
+logger = logzero.setup_logger(name='benchmarks')
+
+
+def prepare(data):
+    """
+        Pre-processes synthetic data as det_vs_gt.py does.
+        Returns a dict: 'buffered_sectors', 'gt', 'dets' (assigned to sectors, geohashed and deduplicated), 'tagged_dets'
+    """
+
+    buffered_sectors = data['sectors'].copy()
+    buffered_sectors['geometry'] = buffered_sectors.geometry.buffer(BUFFER_SIZE_M)
+
+    gt = assign_sectors(data['gt'], buffered_sectors)
+    gt = det_vs_gt.drop_duplicates(det_vs_gt.add_geohash(gt, prefix='gt_'))
+    dets = assign_sectors(data['dets'], buffered_sectors)
+    dets = det_vs_gt.drop_duplicates(det_vs_gt.add_geohash(dets, prefix='dt_'))
+    _, tagged_dets = tag(gt, dets, TOLERANCE_M)
+
+    return dict(buffered_sectors=buffered_sectors, gt=gt, dets=dets, tagged_dets=tagged_dets)
+
+
+def las_input(tagged_dets):
+    # input of add_rgb() and write_las(), as built by gis_to_las.py (elevations are constant instead of being fetched from a DEM)
+
+    gdf = tagged_dets.copy()
+    gdf['geometry'] = gdf.geometry.centroid
+
+    return gis_to_las.add_z(gdf, provider='constant', z=400.0)
+
+
+# benchmark -> function(data, prepared data, temporary folder) returning the callable to be timed;
+# the set-up (ex.: pre-processing) is not timed
+BENCHMARKS = {
+    'tag[sjoin]': lambda data, prep, tmp_dir: lambda: tag(prep['gt'], prep['dets'], TOLERANCE_M, matching_method='sjoin'),
+    'tag[kdtree]': lambda data, prep, tmp_dir: lambda: tag(prep['gt'], prep['dets'], TOLERANCE_M, matching_method='kdtree'),
+    'legacy_tag': lambda data, prep, tmp_dir: lambda: legacy_tag(prep['gt'], prep['dets'], TOLERANCE_M),
+    'ckdnearest': lambda data, prep, tmp_dir: lambda: ckdnearest(prep['gt'], prep['dets']),
+    'clip': lambda data, prep, tmp_dir: lambda: clip(data['dets'], prep['buffered_sectors']),
+    'assign_sectors': lambda data, prep, tmp_dir: lambda: assign_sectors(data['dets'], prep['buffered_sectors']),
+    'add_geohash[geohash]': lambda data, prep, tmp_dir: lambda: det_vs_gt.add_geohash(data['dets'], prefix='dt_'),
+    'add_geohash[morton]': lambda data, prep, tmp_dir: lambda: det_vs_gt.add_geohash(data['dets'], spatial_key='morton'),
+    'detA_vs_detB': lambda data, prep, tmp_dir: lambda: detA_vs_detB.match_runs(data['dets'], data['dets_B'], TOLERANCE_M),
+    'detA_vs_detB[pairs]': lambda data, prep, tmp_dir: lambda: detA_vs_detB.match_runs(data['dets'], data['dets_B'], TOLERANCE_M, return_pairs=True),
+    'detN_consensus': lambda data, prep, tmp_dir: lambda: detN_consensus.consensus({'A': data['dets'], 'B': data['dets_B']}, TOLERANCE_M),
+    'ts_txt_to_gpkg': lambda data, prep, tmp_dir: (
+        lambda txt_file: lambda: ts_txt_to_gpkg.convert(txt_file, tmp_dir)
+    )(write_terrascan_txt(data['dets'], os.path.join(tmp_dir, 'dets.txt'))),
+    'add_rgb': lambda data, prep, tmp_dir: (
+        lambda gdf: lambda: gis_to_las.add_rgb(gdf)
+    )(las_input(prep['tagged_dets'])),
+    'write_las': lambda data, prep, tmp_dir: (
+        lambda gdf: lambda: gis_to_las.write_las(gdf, os.path.join(tmp_dir, 'dets.las'), z_offset_m=1)
+    )(gis_to_las.add_rgb(las_input(prep['tagged_dets']))),
+}
+
+
+def measure(func, repeat):
+    """
+        Times func (repeat runs), then measures the peak of the memory it allocates (one additional run, traced by tracemalloc,
+        hence not timed). Only the memory allocated through Python's allocators (including NumPy arrays) is traced.
+    """
+
+    wall_times, cpu_times = [], []
+    for _ in range(repeat):
+        gc.collect()
+        wall_tic, cpu_tic = time.perf_counter(), time.process_time()
+        func()
+        wall_times.append(time.perf_counter() - wall_tic)
+        cpu_times.append(time.process_time() - cpu_tic)
+
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return dict(
+        wall_time_s_min=min(wall_times),
+        wall_time_s_median=float(np.median(wall_times)),
+        cpu_time_s_median=float(np.median(cpu_times)),
+        peak_memory_mb=peak / 1024**2
+    )
+
+
+def git_commit():
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=current_dir, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def package_version(package):
+
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return None
+
+
+def run_benchmarks(layouts, sizes, benchmarks, repeat=3, seed=0):
+    """
+        Runs the benchmarks on synthetic datasets, one per (layout, size). Returns a list of dicts (one per benchmark and dataset).
+    """
+
+    results = []
+    for layout in layouts:
+        for n_trees in sizes:
+            logger.info(f"> Generating dataset: layout = {layout}, {n_trees} GT trees, seed = {seed}...")
+            data = make_dataset(layout, n_trees, seed=seed)
+            prep = prepare(data)
+            logger.info(f"< ...done: {len(data['gt'])} GT trees, {len(data['dets'])} + {len(data['dets_B'])} detections.")
+
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                for benchmark in benchmarks:
+                    logger.info(f"-> {benchmark}...")
+                    func = BENCHMARKS[benchmark](data, prep, tmp_dir)
+                    result = measure(func, repeat)
+                    results.append(dict(
+                        layout=layout,
+                        n_trees=n_trees,
+                        n_gt=len(data['gt']),
+                        n_dets=len(data['dets']),
+                        benchmark=benchmark,
+                        repeat=repeat,
+                        **result
+                    ))
+                    logger.info(f"<- ...done in {result['wall_time_s_median']:.3f} s (median), peak memory = {result['peak_memory_mb']:.1f} MB.")
+
+    return results
+
+
+def compare(results_df, baseline_df):
+    """
+        Ratios of the median wall times and peak memories w.r.t. a baseline (ex.: the results of another commit); ratio > 1 = regression.
+    """
+
+    keys = ['layout', 'n_trees', 'benchmark']
+    cols = ['wall_time_s_median', 'peak_memory_mb']
+    merged = results_df[keys + cols].merge(baseline_df[keys + cols], on=keys, suffixes=('', '_baseline'))
+    for col in cols:
+        merged[f"{col}_ratio"] = merged[col] / merged[f"{col}_baseline"]
+
+    return merged
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="This script benchmarks the hot paths of the toolkit on synthetic datasets.")
+    parser.add_argument('--layouts', dest='layouts', type=str, nargs='+', default=list(LAYOUTS.keys()), choices=list(LAYOUTS.keys()), help='synthetic layouts (default: all)')
+    parser.add_argument('--sizes', dest='sizes', type=int, nargs='+', default=[1000, 10000], help='numbers of GT trees (default: 1000 10000)')
+    parser.add_argument('--benchmarks', dest='benchmarks', type=str, nargs='+', default=list(BENCHMARKS.keys()), choices=list(BENCHMARKS.keys()), help='benchmarks to run (default: all)')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='number of timed runs per benchmark (default: 3)')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='seed of the synthetic datasets generator (default: 0)')
+    parser.add_argument('--output-file', dest='out_file', type=str, default='benchmarks.json', help='JSON file collecting results (default: benchmarks.json)')
+    parser.add_argument('--baseline', dest='baseline_file', type=str, default=None, help='JSON file output by a previous run (ex.: another commit), results are compared to')
+    parser.add_argument('--verbose', dest='verbose', action='store_true', help='let benchmarked functions log their progress')
+    args = parser.parse_args()
+
+    tic = time.time()
+    logger.info("Starting...")
+
+    if not args.verbose:
+        logzero.loglevel(logging.WARNING)
+
+    results = run_benchmarks(args.layouts, args.sizes, args.benchmarks, repeat=args.repeat, seed=args.seed)
+
+    output = dict(
+        metadata=dict(
+            timestamp=datetime.datetime.now().isoformat(timespec='seconds'),
+            git_commit=git_commit(),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpu_count=os.cpu_count(),
+            packages={package: package_version(package) for package in PACKAGES},
+            settings=dict(layouts=args.layouts, sizes=args.sizes, repeat=args.repeat, seed=args.seed, tolerance_in_meters=TOLERANCE_M)
+        ),
+        results=results
+    )
+    with open(args.out_file, 'w') as fp:
+        json.dump(output, fp, indent=2)
+
+    results_df = pd.DataFrame.from_records(results)
+    print(results_df[['layout', 'n_trees', 'benchmark', 'wall_time_s_median', 'peak_memory_mb']].to_string(index=False))
+
+    if args.baseline_file is not None:
+        with open(args.baseline_file) as fp:
+            baseline = json.load(fp)
+        logger.info(f"Comparison with the baseline (commit: {baseline['metadata'].get('git_commit')}):")
+        print(compare(results_df, pd.DataFrame.from_records(baseline['results'])).to_string(index=False))
+
+    logger.info(f"The following file was written: {args.out_file}")
+
+    toc = time.time()
+    logger.info(f"...done in {toc-tic:.2f} seconds.")
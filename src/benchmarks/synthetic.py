@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from shapely.geometry import box
+
+
+# synthetic datasets lie in Switzerland (EPSG:2056), so that geohashing involves an actual reprojection
+EPSG = 2056
+ORIGIN = (2500000.0, 1115000.0)
+
+
+def orchard_trees(n_trees, rng, spacing_m=6.0, jitter_m=0.2):
+    """
+        Sparse orchard: trees are planted along a regular square grid.
+    """
+
+    n_cols = int(np.ceil(np.sqrt(n_trees)))
+    idx = np.arange(n_trees)
+    coords = np.column_stack([idx % n_cols, idx // n_cols]) * spacing_m
+
+    return coords + rng.normal(0, jitter_m, coords.shape)
+
+
+def alley_trees(n_trees, rng, spacing_m=3.0, alley_width_m=8.0, block_size_m=40.0, jitter_m=0.3):
+    """
+        Dense alleys: pairs of tree rows (one on each side of an alley), pairs being block_size_m apart.
+    """
+
+    # the layout is made roughly square
+    trees_per_row = int(np.ceil(np.sqrt(n_trees * block_size_m / (2 * spacing_m))))
+    idx = np.arange(n_trees)
+    row, pos = idx // trees_per_row, idx % trees_per_row
+    coords = np.column_stack([pos * spacing_m, (row // 2) * block_size_m + (row % 2) * alley_width_m])
+
+    return coords + rng.normal(0, jitter_m, coords.shape)
+
+
+def park_trees(n_trees, rng, trees_per_cluster=30, cluster_spacing_m=60.0, cluster_radius_m=10.0):
+    """
+        Clustered park: groves (Thomas cluster process) scattered over a lawn.
+    """
+
+    n_clusters = max(1, n_trees // trees_per_cluster)
+    extent_m = np.sqrt(n_clusters) * cluster_spacing_m
+    centers = rng.uniform(0, extent_m, (n_clusters, 2))
+    coords = centers[rng.integers(0, n_clusters, n_trees)]
+
+    return coords + rng.normal(0, cluster_radius_m, coords.shape)
+
+
+# layout -> tree generator and detector behaviour:
+# - recall = share of GT trees which are detected
+# - noise_m = standard deviation of the location error of detections
+# - split_rate = share of detected trees which are detected twice (over-segmentation)
+# - fp_rate = number of false detections, scattered at random, per detected tree
+LAYOUTS = {
+    'orchard': dict(trees=orchard_trees, recall=0.95, noise_m=0.5, split_rate=0.02, fp_rate=0.05),
+    'alley': dict(trees=alley_trees, recall=0.9, noise_m=0.8, split_rate=0.05, fp_rate=0.1),
+    'park': dict(trees=park_trees, recall=0.8, noise_m=1.2, split_rate=0.1, fp_rate=0.15),
+}
+
+
+def detect(gt_coords, rng, recall, noise_m, split_rate, fp_rate):
+    """
+        Simulates the output of a tree detector, out of the coordinates of GT trees.
+    """
+
+    detected = gt_coords[rng.random(len(gt_coords)) < recall]
+    split = detected[rng.random(len(detected)) < split_rate]
+    n_fp = int(fp_rate * len(detected))
+    false = rng.uniform(gt_coords.min(axis=0), gt_coords.max(axis=0), (n_fp, 2))
+
+    coords = np.vstack([detected, split, false])
+    coords[:len(detected) + len(split)] += rng.normal(0, noise_m, (len(detected) + len(split), 2))
+
+    # detections are shuffled, as detectors do not output them in any particular order
+    return coords[rng.permutation(len(coords))]
+
+
+def points_gdf(coords, data):
+
+    return gpd.GeoDataFrame(
+        data,
+        geometry=gpd.points_from_xy(coords[:, 0] + ORIGIN[0], coords[:, 1] + ORIGIN[1]),
+        crs=f"EPSG:{EPSG}"
+    )
+
+
+def make_dataset(layout, n_trees, seed=0, n_sectors_per_side=3):
+    """
+        Generates GT trees, detections stemming from two independent runs (A and B) and a grid of
+        n_sectors_per_side x n_sectors_per_side GT sectors covering GT trees. The same seed yields the same dataset.
+        Returns a dict: 'gt', 'dets', 'dets_B', 'sectors' -> GeoDataFrame
+    """
+
+    assert layout in LAYOUTS.keys(), f"Unknown layout: {layout}"
+
+    rng = np.random.default_rng(seed)
+    params = LAYOUTS[layout]
+    detector = {k: v for k, v in params.items() if k != 'trees'}
+
+    gt_coords = params['trees'](n_trees, rng)
+    dets_coords = detect(gt_coords, rng, **detector)
+    dets_B_coords = detect(gt_coords, rng, **detector)
+
+    gt = points_gdf(gt_coords, {'tree_id': np.arange(len(gt_coords))})
+    dets = points_gdf(dets_coords, {'det_id': np.arange(len(dets_coords)), 'score': rng.random(len(dets_coords))})
+    dets_B = points_gdf(dets_B_coords, {'det_id': np.arange(len(dets_B_coords)), 'score': rng.random(len(dets_B_coords))})
+
+    minx, miny, maxx, maxy = gt.total_bounds
+    step_x = (maxx - minx) / n_sectors_per_side
+    step_y = (maxy - miny) / n_sectors_per_side
+    sectors = gpd.GeoDataFrame(
+        {'sector': [f"S{i}" for i in range(n_sectors_per_side**2)]},
+        geometry=[
+            box(minx + i * step_x, miny + j * step_y, minx + (i + 1) * step_x, miny + (j + 1) * step_y)
+            for j in range(n_sectors_per_side) for i in range(n_sectors_per_side)
+        ],
+        crs=f"EPSG:{EPSG}"
+    )
+
+    return dict(gt=gt, dets=dets, dets_B=dets_B, sectors=sectors)
+
+
+def write_terrascan_txt(dets, path, seed=0):
+    """
+        Writes detections as a TerraScan TXT file (cf. ts_txt_to_gpkg.py), with made up tree attributes.
+    """
+
+    rng = np.random.default_rng(seed)
+    n = len(dets)
+    x, y = dets.geometry.x.values, dets.geometry.y.values
+    ground_z = 400.0 + rng.normal(0, 5, n)
+    height = rng.uniform(3, 30, n)
+
+    df = pd.DataFrame({
+        'Group id': np.arange(1, n + 1),
+        'Point count': rng.integers(50, 5000, n),
+        'Average easting': x,
+        'Average northing': y,
+        'Average z': ground_z + height / 2,
+        'Ground z at average xy': ground_z,
+        'Trunk easting': x + rng.normal(0, 0.3, n),
+        'Trunk northing': y + rng.normal(0, 0.3, n),
+        'Trunk ground z': ground_z + rng.normal(0, 0.1, n),
+        'Trunk diameter': rng.uniform(0.1, 1.0, n),
+        'Canopy width': rng.uniform(1, 15, n),
+        'Biggest distance': rng.uniform(1, 15, n),
+        'Smallest distance': rng.uniform(1, 10, n),
+        'Length': rng.uniform(1, 15, n),
+        'Width': rng.uniform(1, 15, n),
+        'Height': height,
+    })
+    df.to_csv(path, sep=',', header=False, index=False, float_format='%.3f')
+
+    return path
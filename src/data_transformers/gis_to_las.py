@@ -1,18 +1,23 @@
 import os, sys
 import time
+import json
 import argparse
 import pandas as pd
 import geopandas as gpd
-import requests
 import laspy
 import numpy as np
 
-from shapely.geometry import Point
 from logzero import logger
-from tqdm.auto import tqdm
-from fractions import Fraction
 
-tqdm.pandas()
+# the following lines allow us to import modules from within this file's parent folder
+from inspect import getsourcefile
+current_path = os.path.abspath(getsourcefile(lambda:0))
+current_dir = os.path.dirname(current_path)
+parent_dir = current_dir[:current_dir.rfind(os.path.sep)]
+sys.path.insert(0, parent_dir)
+from lib.instrumentation import PROFILERS, instrumented_run, begin, end
+from lib.elevation import ELEVATION_PROVIDERS, GENEVA_DEM_URL, elevations
+from lib.misc import read_tagged, curve_order, CURVES
 
 
 # CONSTANTS
@@ -27,95 +32,218 @@ LAS_CLASS = 17
 
 def file_loader(full_path):
 
-    gdf = gpd.read_file(full_path)#, sep=SEPARATOR, names=COL_NAMES)
+    # charges stored as string fractions (legacy format) are converted to integer numerators/denominator
+    gdf = read_tagged(full_path)
 
     return gdf
 
 
-def get_z(x, y):
-
-    url = f"https://ge.ch/sitgags2/rest/services/RASTER/MNA_TERRAIN/ImageServer/getSamples?geometry={x},{y}&geometryType=esriGeometryPoint&sampleDistance=&sampleCount=&mosaicRule=&pixelSize=&returnFirstValueOnly=true&f=json"
-    
-    res = requests.get(url)
-    data = res.json()
-    z = data['samples'][0]['value']
-    time.sleep(0.1)
-    
-    return float(z) 
-
-def add_z(row):
-    
-    x = row.geometry.x
-    y = row.geometry.y
+def add_z(gdf, provider='remote', **options):
+    """
+        Adds the x, y, z columns and turns geometries into 3D points, elevations being provided by one of the providers of lib.elevation.
+    """
     
-    z = get_z(x, y)
+    x = gdf.geometry.x.values
+    y = gdf.geometry.y.values
+    z = elevations(gdf, provider=provider, **options)
     
-    row['x'] = float(x)
-    row['y'] = float(y)
-    row['z'] = z
-    row['geometry'] = Point(x, y, z)
+    out_gdf = gdf.copy()
+    out_gdf['x'] = x
+    out_gdf['y'] = y
+    out_gdf['z'] = z
+    out_gdf['geometry'] = gpd.points_from_xy(x, y, z, crs=gdf.crs)
     
-    return row
+    return out_gdf
 
-def add_rgb(row):
-    
-    if ('FP_charge' in row) and ('TP_charge' in row):
+def add_rgb(gdf):
+    """
+        Adds the r, g, b columns: base colors (cf. README) are weighted by charges, computed on whole columns. 
+        Items lacking charges (ex.: NaN) are gray.
+    """
+
+    out_gdf = gdf.copy()
+    cols = gdf.columns.tolist()
+
+    if ('FP_charge_num' in cols) and ('TP_charge_num' in cols):
         # det
-        row['r'], row['g'], row['b'] = (Fraction(row.FP_charge) * np.array(RED) + Fraction(row.TP_charge) * np.array(BUD_GREEN)).astype(np.int32)
-    elif ('FN_charge' in row) and ('TP_charge' in row):
+        weights = {'FP_charge_num': RED, 'TP_charge_num': BUD_GREEN}
+    elif ('FN_charge_num' in cols) and ('TP_charge_num' in cols):
         # GT
-        row['r'], row['g'], row['b'] = (Fraction(row.FN_charge) * np.array(BLUE) + Fraction(row.TP_charge) * np.array(BRIGHT_GREEN)).astype(np.int32)
+        weights = {'FN_charge_num': BLUE, 'TP_charge_num': BRIGHT_GREEN}
     else:
-        row['r'], row['g'], row['b'] = GRAY
+        weights = None
+
+    rgb = np.tile(np.array(GRAY, dtype=np.int32), (len(gdf), 1))
+    if weights is not None:
+        den = gdf.charge_den.to_numpy(dtype=float)
+        blend = sum([gdf[col].to_numpy(dtype=float)[:, None] * np.array(color) for col, color in weights.items()])
+        blend = np.floor_divide(blend, den[:, None])
+        has_charges = np.isfinite(blend).all(axis=1)
+        rgb[has_charges] = blend[has_charges].astype(np.int32)
+
+    out_gdf['r'], out_gdf['g'], out_gdf['b'] = rgb[:, 0], rgb[:, 1], rgb[:, 2]
 
-    return row
+    return out_gdf
 
-def gdf_to_las(gdf, z_offset_m):
+def las_header(gdf):
 
     header = laspy.LasHeader(point_format=2, version="1.4") # cf. https://laspy.readthedocs.io/en/latest/intro.html
     header.offsets = [gdf.x.min(), gdf.y.min(), gdf.z.min()]
     header.scales = np.array([1.0, 1.0, 1.0])
     if "group_id" in gdf.columns.tolist():
         header.add_extra_dim(laspy.ExtraBytesParams(name="group_id", type=np.int32))
-    if "TP_charge" in gdf.columns.tolist():
+    if "TP_charge_num" in gdf.columns.tolist():
         header.add_extra_dim(laspy.ExtraBytesParams(name="TP_charge", type=float))
-    if "FP_charge" in gdf.columns.tolist():
+    if "FP_charge_num" in gdf.columns.tolist():
         header.add_extra_dim(laspy.ExtraBytesParams(name="FP_charge", type=float))
-    if "FN_charge" in gdf.columns.tolist():
+    if "FN_charge_num" in gdf.columns.tolist():
         header.add_extra_dim(laspy.ExtraBytesParams(name="FN_charge", type=float))
-    
 
-    las = laspy.LasData(header)
+    return header
+
+def las_points(gdf, header, z_offset_m):
+    """
+        Returns the point record of the rows of gdf (ex.: a chunk), according to header (cf. las_header()).
+    """
+
+    points = laspy.ScaleAwarePointRecord.zeros(len(gdf), header=header)
 
-    las.x = gdf.x
-    las.y = gdf.y
-    las.z = gdf.z + z_offset_m
+    points.x = gdf.x.values
+    points.y = gdf.y.values
+    points.z = gdf.z.values + z_offset_m
     if "group_id" in gdf.columns.tolist():
-        las.group_id = gdf.group_id.fillna(-1).astype(np.int32)
-
-    if "TP_charge" in gdf.columns.tolist():
-        las.TP_charge = gdf.TP_charge.fillna(-1).map(Fraction).astype(float)
-    if "FP_charge" in gdf.columns.tolist():
-        las.FP_charge = gdf.FP_charge.fillna(-1).map(Fraction).astype(float)
-    if "FN_charge" in gdf.columns.tolist():
-        las.FN_charge = gdf.FN_charge.fillna(-1).map(Fraction).astype(float)
-    
-    las.red = gdf.r
-    las.green = gdf.g
-    las.blue = gdf.b
+        points.group_id = gdf.group_id.fillna(-1).astype(np.int32).values
 
-    las.classification = [LAS_CLASS]*len(gdf)
+    if "TP_charge_num" in gdf.columns.tolist():
+        points.TP_charge = (gdf.TP_charge_num / gdf.charge_den).fillna(-1).values
+    if "FP_charge_num" in gdf.columns.tolist():
+        points.FP_charge = (gdf.FP_charge_num / gdf.charge_den).fillna(-1).values
+    if "FN_charge_num" in gdf.columns.tolist():
+        points.FN_charge = (gdf.FN_charge_num / gdf.charge_den).fillna(-1).values
     
-    return las
+    points.red = gdf.r.values
+    points.green = gdf.g.values
+    points.blue = gdf.b.values
+
+    points.classification = np.full(len(gdf), LAS_CLASS, dtype=np.uint8)
+
+    return points
+
+def write_las(gdf, out_file, z_offset_m, chunk_size=1_000_000, tile_points=None):
+    """
+        Writes gdf to a LAS file, chunk by chunk (chunk_size points at most), hence the whole point record is never held in memory. 
+        Points are compressed if out_file has the .laz extension, which requires a LAZ backend (ex.: pip install lazrs).
+        - tile_points = (optional) if set, points are indexed by runs of tile_points consecutive points ("tiles"), which are spatially compact 
+          if points are sorted along a space-filling curve (cf. sort_points()); returns the list of tiles: first point, number of points and 
+          bounds (minx, miny, minz, maxx, maxy, maxz, as stored in the LAS file) 
+    """
+
+    compress = os.path.splitext(out_file)[1].lower() == '.laz'
+    if compress and len(laspy.LazBackend.detect_available()) == 0:
+        raise ImportError("Writing LAZ files requires a LAZ backend (pip install lazrs).")
+
+    # chunks are made of whole tiles
+    if tile_points is not None:
+        chunk_size = tile_points * max(1, chunk_size // tile_points)
+
+    tiles = []
+    header = las_header(gdf)
+    with laspy.open(out_file, mode='w', header=header, do_compress=compress) as writer:
+        for start in range(0, len(gdf), chunk_size):
+            points = las_points(gdf.iloc[start:start + chunk_size], header, z_offset_m)
+            writer.write_points(points)
+            if tile_points is None:
+                continue
+            for tile_start in range(0, len(points), tile_points):
+                x, y, z = [np.asarray(points[dim][tile_start:tile_start + tile_points]) for dim in ['x', 'y', 'z']]
+                tiles.append(dict(
+                    first_point=start + tile_start, 
+                    n_points=len(x), 
+                    bounds=[float(x.min()), float(y.min()), float(z.min()), float(x.max()), float(y.max()), float(z.max())]
+                ))
+
+    return tiles if tile_points is not None else None
+
+def sort_points(gdf, curve='hilbert'):
+    """
+        Sorts points along a space-filling curve ('morton' or 'hilbert'), so that neighbouring points are stored close to each other.
+    """
+
+    return gdf.iloc[curve_order(gdf.x.values, gdf.y.values, curve=curve)]
+
+def write_tile_index(tiles, las_file, index_file, sort=None):
+    """
+        Writes the tiles output by write_las() to a JSON sidecar file, cf. read_las_bbox().
+    """
+
+    with open(index_file, 'w') as fp:
+        json.dump(dict(
+            las_file=os.path.basename(las_file), 
+            sort=sort, 
+            n_points=int(sum([tile['n_points'] for tile in tiles])), 
+            tiles=tiles
+        ), fp, indent=1)
+
+def read_las_bbox(las_file, bbox, index_file=None):
+    """
+        Reads the points of a LAS/LAZ file lying within bbox = (minx, miny, maxx, maxy). If a tile index is provided (cf. write_tile_index()), 
+        only the tiles intersecting bbox are read; the whole file is scanned otherwise.
+        Returns a LasData.
+    """
+
+    minx, miny, maxx, maxy = bbox
+
+    with laspy.open(las_file) as reader:
+
+        if index_file is not None:
+            with open(index_file) as fp:
+                tiles = json.load(fp)['tiles']
+            ranges = [
+                (tile['first_point'], tile['n_points']) for tile in tiles 
+                if tile['bounds'][0] <= maxx and tile['bounds'][3] >= minx and tile['bounds'][1] <= maxy and tile['bounds'][4] >= miny
+            ]
+        else:
+            ranges = [(0, reader.header.point_count)]
+
+        records = []
+        for first_point, n_points in ranges:
+            reader.seek(first_point)
+            points = reader.read_points(n_points)
+            x, y = np.asarray(points.x), np.asarray(points.y)
+            records.append(points.array[(x >= minx) & (x <= maxx) & (y >= miny) & (y <= maxy)])
+
+        header = reader.header
+
+    points = laspy.ScaleAwarePointRecord(
+        np.concatenate(records) if len(records) > 0 else np.zeros(0, dtype=header.point_format.dtype()), 
+        header.point_format, header.scales, header.offsets
+    )
+
+    return laspy.LasData(header, points=points)
 
 if __name__ == "__main__":
 
     tic = time.time()
     logger.info("Starting...")
     
-    parser = argparse.ArgumentParser(description="An opinionated script turning GIS files (SHP, GPKG, ...) into LAS.")
+    parser = argparse.ArgumentParser(description="An opinionated script turning GIS files (SHP, GPKG, GeoParquet, Arrow IPC, ...) into LAS.")
     parser.add_argument('--input-file', dest='in_file', type=str, help='input file')
     parser.add_argument('--output-folder', dest='out_folder', type=str, help='output folder')
+    parser.add_argument('--z-provider', dest='z_provider', type=str, default='remote', choices=list(ELEVATION_PROVIDERS.keys()), help='where elevations come from: remote DEM service (default), local DEM raster (--dem-file), constant (--z-value) or attribute (--z-column)')
+    parser.add_argument('--z-url', dest='z_url', type=str, default=GENEVA_DEM_URL, help='URL template of the remote DEM service ({x} and {y} placeholders), for the remote provider (default: DEM of the Canton of Geneva)')
+    parser.add_argument('--z-workers', dest='z_workers', type=int, default=4, help='number of concurrent requests, for the remote provider (default: 4)')
+    parser.add_argument('--z-rate-limit', dest='z_rate_limit', type=float, default=10, help='max number of requests per second, for the remote provider (default: 10)')
+    parser.add_argument('--z-cache-file', dest='z_cache_file', type=str, default=None, help='SQLite file caching elevations across runs, for the remote provider (default: z_cache.sqlite, in the output folder)')
+    parser.add_argument('--dem-file', dest='dem_file', type=str, default=None, help='DEM raster (ex.: GeoTIFF), for the dem provider')
+    parser.add_argument('--z-value', dest='z_value', type=float, default=None, help='elevation of every point, for the constant provider')
+    parser.add_argument('--z-column', dest='z_column', type=str, default=None, help='attribute holding elevations, for the column provider')
+    parser.add_argument('--laz', dest='laz', action='store_true', help='writes a compressed LAZ file instead of a LAS file (requires a LAZ backend, ex.: pip install lazrs)')
+    parser.add_argument('--sort', dest='sort', type=str, default=None, choices=CURVES, help='sorts points along a space-filling curve and writes a tile index next to the output file (<output file>.index.json)')
+    parser.add_argument('--tile-points', dest='tile_points', type=int, default=10000, help='number of consecutive points per tile of the index, if --sort is set (default: 10000)')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=1000000, help='number of points written at once (default: 1000000)')
+    parser.add_argument('--report-file', dest='report_file', type=str, default=None, help='JSON file the run report (per stage timings, memory and throughput) is written to')
+    parser.add_argument('--profiler', dest='profiler', type=str, default=None, choices=PROFILERS, help='profiles the run; the profile is written next to the report file')
+    parser.add_argument('--trace-memory', dest='trace_memory', action='store_true', help='traces the memory allocated by each stage (slower)')
     
     args = parser.parse_args()
     in_file = args.in_file
@@ -123,37 +251,72 @@ if __name__ == "__main__":
     in_filename, _ = os.path.splitext(in_basename)
     out_folder = args.out_folder
 
-    if any([x is None for x in [in_file, out_folder]]):
+    z_options = {
+        'remote': {
+            'url': args.z_url, 
+            'max_workers': args.z_workers, 
+            'rate_limit': args.z_rate_limit, 
+            'cache_file': args.z_cache_file or os.path.join(out_folder or '', 'z_cache.sqlite')
+        },
+        'dem': {'dem_file': args.dem_file},
+        'constant': {'z': args.z_value},
+        'column': {'column': args.z_column},
+    }[args.z_provider]
+
+    if any([x is None for x in [in_file, out_folder] + list(z_options.values())]):
         logger.critical("Invalid arguments. Exiting.")
         sys.exit(1)
     
-    logger.info("> Loading input file...")
-    gdf = file_loader(args.in_file)
-    gdf['geometry'] = gdf.geometry.centroid
-    logger.info("< ...done.")
-
-    logger.info("> Replacing geometries by centroids...")
-    gdf['geometry'] = gdf.geometry.centroid
-    logger.info("< ...done.")
-
-    logger.info("> Computing RGB values...")
-    gdf = gdf.apply(add_rgb, axis=1)
-    logger.info("< ...done.")
-
-    logger.info("> Fetching z coordinates from remote DEM...")
-    gdf_with_z = gdf.progress_apply(add_z, axis=1)
-    logger.info("< ...done.")
-
-    logger.info("> Generating LAS...")
-    las = gdf_to_las(gdf_with_z, z_offset_m=1)
-    out_filename = f"{in_filename}.las"
-    out_file = os.path.join(out_folder, out_filename)
-    las.write(out_file)
-    logger.info("< ...done.")
+    with instrumented_run('gis_to_las', report_file=args.report_file, profiler=args.profiler, trace_memory=args.trace_memory, in_file=os.path.abspath(in_file)):
+        logger.info("> Loading input file...")
+        begin("Loading input file")
+        gdf = file_loader(args.in_file)
+        gdf['geometry'] = gdf.geometry.centroid
+        end(rows=len(gdf))
+        logger.info("< ...done.")
+
+        logger.info("> Replacing geometries by centroids...")
+        begin("Replacing geometries by centroids")
+        gdf['geometry'] = gdf.geometry.centroid
+        end(rows=len(gdf))
+        logger.info("< ...done.")
+
+        logger.info("> Computing RGB values...")
+        begin("Computing RGB values")
+        gdf = add_rgb(gdf)
+        end(rows=len(gdf))
+        logger.info("< ...done.")
+
+        logger.info(f"> Fetching z coordinates ({args.z_provider} provider)...")
+        begin("Fetching z coordinates")
+        gdf_with_z = add_z(gdf, provider=args.z_provider, **z_options)
+        # points having no elevation (ex.: outside of the DEM) cannot be written to LAS
+        n_missing = gdf_with_z.z.isna().sum()
+        if n_missing > 0:
+            logger.warning(f"{n_missing} point(s) having no elevation are skipped.")
+            gdf_with_z = gdf_with_z[gdf_with_z.z.notna()]
+        end(rows=len(gdf))
+        logger.info("< ...done.")
+
+        logger.info("> Generating LAS...")
+        begin("Generating LAS")
+        out_filename = f"{in_filename}.laz" if args.laz else f"{in_filename}.las"
+        out_file = os.path.join(out_folder, out_filename)
+        if args.sort is not None:
+            gdf_with_z = sort_points(gdf_with_z, curve=args.sort)
+        tiles = write_las(gdf_with_z, out_file, z_offset_m=1, chunk_size=args.chunk_size, tile_points=args.tile_points if args.sort is not None else None)
+        out_files = [out_file]
+        if args.sort is not None:
+            index_file = f"{out_file}.index.json"
+            write_tile_index(tiles, out_file, index_file, sort=args.sort)
+            out_files.append(index_file)
+        end(rows=len(gdf_with_z))
+        logger.info("< ...done.")
     
     
-    print("The following file was written:")
-    print(out_file)
+    print("The following file(s) were written:")
+    for x in out_files:
+        print(x)
 
     print()
     print("*** Please execute the following command if you also want to generate files compatible with Potree. ***")
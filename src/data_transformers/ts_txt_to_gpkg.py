@@ -1,48 +1,26 @@
 import os, sys
 import time
+import glob
+import json
 import argparse
+import shapely
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 
-from shapely.geometry import Point
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from logzero import logger
 
-def file_loader(full_path):
-
-    COL_NAMES = [
-        'Group id',
-        'Point count',
-        'Average easting',
-        'Average northing',
-        'Average z',
-        'Ground z at average xy',
-        'Trunk easting',
-        'Trunk northing',
-        'Trunk ground z',
-        'Trunk diameter',
-        'Canopy width',
-        'Biggest distance',
-        'Smallest distance',
-        'Length',
-        'Width',
-        'Height'
-    ]
-
-    SEPARATOR = ','
-
-    df = pd.read_csv(full_path, sep=SEPARATOR, names=COL_NAMES)
-
-    return df
-
-def gen_geometry(row, x_col_name, y_col_name):
-
-    x, y = row[x_col_name], row[y_col_name]
-    row['geometry'] = Point(x,y)
-    
-    return row
-
+# the following lines allow us to import modules from within this file's parent folder
+from inspect import getsourcefile
+current_path = os.path.abspath(getsourcefile(lambda:0))
+current_dir = os.path.dirname(current_path)
+parent_dir = current_dir[:current_dir.rfind(os.path.sep)]
+sys.path.insert(0, parent_dir)
+from lib.instrumentation import PROFILERS, instrumented_run, begin, end
+from lib.misc import GdfWriter, read_gdf
 
-header = [
+COL_NAMES = [
     'Group id',
     'Point count',
     'Average easting',
@@ -61,49 +39,233 @@ header = [
     'Height'
 ]
 
+# explicit dtypes spare pandas the inference of column types, chunk by chunk
+COL_DTYPES = {col: np.int64 if col in ['Group id', 'Point count'] else np.float64 for col in COL_NAMES}
+
+SEPARATOR = ','
+
+def file_loader(full_path, chunk_size=None):
+    """
+        Returns a DataFrame holding the whole file, or an iterator over DataFrames holding chunk_size rows at most, if chunk_size is set.
+    """
+
+    return pd.read_csv(full_path, sep=SEPARATOR, names=COL_NAMES, dtype=COL_DTYPES, chunksize=chunk_size)
+
+def gen_geometries(df, epsg):
+    """
+        Returns two GeoDataFrames holding the attributes of df, the geometries of which are the average xy and the trunk xy, respectively.
+    """
+
+    # both geometries are built at once, out of a (n rows, 2 geometries, xy) array
+    coords = df[['Average easting', 'Average northing', 'Trunk easting', 'Trunk northing']].to_numpy(dtype=float).reshape(-1, 2, 2)
+    points = shapely.points(coords)
+
+    average_xy_gdf = gpd.GeoDataFrame(df, geometry=points[:, 0], crs=f"EPSG:{epsg}")
+    trunk_xy_gdf = gpd.GeoDataFrame(df, geometry=points[:, 1], crs=f"EPSG:{epsg}")
+
+    return average_xy_gdf, trunk_xy_gdf
+
+
+def convert_file(in_file, out_folder, epsg='2056', chunk_size=100000):
+    """
+        Turns a TerraScan TXT file into two GeoPackage files, the geometries of which are the average xy and the trunk xy, respectively. 
+        The input file is read once, chunk by chunk (chunk_size rows at most), both output files being written as chunks are read, 
+        hence the memory footprint does not depend on the size of the input file.
+        Returns a dict: in_file, out_files (paths of the written files), rows, wall_time_s
+    """
+
+    tic = time.time()
+
+    basename = os.path.basename(in_file)
+    filename, _ = os.path.splitext(basename)
+
+    average_xy_filename = f"{filename}_average_xy.gpkg"
+    trunk_xy_filename = f"{filename}_trunk_xy.gpkg"
+
+    average_xy_file_fullpath = os.path.join(out_folder, average_xy_filename)
+    trunk_xy_file_fullpath = os.path.join(out_folder, trunk_xy_filename)
+
+    logger.info(f"> Converting {basename} to GPKG, chunk by chunk...")
+    begin("Converting input file to GPKG")
+    n_rows = 0
+    with GdfWriter(average_xy_file_fullpath) as average_xy_writer, GdfWriter(trunk_xy_file_fullpath) as trunk_xy_writer:
+        for df in file_loader(in_file, chunk_size=chunk_size):
+            average_xy_gdf, trunk_xy_gdf = gen_geometries(df, epsg)
+            average_xy_writer.write(average_xy_gdf)
+            trunk_xy_writer.write(trunk_xy_gdf)
+            n_rows += len(df)
+    end(rows=n_rows)
+    logger.info(f"< ...done: {n_rows} rows converted.")
+
+    return dict(in_file=in_file, out_files=[average_xy_file_fullpath, trunk_xy_file_fullpath], rows=n_rows, wall_time_s=time.time() - tic)
+
+
+def convert(in_file, out_folder, epsg='2056', chunk_size=100000):
+    """
+        Same as convert_file(), returning the paths of the written files only.
+    """
+
+    return convert_file(in_file, out_folder, epsg=epsg, chunk_size=chunk_size)['out_files']
+
+
+def list_input_files(patterns):
+    """
+        Returns the (sorted) list of the files matching patterns, each pattern being either a file, a glob pattern (ex.: tiles/*.txt)
+        or a folder, in which case the .txt files of the folder are listed.
+    """
+
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            files += glob.glob(os.path.join(pattern, '*.txt'))
+        else:
+            files += glob.glob(pattern)
+
+    return sorted(set([os.path.abspath(f) for f in files]))
+
+
+MANIFEST_FILENAME = 'ts_txt_to_gpkg_manifest.json'
+
+def file_signature(in_file, epsg):
+
+    stat = os.stat(in_file)
+
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, epsg=str(epsg))
+
+
+def load_manifest(path):
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def write_manifest(manifest, path):
+
+    # the manifest is replaced atomically, so that an interrupted run does not leave it corrupted
+    with open(f"{path}.tmp", 'w') as fp:
+        json.dump(manifest, fp, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def is_up_to_date(manifest, in_file, epsg):
+    """
+        Whether in_file has already been converted (same size, modification time and EPSG) and its outputs still exist.
+    """
+
+    entry = manifest.get(in_file)
+
+    return entry is not None and entry['signature'] == file_signature(in_file, epsg) and all([os.path.exists(f) for f in entry['out_files']])
+
+
+def convert_files(in_files, out_folder, epsg='2056', chunk_size=100000, max_workers=1, force=False):
+    """
+        Converts several TerraScan TXT files (cf. convert_file()), in a pool of max_workers processes. A manifest (MANIFEST_FILENAME, 
+        in out_folder) records the signature (size, modification time, EPSG), row count and timing of each converted file: files which 
+        have not changed since they were converted are skipped, unless force is True.
+        Returns the manifest entries of in_files.
+    """
+
+    # outputs are named after input files
+    basenames = [os.path.splitext(os.path.basename(f))[0] for f in in_files]
+    duplicates = sorted(set([b for b in basenames if basenames.count(b) > 1]))
+    if len(duplicates) > 0:
+        raise ValueError(f"Input files sharing the same name would be converted to the same output files: {duplicates}")
+
+    manifest_file = os.path.join(out_folder, MANIFEST_FILENAME)
+    manifest = load_manifest(manifest_file)
+
+    todo = [f for f in in_files if force or not is_up_to_date(manifest, f, epsg)]
+    logger.info(f"{len(in_files) - len(todo)} file(s) out of {len(in_files)} are up to date, {len(todo)} to be converted.")
+
+    def record(result):
+        manifest[result['in_file']] = dict(
+            signature=file_signature(result['in_file'], epsg), 
+            out_files=[os.path.abspath(f) for f in result['out_files']], 
+            rows=result['rows'], 
+            wall_time_s=result['wall_time_s']
+        )
+        write_manifest(manifest, manifest_file)
+
+    if max_workers <= 1 or len(todo) <= 1:
+        for in_file in todo:
+            record(convert_file(in_file, out_folder, epsg=epsg, chunk_size=chunk_size))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(convert_file, in_file, out_folder, epsg, chunk_size) for in_file in todo]
+            for future in as_completed(futures):
+                record(future.result())
+
+    return [manifest[f] for f in in_files]
+
+
+def merge_outputs(entries, in_files, out_folder, name):
+    """
+        Merges the outputs of several files (cf. convert_files()) into one GeoPackage file per geometry type (<name>_average_xy.gpkg,
+        <name>_trunk_xy.gpkg), with a 'source_file' column holding the name of the input file of each row. Returns the paths of the merged files.
+    """
+
+    out_files = []
+    for i, suffix in enumerate(['average_xy', 'trunk_xy']):
+        out_file = os.path.join(out_folder, f"{name}_{suffix}.gpkg")
+        with GdfWriter(out_file) as writer:
+            for entry, in_file in zip(entries, in_files):
+                gdf = read_gdf(entry['out_files'][i])
+                gdf['source_file'] = os.path.basename(in_file)
+                writer.write(gdf)
+        out_files.append(out_file)
+
+    return out_files
+
+
 if __name__ == "__main__":
 
     tic = time.time()
     logger.info("Starting...")
     
     parser = argparse.ArgumentParser(description="This script turns TerraScan TXT output files into GeoPackage files.")
-    parser.add_argument('--input-file', dest='in_file', type=str, help='input file')
+    parser.add_argument('--input-file', dest='in_files', type=str, nargs='+', help='input file(s): files, glob patterns (ex.: "tiles/*.txt") or folders (the .txt files of which are converted)')
     parser.add_argument('--output-folder', dest='out_folder', type=str, help='output folder')
     parser.add_argument('--epsg', dest='epsg', type=str, help='EPSG (ex.: 2056)')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=100000, help='number of rows read and converted at once (default: 100000)')
+    parser.add_argument('--workers', dest='workers', type=int, default=1, help='number of files converted concurrently, by as many processes (default: 1)')
+    parser.add_argument('--merge', dest='merge', type=str, default=None, help='(optional) name of the files merging the outputs of all the input files, one per geometry type (<name>_average_xy.gpkg, <name>_trunk_xy.gpkg)')
+    parser.add_argument('--force', dest='force', action='store_true', help='converts every input file, including the ones which have not changed since they were converted (cf. manifest)')
+    parser.add_argument('--report-file', dest='report_file', type=str, default=None, help='JSON file the run report (per stage timings, memory and throughput) is written to')
+    parser.add_argument('--profiler', dest='profiler', type=str, default=None, choices=PROFILERS, help='profiles the run; the profile is written next to the report file')
+    parser.add_argument('--trace-memory', dest='trace_memory', action='store_true', help='traces the memory allocated by each stage (slower)')
 
     args = parser.parse_args()
     epsg = args.epsg if args.epsg is not None else '2056'
-    in_file = args.in_file
     out_folder = args.out_folder
 
-    if any([x is None for x in [in_file, out_folder]]):
+    if any([x is None for x in [args.in_files, out_folder]]):
         logger.critical("Invalid arguments. Exiting.")
         sys.exit(1)
-    
-    logger.info("> Loading input file...")
-    df = file_loader(args.in_file)
-    logger.info("< ...done.")
-
-    logger.info("> Generating geometries...")
-    average_xy_gdf = gpd.GeoDataFrame(df.apply(lambda row: gen_geometry(row, 'Average easting', 'Average northing'), axis=1))
-    average_xy_gdf = average_xy_gdf.set_crs(epsg=epsg)
 
-    trunk_xy_gdf =  gpd.GeoDataFrame(df.apply(lambda row: gen_geometry(row, 'Trunk easting', 'Trunk northing'), axis=1))
-    trunk_xy_gdf =  trunk_xy_gdf.set_crs(epsg=epsg)
-    logger.info("< ...done.")
+    in_files = list_input_files(args.in_files)
+    if len(in_files) == 0:
+        logger.critical("No input file found. Exiting.")
+        sys.exit(1)
+    
+    with instrumented_run('ts_txt_to_gpkg', report_file=args.report_file, profiler=args.profiler, trace_memory=args.trace_memory, in_files=in_files):
+        begin("Converting input files")
+        entries = convert_files(in_files, out_folder, epsg=epsg, chunk_size=args.chunk_size, max_workers=args.workers, force=args.force)
+        end(rows=sum([entry['rows'] for entry in entries]))
+        out_files = [f for entry in entries for f in entry['out_files']] + [os.path.join(out_folder, MANIFEST_FILENAME)]
 
-    basename = os.path.basename(in_file)
-    filename, _ = os.path.splitext(basename)
+        if args.merge is not None:
+            logger.info("> Merging outputs...")
+            begin("Merging outputs")
+            out_files += merge_outputs(entries, in_files, out_folder, args.merge)
+            end(rows=sum([entry['rows'] for entry in entries]))
+            logger.info("< ...done.")
 
-    average_xy_filename = f"{filename}_average_xy.gpkg"
-    trunk_xy_filename = f"{filename}_trunk_xy.gpkg"
-
-    average_xy_file_fullpath = os.path.join(out_folder, average_xy_filename)
-    trunk_xy_file_fullpath = os.path.join(out_folder, trunk_xy_filename)
+    logger.info("The following files were written:")
+    for x in out_files:
+        print(x)
 
-    logger.info("> Exporting to GPKG...")
-    average_xy_gdf.to_file(average_xy_file_fullpath, driver='GPKG')
-    trunk_xy_gdf.to_file(trunk_xy_file_fullpath, driver='GPKG')
-    logger.info("< ...done. The following files were written:")
-    for x in [average_xy_file_fullpath, trunk_xy_file_fullpath]:
-        print(x)
\ No newline at end of file
+    toc = time.time()
+    logger.info(f"...done in {toc-tic:.2f} seconds.")
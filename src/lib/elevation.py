@@ -0,0 +1,259 @@
+import time
+import sqlite3
+import threading
+import requests
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from logzero import logger
+from pyproj import CRS
+from requests.adapters import HTTPAdapter
+from tqdm.auto import tqdm
+from urllib3.util.retry import Retry
+
+
+GENEVA_DEM_URL = "https://ge.ch/sitgags2/rest/services/RASTER/MNA_TERRAIN/ImageServer/getSamples?geometry={x},{y}&geometryType=esriGeometryPoint&sampleDistance=&sampleCount=&mosaicRule=&pixelSize=&returnFirstValueOnly=true&f=json"
+
+
+class RateLimiter:
+    """
+        Spaces out the calls to wait() made by any number of threads, so that no more than rate calls per second happen (no limit if rate is None).
+    """
+
+    def __init__(self, rate=None):
+
+        self.interval = 0. if rate is None else 1. / rate
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+
+        with self.lock:
+            now = time.monotonic()
+            call = max(now, self.next_call)
+            self.next_call = call + self.interval
+
+        if call > now:
+            time.sleep(call - now)
+
+
+class ElevationCache:
+    """
+        Persistent cache of elevations (SQLite file), keyed by the URL template of the service and by coordinates snapped to a grid.
+        Only the thread which has opened the cache may use it.
+    """
+
+    def __init__(self, path):
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS elevation (url TEXT, ix INTEGER, iy INTEGER, z REAL, PRIMARY KEY (url, ix, iy))")
+        self.conn.commit()
+
+    def get(self, url, keys):
+        """
+            Returns a dict: (ix, iy) -> z, for the cached keys.
+        """
+
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (ix INTEGER, iy INTEGER)")
+        self.conn.execute("DELETE FROM wanted")
+        self.conn.executemany("INSERT INTO wanted VALUES (?, ?)", [(int(ix), int(iy)) for ix, iy in keys])
+        rows = self.conn.execute(
+            "SELECT e.ix, e.iy, e.z FROM wanted w JOIN elevation e ON e.url = ? AND e.ix = w.ix AND e.iy = w.iy", (url, )
+        )
+
+        return {(ix, iy): z for ix, iy, z in rows}
+
+    def put(self, url, items):
+        """
+            - items = list of ((ix, iy), z)
+        """
+
+        self.conn.executemany("INSERT OR REPLACE INTO elevation VALUES (?, ?, ?, ?)", [(url, int(ix), int(iy), z) for (ix, iy), z in items])
+        self.conn.commit()
+
+    def close(self):
+
+        self.conn.close()
+
+
+class ElevationClient:
+    """
+        Fetches elevations from an ArcGIS ImageServer (getSamples operation), one point per request, through pooled connections:
+        - url = template of the request URL, with {x} and {y} placeholders
+        - max_workers = number of concurrent requests
+        - rate_limit = (optional) max number of requests per second, shared by all the workers
+        - retries = number of retries of failed requests (connection errors, HTTP 429 and 5xx responses), with exponential backoff
+        - cache_file = (optional) SQLite file caching elevations across runs, keyed by coordinates snapped to a resolution (m) grid;
+          points are sampled at the snapped coordinates, so that points sharing a grid cell cost a single request
+    """
+
+    def __init__(self, url=GENEVA_DEM_URL, max_workers=4, rate_limit=10, retries=3, timeout=30, cache_file=None, resolution=0.01):
+
+        self.url = url
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.resolution = resolution
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.cache = ElevationCache(cache_file) if cache_file is not None else None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, 
+            pool_maxsize=max_workers, 
+            max_retries=Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # number of requests sent by this client
+        self.n_requests = 0
+
+    def get_z(self, x, y):
+
+        self.rate_limiter.wait()
+        res = self.session.get(self.url.format(x=x, y=y), timeout=self.timeout)
+        res.raise_for_status()
+        data = res.json()
+
+        return float(data['samples'][0]['value'])
+
+    def fetch(self, x, y):
+        """
+            Returns the elevation of each point (x, y = coordinate arrays, in the CRS the service expects).
+        """
+
+        keys = np.column_stack([np.round(np.asarray(x) / self.resolution), np.round(np.asarray(y) / self.resolution)]).astype(np.int64)
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        unique_keys = [tuple(key) for key in unique_keys.tolist()]
+
+        known = self.cache.get(self.url, unique_keys) if self.cache is not None else {}
+        missing = [key for key in unique_keys if key not in known]
+        logger.info(f"{len(unique_keys) - len(missing)} elevation(s) out of {len(unique_keys)} found in cache, {len(missing)} to be fetched.")
+
+        fetched = []
+        n_cached = 0
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = {
+                executor.submit(self.get_z, ix * self.resolution, iy * self.resolution): (ix, iy) for ix, iy in missing
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                self.n_requests += 1
+                fetched.append((futures[future], future.result()))
+                # fetched elevations are persisted as they come, so that an interrupted run does not have to fetch them again
+                if self.cache is not None and len(fetched) - n_cached >= 1000:
+                    self.cache.put(self.url, fetched[n_cached:])
+                    n_cached = len(fetched)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            if self.cache is not None and len(fetched) > n_cached:
+                self.cache.put(self.url, fetched[n_cached:])
+        known.update(dict(fetched))
+
+        return np.array([known[key] for key in unique_keys], dtype=float)[inverse.ravel()]
+
+    def close(self):
+
+        self.session.close()
+        if self.cache is not None:
+            self.cache.close()
+
+
+def remote_z(gdf, url=GENEVA_DEM_URL, max_workers=4, rate_limit=10, cache_file=None, resolution=0.01):
+    """
+        Fetches the elevation of each point from a remote service, cf. ElevationClient; coordinates are expressed in the CRS of gdf.
+    """
+
+    client = ElevationClient(url=url, max_workers=max_workers, rate_limit=rate_limit, cache_file=cache_file, resolution=resolution)
+    try:
+        z = client.fetch(gdf.geometry.x.values, gdf.geometry.y.values)
+    finally:
+        client.close()
+    logger.info(f"{client.n_requests} request(s) sent.")
+
+    return z
+
+
+def dem_z(gdf, dem_file, band=1, max_window_pixels=2**24):
+    """
+        Samples a local DEM raster (any format readable by rasterio, ex.: GeoTIFF) at each point (value of the pixel including the point).
+        Points are reprojected to the CRS of the DEM if needed. Pixels are read window by window, each window spanning the points of
+        a strip of rows and holding max_window_pixels at most, which bounds the memory footprint.
+        Points lying outside of the DEM or on nodata pixels get NaN.
+    """
+
+    try:
+        import rasterio
+        from rasterio.transform import rowcol
+        from rasterio.windows import Window
+    except ImportError:
+        raise ImportError("The 'dem' elevation provider requires the rasterio package (pip install rasterio).")
+
+    z = np.full(len(gdf), np.nan)
+
+    with rasterio.open(dem_file) as src:
+
+        geometry = gdf.geometry
+        if gdf.crs is not None and src.crs is not None and CRS(src.crs) != CRS(gdf.crs):
+            geometry = geometry.to_crs(src.crs)
+
+        rows, cols = rowcol(src.transform, geometry.x.values, geometry.y.values)
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        inside = np.flatnonzero((rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width))
+        if len(inside) == 0:
+            return z
+
+        col_min, col_max = cols[inside].min(), cols[inside].max()
+        row_min = rows[inside].min()
+        strip_height = max(1, max_window_pixels // (col_max - col_min + 1))
+        strips = (rows[inside] - row_min) // strip_height
+
+        for strip in np.unique(strips):
+            idx = inside[strips == strip]
+            r0, r1 = rows[idx].min(), rows[idx].max()
+            c0, c1 = cols[idx].min(), cols[idx].max()
+            window = src.read(band, window=Window(c0, r0, c1 - c0 + 1, r1 - r0 + 1)).astype(float)
+            if src.nodata is not None:
+                window[window == src.nodata] = np.nan
+            z[idx] = window[rows[idx] - r0, cols[idx] - c0]
+
+    return z
+
+
+def constant_z(gdf, z):
+
+    return np.full(len(gdf), float(z))
+
+
+def column_z(gdf, column):
+
+    return gdf[column].astype(float).values
+
+
+# provider -> function(gdf, **options) returning the elevation of each point of gdf (NaN if unknown)
+ELEVATION_PROVIDERS = {
+    'remote': remote_z,
+    'dem': dem_z,
+    'constant': constant_z,
+    'column': column_z,
+}
+
+
+def elevations(gdf, provider='remote', **options):
+    """
+        Returns the elevation of each point of gdf, according to one of ELEVATION_PROVIDERS:
+        - 'remote' = remote DEM service (options: url, max_workers, rate_limit, cache_file, resolution)
+        - 'dem' = local DEM raster (options: dem_file, band)
+        - 'constant' = the same elevation for every point (options: z)
+        - 'column' = elevations read from an attribute of gdf (options: column)
+    """
+
+    assert provider in ELEVATION_PROVIDERS.keys(), f"Unknown elevation provider: {provider}"
+
+    z = ELEVATION_PROVIDERS[provider](gdf, **options)
+
+    n_missing = int(np.isnan(z).sum())
+    if n_missing > 0:
+        logger.warning(f"{n_missing} point(s) out of {len(z)} have no elevation.")
+
+    return z
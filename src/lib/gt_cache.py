@@ -0,0 +1,145 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pyarrow
+import pyarrow.ipc
+import geopandas as gpd
+
+from logzero import logger
+from pyproj import CRS
+
+from lib.misc import read_schema
+
+
+# to be bumped whenever the layout of cache entries changes, so that stale entries are not read
+CACHE_VERSION = 2
+
+META_FILENAME = 'meta.json'
+XY_FILENAME = 'xy.npy'
+Z_FILENAME = 'z.npy'
+ATTRIBUTES_FILENAME = 'attributes.arrow'
+
+
+def file_digest(path, chunk_size=2**20):
+    """
+        SHA-256 digest of the content of a file (or of the files of a folder, ex.: ESRI File Geodatabase), read chunk by chunk.
+    """
+
+    h = hashlib.sha256()
+
+    paths = [path] if not os.path.isdir(path) else sorted(
+        [os.path.join(root, f) for root, _, files in os.walk(path) for f in files]
+    )
+    for p in paths:
+        h.update(os.path.relpath(p, path).encode())
+        with open(p, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(chunk_size), b''):
+                h.update(chunk)
+
+    return h.hexdigest()
+
+
+def gt_cache_key(files, settings, name):
+    """
+        Key of the cache entry of the GT data pre-processed by name (ex.: the script), out of files according to settings:
+        the key changes whenever the content or the CRS of any input file, or any setting changes.
+        - files = dict: role (ex.: gt_trees) -> list of input files
+        - settings = dict of the settings which pre-processing depends on (JSON serializable)
+    """
+
+    def crs(path):
+        _crs = read_schema(path)['crs']
+        return None if _crs is None else _crs.to_wkt()
+
+    key = dict(
+        version=CACHE_VERSION,
+        name=name,
+        files={role: [file_digest(f) for f in _files] for role, _files in files.items()},
+        crs={role: [crs(f) for f in _files] for role, _files in files.items()},
+        settings=settings
+    )
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def write_gt_cache(cache_dir, key, gdf):
+    """
+        Writes a cache entry (cache_dir/key folder) holding pre-processed GT points:
+        - XY_FILENAME = (n, 2) array of coordinates (NumPy format, memory-mappable), Z_FILENAME = elevations, if any
+        - ATTRIBUTES_FILENAME = attributes (ex.: keys, sector labels), along with the index (uncompressed Arrow IPC)
+        - META_FILENAME = CRS, column order, etc.
+        Only plain arrays are stored (no pickle), hence reading an entry cannot execute any code and does not depend on library versions.
+        The entry is written to a temporary folder first, then renamed, so that concurrent or interrupted runs do not leave partial entries.
+    """
+
+    entry_dir = os.path.join(cache_dir, key)
+    tmp_dir = f"{entry_dir}.tmp-{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    geometry = gdf.geometry
+    has_z = bool(geometry.has_z.any())
+    np.save(os.path.join(tmp_dir, XY_FILENAME), np.column_stack([geometry.x.values, geometry.y.values]), allow_pickle=False)
+    if has_z:
+        np.save(os.path.join(tmp_dir, Z_FILENAME), geometry.z.values, allow_pickle=False)
+
+    table = pyarrow.Table.from_pandas(gdf.drop(columns=[geometry.name]), preserve_index=True)
+    with pyarrow.OSFile(os.path.join(tmp_dir, ATTRIBUTES_FILENAME), 'wb') as sink:
+        with pyarrow.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    meta = dict(
+        version=CACHE_VERSION,
+        rows=len(gdf),
+        crs=None if gdf.crs is None else CRS(gdf.crs).to_wkt(),
+        geometry_column=geometry.name,
+        columns=gdf.columns.tolist(),
+        has_z=has_z
+    )
+    with open(os.path.join(tmp_dir, META_FILENAME), 'w') as fp:
+        json.dump(meta, fp, indent=2)
+
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # another run has written the same entry meanwhile
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return entry_dir
+
+
+def read_gt_cache(cache_dir, key):
+    """
+        Reads a cache entry (cf. write_gt_cache()).
+        Returns (GeoDataFrame, memory-mapped (n, 2) array of coordinates), or None if there is no such entry.
+        Coordinates stay memory-mapped, so that a KD-tree can be built on them without copying them (cf. cKDTree(xy));
+        attributes and geometries are decoded into memory, as GeoDataFrames require.
+    """
+
+    entry_dir = os.path.join(cache_dir, key)
+    meta_file = os.path.join(entry_dir, META_FILENAME)
+    if not os.path.exists(meta_file):
+        return None
+
+    with open(meta_file) as fp:
+        meta = json.load(fp)
+    if meta['version'] != CACHE_VERSION:
+        return None
+
+    xy = np.load(os.path.join(entry_dir, XY_FILENAME), mmap_mode='r', allow_pickle=False)
+    z = np.load(os.path.join(entry_dir, Z_FILENAME), mmap_mode='r', allow_pickle=False) if meta['has_z'] else None
+
+    with pyarrow.memory_map(os.path.join(entry_dir, ATTRIBUTES_FILENAME), 'r') as source:
+        df = pyarrow.ipc.open_file(source).read_all().to_pandas()
+
+    # points are rebuilt out of coordinates, which is much faster than decoding WKB
+    geometry = gpd.points_from_xy(xy[:, 0], xy[:, 1], z, crs=meta['crs'])
+    gdf = gpd.GeoDataFrame(df, geometry=geometry, crs=meta['crs'])
+    if meta['geometry_column'] != 'geometry':
+        gdf = gdf.rename_geometry(meta['geometry_column'])
+    gdf = gdf[meta['columns']]
+
+    logger.info(f"{meta['rows']} GT points read from cache {entry_dir}.")
+
+    return gdf, xy
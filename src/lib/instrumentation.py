@@ -0,0 +1,271 @@
+import os, sys
+import time
+import json
+import platform
+import datetime
+import tracemalloc
+
+from contextlib import contextmanager
+from logzero import logger
+from pydantic import BaseModel
+from typing import Literal, Optional
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+PROFILERS = ['cprofile', 'pyinstrument']
+PROFILE_FILE_EXTENSIONS = {'cprofile': '.prof', 'pyinstrument': '.html'}
+
+
+def max_rss_mb():
+    """
+        High-water mark of the resident set size of the current process, in MB (None if unavailable).
+    """
+
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss / 1024**2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def rss_mb():
+    """
+        Current resident set size of the current process, in MB (None if unavailable, i.e. outside of Linux).
+    """
+
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class RunReport:
+    """
+        Records the wall time, CPU time, memory and row throughput of the (possibly nested) stages of a run.
+        Stages are delimited by begin() and end() calls; memory is traced by tracemalloc if trace_memory is True.
+    """
+
+    def __init__(self, name, trace_memory=False, **metadata):
+
+        self.name = name
+        self.metadata = metadata
+        self.trace_memory = trace_memory
+        # stages are listed by beginning order; the stack holds the stages which have begun but not ended yet
+        self.stages = []
+        self.stack = []
+        self.started_at = datetime.datetime.now().isoformat(timespec='seconds')
+        self.wall_tic = time.perf_counter()
+        self.cpu_tic = time.process_time()
+
+        self.started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if self.started_tracing:
+            tracemalloc.start()
+
+    def _traced_peak(self):
+
+        if not self.trace_memory:
+            return None
+
+        # the peak of the enclosing stage accounts for the peaks of the stages it encloses, cf. end()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+
+        return peak
+
+    def begin(self, stage):
+
+        if len(self.stack) > 0 and self.trace_memory:
+            self.stack[-1]['traced_peak'] = max(self.stack[-1]['traced_peak'], self._traced_peak())
+        elif self.trace_memory:
+            tracemalloc.reset_peak()
+
+        self.stages.append(dict(stage=stage, level=len(self.stack)))
+        self.stack.append(dict(
+            record=self.stages[-1],
+            wall_tic=time.perf_counter(),
+            cpu_tic=time.process_time(),
+            rss_tic=rss_mb(),
+            traced_tic=tracemalloc.get_traced_memory()[0] if self.trace_memory else None,
+            traced_peak=0
+        ))
+
+    def end(self, rows=None):
+        """
+            - rows = (optional) number of rows (ex.: GT trees, detections) the stage has processed, which throughput is computed out of
+        """
+
+        current = self.stack.pop()
+        wall_time = time.perf_counter() - current['wall_tic']
+        rss = rss_mb()
+
+        traced_peak_delta = None
+        if self.trace_memory:
+            traced_peak = max(current['traced_peak'], self._traced_peak())
+            traced_peak_delta = (traced_peak - current['traced_tic']) / 1024**2
+            if len(self.stack) > 0:
+                self.stack[-1]['traced_peak'] = max(self.stack[-1]['traced_peak'], traced_peak)
+
+        current['record'].update(
+            wall_time_s=wall_time,
+            cpu_time_s=time.process_time() - current['cpu_tic'],
+            max_rss_mb=max_rss_mb(),
+            rss_delta_mb=None if rss is None or current['rss_tic'] is None else rss - current['rss_tic'],
+            traced_peak_delta_mb=traced_peak_delta,
+            rows=rows,
+            rows_per_s=None if rows is None or wall_time == 0 else rows / wall_time
+        )
+
+    def to_dict(self):
+
+        return dict(
+            name=self.name,
+            started_at=self.started_at,
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpu_count=os.cpu_count(),
+            wall_time_s=time.perf_counter() - self.wall_tic,
+            cpu_time_s=time.process_time() - self.cpu_tic,
+            max_rss_mb=max_rss_mb(),
+            trace_memory=self.trace_memory,
+            metadata=self.metadata,
+            stages=self.stages
+        )
+
+    def write(self, path):
+
+        with open(path, 'w') as fp:
+            json.dump(self.to_dict(), fp, indent=2, default=str)
+
+
+# the current run, if any (cf. start_run()); stages are not recorded if there is no current run report
+_current_run = None
+
+def begin(stage):
+
+    if _current_run is not None and _current_run['report'] is not None:
+        _current_run['report'].begin(stage)
+
+
+def end(rows=None):
+
+    if _current_run is not None and _current_run['report'] is not None:
+        _current_run['report'].end(rows=rows)
+
+
+def start_profiler(profiler):
+
+    if profiler == 'cprofile':
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    else:
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError("The 'pyinstrument' profiler requires the pyinstrument package (pip install pyinstrument).")
+        _profiler = Profiler()
+        _profiler.start()
+
+    return _profiler
+
+
+def stop_profiler(_profiler, profiler, profile_file):
+
+    if profiler == 'cprofile':
+        _profiler.disable()
+        # to be browsed by ex.: python -m pstats <file>, snakeviz <file>
+        _profiler.dump_stats(profile_file)
+    else:
+        _profiler.stop()
+        with open(profile_file, 'w') as fp:
+            fp.write(_profiler.output_html())
+
+
+def start_run(name, report_file=None, profiler=None, trace_memory=False, **metadata):
+    """
+        Starts recording the stages of a run (cf. begin(), end()), until stop_run() is called, which writes a JSON run report to report_file, if provided.
+        - profiler = (optional) one of PROFILERS; the run is profiled and the profile is written next to the report file
+          (<report file without extension>.prof or .html), or to <name>_profile.prof (.html) if no report file is provided
+        - trace_memory = whether the memory allocated by each stage is traced by tracemalloc, which slows the run down
+        - metadata = written as such to the report (ex.: configuration file)
+    """
+
+    global _current_run
+
+    assert profiler is None or profiler in PROFILERS, f"Unknown profiler: {profiler}"
+
+    _current_run = dict(
+        previous_run=_current_run,
+        report=RunReport(name, trace_memory=trace_memory, **metadata) if report_file is not None else None,
+        report_file=report_file,
+        profiler=profiler,
+        profile_file=None if profiler is None else (
+            (os.path.splitext(report_file)[0] if report_file is not None else f"{name}_profile") + PROFILE_FILE_EXTENSIONS[profiler]
+        )
+    )
+    _current_run['_profiler'] = start_profiler(profiler) if profiler is not None else None
+
+    return _current_run['report']
+
+
+def stop_run():
+    """
+        Stops the current run (cf. start_run()). Returns the list of the written files.
+    """
+
+    global _current_run
+
+    run = _current_run
+    _current_run = run['previous_run']
+    out_files = []
+
+    if run['_profiler'] is not None:
+        stop_profiler(run['_profiler'], run['profiler'], run['profile_file'])
+        out_files.append(run['profile_file'])
+
+    report = run['report']
+    if report is not None:
+        # stages left open (ex.: by an exception) are closed
+        while len(report.stack) > 0:
+            report.end()
+        report.write(run['report_file'])
+        if report.started_tracing:
+            tracemalloc.stop()
+        out_files.append(run['report_file'])
+
+    return out_files
+
+
+@contextmanager
+def instrumented_run(name, report_file=None, profiler=None, trace_memory=False, **metadata):
+    """
+        Same as start_run() ... stop_run(), around the enclosed code.
+    """
+
+    report = start_run(name, report_file=report_file, profiler=profiler, trace_memory=trace_memory, **metadata)
+    try:
+        yield report
+    finally:
+        for out_file in stop_run():
+            logger.info(f"The following file was written: {out_file}")
+
+
+class InstrumentationSettings(BaseModel):
+    """
+        Optional 'instrumentation' section of configuration files, cf. instrumented_run().
+    """
+
+    class Config:
+        # cf. https://pydantic-docs.helpmanual.io/usage/model_config/
+        extra = 'forbid'
+
+    report_file: Optional[str] = None
+    profiler: Optional[Literal['cprofile', 'pyinstrument']] = None
+    trace_memory: bool = False
@@ -1,11 +1,24 @@
+import os
+import json
+import warnings
 import numpy as np
 import pygeohash as pgh
 import pandas as pd
 import geopandas as gpd
-import networkx as nx
+import shapely
+import pyogrio
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import current_process, shared_memory
+from pyproj import CRS
+from shapely.geometry import box
 from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from fractions import Fraction
 
 def geohash(row):
@@ -13,6 +26,142 @@ def geohash(row):
     return out
 
 
+GEOHASH_BASE32 = np.frombuffer(b'0123456789bcdefghjkmnpqrstuvwxyz', dtype=np.uint8)
+
+def geohash_encode(lon, lat, precision=16):
+    """
+        Vectorized version of pygeohash.encode, yielding the very same strings.
+    """
+
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+
+    lon_lo, lon_hi = np.full(len(lon), -180.0), np.full(len(lon), 180.0)
+    lat_lo, lat_hi = np.full(len(lat), -90.0), np.full(len(lat), 90.0)
+
+    chars = np.zeros((len(lon), precision), dtype=np.uint8)
+    even = True
+    for i in range(precision):
+        for bit in [16, 8, 4, 2, 1]:
+            if even:
+                mid = (lon_lo + lon_hi) / 2
+                above = lon > mid
+                lon_lo = np.where(above, mid, lon_lo)
+                lon_hi = np.where(above, lon_hi, mid)
+            else:
+                mid = (lat_lo + lat_hi) / 2
+                above = lat > mid
+                lat_lo = np.where(above, mid, lat_lo)
+                lat_hi = np.where(above, lat_hi, mid)
+            chars[:, i] |= np.where(above, bit, 0).astype(np.uint8)
+            even = not even
+
+    return np.ascontiguousarray(GEOHASH_BASE32[chars]).view(f'S{precision}').ravel().astype(str).astype(object)
+
+
+def _spread_bits(v):
+
+    # 0b...abcd -> 0b...0a0b0c0d
+    v = v & np.uint64(0x00000000FFFFFFFF)
+    v = (v | (v << np.uint64(16))) & np.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << np.uint64(8))) & np.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << np.uint64(2))) & np.uint64(0x3333333333333333)
+    v = (v | (v << np.uint64(1))) & np.uint64(0x5555555555555555)
+
+    return v
+
+
+MORTON_BITS = 31 # per axis => keys fit in 62 bits, hence they can be safely cast to int64 (ex.: when writing to GPKG)
+
+def morton_encode(x, y, resolution=0.01):
+    """
+        Interleaves the bits of projected coordinates, once snapped to a grid having the given resolution (in CRS units), 
+        into a uint64 (Morton / Z-order) key. Coordinates must lie within +/- resolution * 2**30 from the CRS origin 
+        (ex.: +/- 10'737 km for a 1 cm resolution).
+    """
+
+    offset = 2**(MORTON_BITS-1)
+    qx = np.floor(np.asarray(x, dtype=float) / resolution) + offset
+    qy = np.floor(np.asarray(y, dtype=float) / resolution) + offset
+
+    if len(qx) > 0 and (min(qx.min(), qy.min()) < 0 or max(qx.max(), qy.max()) >= 2**MORTON_BITS):
+        raise ValueError(f"Coordinates are out of the range supported by Morton keys, with resolution = {resolution}.")
+
+    return _spread_bits(qx.astype(np.uint64)) | (_spread_bits(qy.astype(np.uint64)) << np.uint64(1))
+
+
+def morton_decode(key, resolution=0.01):
+    """
+        Returns the (x, y) coordinates of the lower left corner of the grid cells encoded by morton_encode.
+    """
+
+    def compact_bits(v):
+        v = v & np.uint64(0x5555555555555555)
+        v = (v | (v >> np.uint64(1))) & np.uint64(0x3333333333333333)
+        v = (v | (v >> np.uint64(2))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+        v = (v | (v >> np.uint64(4))) & np.uint64(0x00FF00FF00FF00FF)
+        v = (v | (v >> np.uint64(8))) & np.uint64(0x0000FFFF0000FFFF)
+        v = (v | (v >> np.uint64(16))) & np.uint64(0x00000000FFFFFFFF)
+        return v.astype(np.int64)
+
+    key = np.asarray(key).astype(np.uint64)
+    offset = 2**(MORTON_BITS-1)
+
+    return (compact_bits(key) - offset) * resolution, (compact_bits(key >> np.uint64(1)) - offset) * resolution
+
+
+def hilbert_encode(qx, qy, bits):
+    """
+        Returns the index of grid cells (qx, qy = integer coordinates in [0, 2**bits)) along the Hilbert curve filling the grid.
+    """
+
+    n = np.int64(2**bits)
+    x, y = np.asarray(qx, dtype=np.int64).copy(), np.asarray(qy, dtype=np.int64).copy()
+    d = np.zeros(len(x), dtype=np.int64)
+
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        # the quadrant is rotated, so that the curve is continuous
+        flip = ~ry & rx
+        x[flip], y[flip] = n - 1 - x[flip], n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s //= 2
+
+    return d
+
+
+CURVES = ['morton', 'hilbert']
+
+def curve_order(x, y, curve='hilbert', bits=16):
+    """
+        Returns the indices sorting points along a space-filling curve ('morton' or 'hilbert') covering their bounding square,
+        split into 2**bits x 2**bits cells. Points sharing a cell keep their order.
+    """
+
+    assert curve in CURVES, f"Unknown curve: {curve}"
+
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if len(x) == 0:
+        return np.array([], dtype=np.int64)
+
+    size = max(x.max() - x.min(), y.max() - y.min())
+    cell_size = size / 2**bits if size > 0 else 1.
+    qx = np.minimum(np.floor((x - x.min()) / cell_size), 2**bits - 1).astype(np.int64)
+    qy = np.minimum(np.floor((y - y.min()) / cell_size), 2**bits - 1).astype(np.int64)
+
+    if curve == 'morton':
+        keys = _spread_bits(qx.astype(np.uint64)) | (_spread_bits(qy.astype(np.uint64)) << np.uint64(1))
+    else:
+        keys = hilbert_encode(qx, qy, bits)
+
+    return np.argsort(keys, kind='stable')
+
+
 # cf. https://gis.stackexchange.com/questions/222315/geopandas-find-nearest-point-in-other-dataframe
 def ckdnearest(gdA, gdB):
 
@@ -52,6 +201,47 @@ def clip(gdf, sectors):
     return clipped_gdf
 
 
+SECTOR_OVERLAP_POLICIES = ['duplicate', 'first', 'nearest_centroid']
+
+def assign_sectors(gdf, sectors, overlap_policy='duplicate', columns=['sector']):
+    """
+        Single-pass alternative to clip(): points are labelled with the 'sector' (and, optionally, other columns) 
+        of the sectors they intersect, by means of one spatial join. Points which do not intersect any sector are dropped. 
+        Points intersecting more than one sector are handled according to overlap_policy:
+            * 'duplicate': the point is repeated, once per sector (same rows as clip(), in a different order);
+            * 'first': the point is assigned to the first sector, in the order of the sectors GeoDataFrame;
+            * 'nearest_centroid': the point is assigned to the sector whose centroid is the nearest.
+        Output rows are sorted by sector, then by input order (whereas clip() returns the points of each sector in spatial index order).
+    """
+
+    assert overlap_policy in SECTOR_OVERLAP_POLICIES, f"Unknown overlap policy: {overlap_policy}"
+
+    # the spatial index of sectors is cached by GeoPandas, hence it is built once if sectors are reused
+    pts_idx, sec_idx = sectors.sindex.query(gdf.geometry.values, predicate='intersects')
+
+    if overlap_policy != 'duplicate':
+        if overlap_policy == 'first':
+            rank = sec_idx
+        else:
+            centroids = xy(gpd.GeoDataFrame(geometry=sectors.geometry.centroid))
+            pts = xy(gdf)[pts_idx]
+            rank = np.hypot(pts[:, 0] - centroids[sec_idx, 0], pts[:, 1] - centroids[sec_idx, 1])
+        
+        # for each point, the (point, sector) pair with the lowest rank is kept
+        order = np.lexsort((rank, pts_idx))
+        _, first = np.unique(pts_idx[order], return_index=True)
+        pts_idx, sec_idx = pts_idx[order][first], sec_idx[order][first]
+
+    order = np.lexsort((pts_idx, sec_idx))
+    pts_idx, sec_idx = pts_idx[order], sec_idx[order]
+
+    out_gdf = gdf.iloc[pts_idx].copy()
+    for col in columns:
+        out_gdf[col] = sectors[col].values[sec_idx]
+
+    return out_gdf
+
+
 def legacy_tag(gt, preds, tol):
 
     assert 'geohash' in gt.columns.tolist()
@@ -81,133 +271,928 @@ def legacy_tag(gt, preds, tol):
     except AssertionError as e:
         print(f"AssertionError: {e}")
 
+    _gt['tag'] = pd.Categorical(_gt.tag, categories=['TP', 'FN'])
+    _preds['tag'] = pd.Categorical(_preds.tag, categories=['TP', 'FP'])
+
     return _gt, _preds
 
 
-def tag(gt, dets, tol_m, gt_prefix, dets_prefix):
+# file extension -> format; files having any other extension are read by GeoPandas/Fiona and written as GeoPackage
+FILE_FORMATS = {
+    '.parquet': 'GeoParquet',
+    '.geoparquet': 'GeoParquet',
+    '.arrow': 'Arrow',
+    '.feather': 'Arrow',
+    '.ipc': 'Arrow',
+}
+
+def file_format(path):
+
+    return FILE_FORMATS.get(os.path.splitext(path)[1].lower(), 'GPKG')
+
+
+# number of rows decoded at once by read_gdf(), when GeoParquet and Arrow IPC files are filtered by a bbox
+READ_BATCH_SIZE = 65536
+
+def _read_columnar_bbox(path, fmt, columns, bbox, fid_as_index):
     """
-        - tol_m = tolerance in meters
+        Reads the features of a GeoParquet or Arrow IPC file intersecting bbox, batch by batch (READ_BATCH_SIZE rows at most): 
+        each batch is decoded, then filtered, hence the memory footprint depends on the number of matching features, not on the size of the file.
     """
 
-    ### --- helper functions --- ###
-    def make_groups():
+    schema = read_schema(path)
+    geometry_column = schema['geometry_column']
+    bbox_geometry = box(*bbox)
+
+    if fmt == 'GeoParquet':
+        parquet_file = pyarrow.parquet.ParquetFile(path)
+        arrow_schema = parquet_file.schema_arrow
+    else:
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r'))
+        arrow_schema = reader.schema
+
+    # same column order as gpd.read_parquet() (requested order) and gpd.read_feather() (file order)
+    if columns is None:
+        columns = arrow_schema.names
+    elif fmt == 'Arrow':
+        columns = [col for col in arrow_schema.names if col in columns]
+    arrow_schema = pyarrow.schema([arrow_schema.field(col) for col in columns], metadata=arrow_schema.metadata)
+
+    if fmt == 'GeoParquet':
+        batches = parquet_file.iter_batches(batch_size=READ_BATCH_SIZE, columns=columns)
+    else:
+        batches = (
+            batch.slice(start, READ_BATCH_SIZE).select(columns)
+            for batch in (reader.get_batch(i) for i in range(reader.num_record_batches))
+            for start in range(0, max(batch.num_rows, 1), READ_BATCH_SIZE)
+        )
+
+    kept_batches, kept_geometries, kept_rows = [], [], []
+    offset = 0
+    for batch in batches:
+        geometries = shapely.from_wkb(batch.column(geometry_column).to_numpy(zero_copy_only=False))
+        mask = shapely.intersects(geometries, bbox_geometry)
+        kept_batches.append(batch.filter(pyarrow.array(mask)))
+        kept_geometries.append(geometries[mask])
+        kept_rows.append(offset + np.flatnonzero(mask))
+        offset += batch.num_rows
+
+    df = pyarrow.Table.from_batches(kept_batches, schema=arrow_schema).to_pandas()
+    # the geometry column keeps its position
+    df[geometry_column] = gpd.GeoSeries(np.concatenate(kept_geometries) if len(kept_geometries) > 0 else [], index=df.index)
+    gdf = gpd.GeoDataFrame(df, geometry=geometry_column, crs=schema['crs'])
+
+    if fid_as_index:
+        gdf.index = np.concatenate(kept_rows) if len(kept_rows) > 0 else np.empty(0, dtype=np.int64)
+        return gdf
+
+    return gdf.reset_index(drop=True)
+
+
+def read_gdf(path, columns=None, bbox=None, fid_as_index=False):
+    """
+        Reads a single file (cf. FILE_FORMATS). 
+        - columns = attributes to read (None = all of them);
+        - bbox = (minx, miny, maxx, maxy), features which do not intersect it are skipped by GDAL/OGR, 
+          or filtered out batch by batch, right after decoding (GeoParquet, Arrow IPC), cf. _read_columnar_bbox();
+        - fid_as_index = if True, the index holds feature ids (GDAL/OGR) or row numbers (GeoParquet, Arrow IPC).
+    """
 
-        g = nx.Graph()
-        for row in l_join[l_join.geohash_y.notnull()].itertuples():
-            g.add_edge(row.geohash_x, row.geohash_y)
+    fmt = file_format(path)
+
+    if fmt in ['GeoParquet', 'Arrow']:
+        if columns is not None:
+            columns = list(columns) + [read_schema(path)['geometry_column']]
+        if bbox is not None:
+            return _read_columnar_bbox(path, fmt, columns, bbox, fid_as_index)
+        if fmt == 'GeoParquet':
+            gdf = gpd.read_parquet(path, columns=columns)
+        else:
+            gdf = gpd.read_feather(path, columns=columns)
+        return gdf if fid_as_index else gdf.reset_index(drop=True)
+
+    # GDAL/OGR => Arrow-based vectorized read, which does not return feature ids, though (pyogrio 0.6)
+    with warnings.catch_warnings():
+        # bbox filters may well yield no feature at all
+        warnings.filterwarnings('ignore', message='.*does not have any features to read')
+        return pyogrio.read_dataframe(
+            path, 
+            columns=columns, 
+            bbox=None if bbox is None else tuple(bbox), 
+            fid_as_index=fid_as_index, 
+            use_arrow=not fid_as_index
+        )
+
+
+def _geometry_type(geometry_type):
+    # ex.: 'Point Z' -> 'Point', '3D Point' -> 'Point'
+    return geometry_type.replace('3D ', '').split(' ')[0]
+
+
+def read_schema(path):
+    """
+        Reads the attributes, the CRS and the geometry type(s) of a file, without decoding any feature.
+    """
 
-        groups = list(nx.connected_components(g))
+    fmt = file_format(path)
+
+    if fmt in ['GeoParquet', 'Arrow']:
+        if fmt == 'GeoParquet':
+            schema = pyarrow.parquet.read_schema(path)
+        else:
+            with pyarrow.ipc.open_file(path) as reader:
+                schema = reader.schema
+        geo = json.loads(schema.metadata[b'geo'])
+        geometry_column = geo['primary_column']
+        geometry_meta = geo['columns'][geometry_column]
+        # cf. GeoParquet specification: a missing CRS means OGC:CRS84
+        crs = geometry_meta.get('crs', 'OGC:CRS84')
+        return dict(
+            columns=[col for col in schema.names if col != geometry_column and not col.startswith('__index_level_')],
+            crs=None if crs is None else CRS.from_user_input(crs),
+            geometry_column=geometry_column,
+            geometry_types=sorted(set([_geometry_type(t) for t in geometry_meta.get('geometry_types', [])]))
+        )
+
+    info = pyogrio.read_info(path)
+    return dict(
+        columns=info['fields'].tolist(),
+        crs=None if info['crs'] is None else CRS.from_user_input(info['crs']),
+        geometry_column='geometry',
+        geometry_types=[] if info['geometry_type'] in [None, 'Unknown'] else [_geometry_type(info['geometry_type'])]
+    )
 
-        return groups
 
+def check_schemas(files, required_columns=[], geometry_types=None, crs=None):
+    """
+        Checks up front that files share the same CRS (and match crs, if provided), include the required columns 
+        and only hold geometries of the allowed types (if known). Returns the list of schemas (cf. read_schema()).
+    """
 
-    def assess_group(group):
+    schemas = [read_schema(_file) for _file in files]
 
-        # init
-        cnt_gt = 0
-        cnt_dets = 0
-        FP_charge = 0
-        FN_charge = 0
-    
-        for el in group:
-            if el.startswith(dets_prefix):
-                cnt_dets += 1
-            if el.startswith(gt_prefix):
-                cnt_gt += 1
-            
-        if cnt_dets > cnt_gt:
-            FP_charge = cnt_dets - cnt_gt
-        
-        if cnt_dets < cnt_gt:
-            FN_charge = cnt_gt - cnt_dets
+    for _file, schema in zip(files, schemas):
+        missing_columns = [col for col in required_columns if col not in schema['columns']]
+        if len(missing_columns) > 0:
+            raise ValueError(f"{_file}: missing column(s) {missing_columns}.")
+        if geometry_types is not None and not set(schema['geometry_types']).issubset(geometry_types):
+            raise ValueError(f"{_file}: unexpected geometry type(s) {schema['geometry_types']}, expected {geometry_types}.")
 
-        return dict(cnt_gt=cnt_gt, cnt_dets=cnt_dets, FP_charge=FP_charge, FN_charge=FN_charge)
+    crss = [schema['crs'] for schema in schemas] + ([] if crs is None else [crs])
+    if any([_crs != crss[0] for _crs in crss]):
+        raise ValueError(f"Input datasets have mismatching CRS: {files}.")
 
+    return schemas
 
-    def assign_groups(row):
 
-        group_index = {node: i for i, group in enumerate(groups) for node in group}
-    
-        try:
-            row['group_id'] = group_index[row['geohash']]
-        except: 
-            row['group_id'] = None
-        
-        return row
+# bits of the order_column of load_gdf() allotted to the feature id, the remaining ones being allotted to the file index
+FID_BITS = 40
 
+def load_gdf(files, columns=None, required_columns=[], bbox=None, mask=None, geometry_types=None, crs=None, order_column=None, schemas=None, max_workers=None):
+    """
+        Loads 1+ files concurrently and concatenates them. Schemas are checked before decoding any feature (cf. check_schemas()).
+        - columns = attributes to read, if available (None = all of them); required_columns are always read;
+        - bbox = (minx, miny, maxx, maxy), cf. read_gdf();
+        - mask = geometry, GeoSeries or GeoDataFrame: its bounds are used as bbox, then features not intersecting it are dropped;
+        - order_column = (optional) name of a column to add, holding the rank of each feature within the concatenation of the whole files 
+          (file index, then feature id), which output rows are sorted by; ranks do not depend on bbox nor mask;
+        - schemas = (optional) output of check_schemas(), in which case schemas are not checked again (ex.: when files are read tile by tile).
+    """
+
+    if mask is not None:
+        mask = gpd.GeoSeries([mask]) if not isinstance(mask, (gpd.GeoSeries, gpd.GeoDataFrame)) else mask
+        bbox = mask.total_bounds
+
+    if schemas is None:
+        schemas = check_schemas(files, required_columns=required_columns, geometry_types=geometry_types, crs=crs)
+
+    if columns is None:
+        files_columns = [None for _ in files]
+    else:
+        wanted_columns = list(OrderedDict.fromkeys(list(required_columns) + list(columns)))
+        files_columns = [[col for col in wanted_columns if col in schema['columns']] for schema in schemas]
+
+    max_workers = min(len(files), os.cpu_count()) if max_workers is None else max_workers
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        gdfs = list(executor.map(
+            lambda args: read_gdf(args[0], columns=args[1], bbox=bbox, fid_as_index=order_column is not None), 
+            zip(files, files_columns)
+        ))
 
-    def assign_charges(row):
+    if order_column is not None:
+        for file_idx, _gdf in enumerate(gdfs):
+            fids = _gdf.index.values.astype(np.int64)
+            assert (fids < 2**FID_BITS).all(), "Too many features."
+            _gdf[order_column] = (np.int64(file_idx) << FID_BITS) | fids
+
+    # all the files share the same CRS, which is set on the outcome
+    gdf = gpd.GeoDataFrame(pd.concat(gdfs, ignore_index=True), geometry=gdfs[0].geometry.name, crs=gdfs[0].crs)
+
+    if mask is not None:
+        gdf = gdf.iloc[np.unique(mask.sindex.query(gdf.geometry.values, predicate='intersects')[0])].reset_index(drop=True)
+
+    if order_column is not None:
+        gdf = gdf.sort_values(order_column, kind='stable').reset_index(drop=True)
+
+    return gdf
+
+
+def write_gdf(gdf, path):
+    """
+        Writes gdf in the format matching the file extension (cf. FILE_FORMATS), GeoPackage by default.
+        Columnar formats (GeoParquet, Arrow IPC) preserve dtypes, including numeric and categorical ones.
+    """
+
+    fmt = file_format(path)
+
+    if fmt == 'GeoParquet':
+        gdf.to_parquet(path, index=False)
+    elif fmt == 'Arrow':
+        gdf.to_feather(path, index=False)
+    else:
+        # categorical columns are not supported by the GPKG driver
+        categorical_cols = gdf.select_dtypes(include='category').columns.tolist()
+        pyogrio.write_dataframe(gdf.astype({col: str for col in categorical_cols}), path, driver='GPKG')
+
+
+class GdfWriter:
+    """
+        Writes GeoDataFrames sharing the same columns to a single file, chunk by chunk (ex.: tile by tile). 
+        The format is inferred from the file extension, as in write_gdf().
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.format = file_format(path)
+        self.writer = None
+        self.schema = None
+        self.empty_chunk = None
+
+    def write(self, gdf):
+
+        # empty chunks are only written if no other chunk is, as their (object) columns lack a proper type
+        if len(gdf) == 0:
+            self.empty_chunk = gdf
+            return
+
+        if self.format == 'GPKG':
+            categorical_cols = gdf.select_dtypes(include='category').columns.tolist()
+            pyogrio.write_dataframe(gdf.astype({col: str for col in categorical_cols}), self.path, driver='GPKG', append=self.writer is not None)
+            self.writer = self.path
+            return
+
+        # N.B.: this function is private to GeoPandas, yet it is the one which to_parquet() and to_feather() rely on
+        from geopandas.io.arrow import _geopandas_to_arrow
+        table = _geopandas_to_arrow(gdf, index=False)
+
+        if self.writer is None:
+            # the bounding box of the first chunk would not hold for the whole file
+            geo = json.loads(table.schema.metadata[b'geo'])
+            for geometry_meta in geo['columns'].values():
+                geometry_meta.pop('bbox', None)
+            self.schema = table.schema.with_metadata({**table.schema.metadata, b'geo': json.dumps(geo).encode()})
+            if self.format == 'GeoParquet':
+                self.writer = pyarrow.parquet.ParquetWriter(self.path, self.schema)
+            else:
+                self.writer = pyarrow.ipc.new_file(self.path, self.schema)
+
+        self.writer.write_table(table.cast(self.schema))
+
+    def close(self):
+
+        if self.writer is None:
+            if self.empty_chunk is not None:
+                write_gdf(self.empty_chunk, self.path)
+        elif self.format != 'GPKG':
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# legacy charge columns, holding Fraction objects (or their string representation)
+CHARGE_COLUMNS = ['TP_charge', 'FP_charge', 'FN_charge']
+
+
+def sum_charges(num, den):
+    """
+        Exact sum of the charges num/den. Numerators are summed per distinct denominator, 
+        hence only a handful of Fraction objects get ever built.
+    """
+
+    num = np.asarray(num, dtype=np.int64)
+    den = np.asarray(den, dtype=np.int64)
+
+    dens, inverse = np.unique(den, return_inverse=True)
+    nums = np.zeros(len(dens), dtype=np.int64)
+    np.add.at(nums, inverse.ravel(), num)
+
+    return sum((Fraction(int(n), int(d)) for n, d in zip(nums, dens)), Fraction(0))
+
+
+def charges_from_strings(gdf):
+    """
+        Converts legacy charge columns, holding fractions as strings (ex.: TP_charge = '1/3'), 
+        to integer numerators (ex.: TP_charge_num = 1) sharing a common denominator (charge_den).
+    """
+
+    out_gdf = gdf.copy()
+    legacy_cols = [col for col in CHARGE_COLUMNS if col in gdf.columns]
+
+    nums = {}
+    dens = {}
+    for col in legacy_cols:
+        codes, uniques = pd.factorize(gdf[col].astype(str))
+        fractions = [Fraction(v) for v in uniques]
+        nums[col] = np.array([f.numerator for f in fractions], dtype=np.int64)[codes]
+        dens[col] = np.array([f.denominator for f in fractions], dtype=np.int64)[codes]
+
+    charge_den = np.lcm.reduce([dens[col] for col in legacy_cols], axis=0)
+
+    for col in legacy_cols:
+        out_gdf[f'{col}_num'] = (nums[col] * (charge_den // dens[col])).astype(np.int32)
+    out_gdf['charge_den'] = charge_den.astype(np.int32)
+
+    return out_gdf.drop(columns=legacy_cols)
+
+
+def read_tagged(path):
+    """
+        Reads a file generated by tag(), accepting files in which charges are stored as string fractions (legacy format), too.
+    """
+
+    gdf = read_gdf(path)
+
+    if 'charge_den' not in gdf.columns and any([col in gdf.columns for col in CHARGE_COLUMNS]):
+        gdf = charges_from_strings(gdf)
+
+    return gdf
+
+
+def csgraph_components(n_nodes, src, dst):
+
+    adjacency = coo_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n_nodes, n_nodes)).tocsr()
+    _, labels = connected_components(adjacency, directed=False)
+
+    return labels
+
+
+def union_find_components(n_nodes, src, dst):
+
+    parent = np.arange(n_nodes)
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+
+    while True:
+        # path compression (pointer jumping), until every node points to its root
+        while True:
+            grand_parent = parent[parent]
+            if (grand_parent == parent).all():
+                break
+            parent = grand_parent
         
-        for k, v in charges_dict[row['geohash']].items():
-            row[k] = v
+        root_src, root_dst = parent[src], parent[dst]
+        unlinked = root_src != root_dst
+        if not unlinked.any():
+            break
+
+        # union: the greater root is hooked to the smaller one
+        np.minimum.at(parent, np.maximum(root_src[unlinked], root_dst[unlinked]), np.minimum(root_src[unlinked], root_dst[unlinked]))
+
+    # roots are the smallest node of each component => labels are numbered as in csgraph_components
+    _, labels = np.unique(parent, return_inverse=True)
+
+    return labels
+
+
+def xy(gdf):
+
+    return np.column_stack([gdf.geometry.x.values, gdf.geometry.y.values])
+
+
+def kdtree_pairs(xy_A, xy_B, r):
+    """
+        Returns the positional indices (i, j) and the distance of every pair (xy_A[i], xy_B[j]) such that distance <= r, 
+        sorted by i, then j. Either coordinate arrays or prebuilt cKDTree's are accepted.
+    """
+
+    tree_A = xy_A if isinstance(xy_A, cKDTree) else cKDTree(xy_A)
+    tree_B = xy_B if isinstance(xy_B, cKDTree) else cKDTree(xy_B)
+
+    if tree_A.n == 0 or tree_B.n == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=float)
+
+    pairs = tree_A.sparse_distance_matrix(tree_B, r, output_type='ndarray')
+    order = np.lexsort((pairs['j'], pairs['i']))
+
+    return pairs['i'][order].astype(np.int64), pairs['j'][order].astype(np.int64), pairs['v'][order]
 
-        return row
 
-    ### --- main --- ###
+COMPONENT_FINDERS = {
+    'csgraph': csgraph_components,
+    'union_find': union_find_components,
+}
+
+MATCHING_METHODS = ['sjoin', 'kdtree']
+
+
+def match_pairs(gt, dets, tol_m, matching_method='sjoin', gt_kdtree=None):
+    """
+        Finds the (detection, GT tree) pairs matching according to matching_method (cf. tag()).
+        Returns the geometry of detections (buffered, in the case of the 'sjoin' method), then the positional indices 
+        of matching detections and GT trees, sorted by detection, then by GT tree.
+    """
+
+    if matching_method == 'sjoin':
+        dets_geometry = dets.geometry.buffer(tol_m)
+        dets_idx, gt_idx = gt.sindex.query(dets_geometry.values, predicate='intersects')
+        order = np.lexsort((gt_idx, dets_idx))
+        dets_idx, gt_idx = dets_idx[order], gt_idx[order]
+    else:
+        dets_geometry = dets.geometry
+        dets_idx, gt_idx, _ = kdtree_pairs(xy(dets), xy(gt) if gt_kdtree is None else gt_kdtree, tol_m)
+
+    return dets_geometry, dets_idx, gt_idx
+
+
+def tag(gt, dets, tol_m, gt_prefix=None, dets_prefix=None, component_finder='csgraph', matching_method='sjoin', gt_kdtree=None):
+    """
+        - tol_m = tolerance in meters
+        - gt_prefix, dets_prefix = no longer used, as GT trees and detections are told apart by the side they come from; 
+          hence, keys (the 'geohash' column) may be either strings (ex.: geohashes) or integers (ex.: Morton keys)
+        - component_finder = one of the keys of COMPONENT_FINDERS
+        - matching_method = one of MATCHING_METHODS:
+            * 'sjoin': detections are buffered by tol_m and intersected with GT trees (output detections keep the buffered geometry);
+            * 'kdtree': pairs within tol_m are found by a KD-tree query on point coordinates (output detections keep their original geometry).
+        - gt_kdtree = (optional) cKDTree built on the coordinates of gt, for the 'kdtree' matching method (ex.: shared by several calls)
+        The spatial index of gt, used by the 'sjoin' matching method, is cached by GeoPandas: it is only built once if gt is reused.
+    """
+
+    assert component_finder in COMPONENT_FINDERS.keys(), f"Unknown component finder: {component_finder}"
+    assert matching_method in MATCHING_METHODS, f"Unknown matching method: {matching_method}"
     assert 'geohash' in gt.columns.tolist()
     assert 'geohash' in dets.columns.tolist()
 
+    n_nodes, is_det, dets_nodes, gt_nodes = tag_nodes(gt, dets)
+
+    # (detection, GT tree) pairs, as positional indices
+    dets_geometry, dets_idx, gt_idx = match_pairs(gt, dets, tol_m, matching_method=matching_method, gt_kdtree=gt_kdtree)
+
+    edges_src = dets_nodes[dets_idx]
+    edges_dst = gt_nodes[gt_idx]
+
+    # connected components; trivial FPs (FNs) are components made of one single detection (GT tree)
+    labels = COMPONENT_FINDERS[component_finder](n_nodes, edges_src, edges_dst)
+
+    return charge_components(gt, dets, labels, is_det, dets_nodes, gt_nodes, edges_src, dets_geometry=dets_geometry)
+
+
+def tag_nodes(gt, dets):
+    """
+        Returns the number of nodes, a mask telling detections apart, then the node id of each detection and of each GT tree. 
+        Rows sharing the same key (the 'geohash' column) share the same node; detections come first, then GT trees.
+    """
+
+    # lookup table: key -> node id
+    dets_keys = pd.Index(dets.geohash.unique())
+    gt_keys = pd.Index(gt.geohash.unique())
+    n_nodes = len(dets_keys) + len(gt_keys)
+    is_det = np.arange(n_nodes) < len(dets_keys)
+
+    dets_nodes = dets_keys.get_indexer(dets.geohash)
+    gt_nodes = len(dets_keys) + gt_keys.get_indexer(gt.geohash)
+
+    return n_nodes, is_det, dets_nodes, gt_nodes
+
+
+def charge_components(gt, dets, labels, is_det, dets_nodes, gt_nodes, edges_src, dets_geometry=None):
+    """
+        Tags GT trees and detections, out of the component labels of the nodes (cf. tag_nodes()) and of the (sorted) 
+        detection nodes of the edges. Output frames are the same as tag()'s; detections keep their geometry unless dets_geometry is provided.
+    """
+
     # init
     _gt = gt.copy()
     _dets = dets.copy()
-    _dets['geometry'] = _dets.geometry.buffer(tol_m)
-
-    charges_dict = {}
-
-    # spatial joins
-    l_join = gpd.sjoin(_dets, _gt, how='left', predicate='intersects', lsuffix='x', rsuffix='y')
-    r_join = gpd.sjoin(_dets, _gt, how='right', predicate='intersects', lsuffix='x', rsuffix='y')
-
-    # trivial False Positives
-    trivial_FPs = l_join[l_join.geohash_y.isna()]
-    for tup in trivial_FPs.itertuples():
-        charges_dict = {
-            **charges_dict,
-            tup.geohash_x: {
-                'FP_charge': Fraction(1, 1),
-                'TP_charge': Fraction(0, 1)
-            }
-        }
-
-    # trivial False Negatives
-    trivial_FNs = r_join[r_join.geohash_x.isna()]
-    for tup in trivial_FNs.itertuples():
-        charges_dict = {
-            **charges_dict,
-            tup.geohash_y: {
-                'FN_charge': Fraction(1, 1),
-                'TP_charge': Fraction(0, 1)
-            }
-        }
-
-    # less trivial cases
-    groups = make_groups()
-    for group in groups:
-        group_assessment = assess_group(group)
-        this_group_charges_dict = {}
-
-        for el in group:
-            if el.startswith(dets_prefix):
-                this_group_charges_dict[el] = {
-                    'TP_charge': Fraction(min(group_assessment['cnt_gt'], group_assessment['cnt_dets']), group_assessment['cnt_dets']),
-                    'FP_charge': Fraction(group_assessment['FP_charge'], group_assessment['cnt_dets'])      
-                }
-        
-            if el.startswith(gt_prefix):
-                this_group_charges_dict[el] = {
-                    'TP_charge': Fraction(min(group_assessment['cnt_gt'], group_assessment['cnt_dets']), group_assessment['cnt_gt']),
-                    'FN_charge': Fraction(group_assessment['FN_charge'], group_assessment['cnt_gt'])
-                }
-        
-        charges_dict = {**charges_dict, **this_group_charges_dict}
-    
-    _gt = _gt.apply(lambda row: assign_groups(row), axis=1)
-    _dets = _dets.apply(lambda row: assign_groups(row), axis=1)
+    is_gt = ~is_det
+
+    if dets_geometry is not None:
+        _dets['geometry'] = dets_geometry
+
+    # per component counts
+    cnt_dets = np.bincount(labels, weights=is_det).astype(np.int64)
+    cnt_gt = np.bincount(labels, weights=is_gt).astype(np.int64)
+    node_cnt_dets = cnt_dets[labels]
+    node_cnt_gt = cnt_gt[labels]
+
+    # group ids are only assigned to non-trivial components, numbered by order of first appearance in the join
+    components, first_edge = np.unique(labels[edges_src], return_index=True)
+    group_index = np.full(len(cnt_dets), np.nan)
+    group_index[components[np.argsort(first_edge)]] = np.arange(len(components))
+    node_group_id = group_index[labels]
+    node_TP, node_FP, node_FN = node_charges(node_cnt_gt, node_cnt_dets)
+
+    # charges, as integer numerators sharing a common denominator, i.e. TP_charge = TP_charge_num / charge_den
+    _dets['group_id'] = node_group_id[dets_nodes]
+    _dets['TP_charge_num'] = node_TP[dets_nodes].astype(np.int32)
+    _dets['FP_charge_num'] = node_FP[dets_nodes].astype(np.int32)
+    _dets['charge_den'] = node_cnt_dets[dets_nodes].astype(np.int32)
+
+    _gt['group_id'] = node_group_id[gt_nodes]
+    _gt['TP_charge_num'] = node_TP[gt_nodes].astype(np.int32)
+    _gt['FN_charge_num'] = node_FN[gt_nodes].astype(np.int32)
+    _gt['charge_den'] = node_cnt_gt[gt_nodes].astype(np.int32)
+
+    return (
+        _gt[gt.columns.to_list() + ['group_id', 'TP_charge_num', 'FN_charge_num', 'charge_den']], 
+        _dets[dets.columns.to_list() + ['group_id', 'TP_charge_num', 'FP_charge_num', 'charge_den']]
+    )
+
+
+def sweep_pairs(gt, dets, tolerances, matching_method='sjoin', gt_kdtree=None):
+    """
+        Finds the (detection, GT tree) pairs matching at the largest tolerance (cf. match_pairs()), along with the level of each pair, 
+        i.e. the index of the smallest tolerance at which it matches.
+        - tolerances = tolerances in meters, sorted in increasing order
+        Returns the positional indices of matching detections and GT trees (sorted by detection, then by GT tree), then levels.
+    """
+
+    if matching_method == 'sjoin':
+        _, dets_idx, gt_idx = match_pairs(gt, dets, tolerances[-1], matching_method='sjoin')
+        level = np.full(len(dets_idx), len(tolerances) - 1)
+        # buffers are nested => pairs matching at some tolerance are looked for among the ones matching at the next tolerance, only
+        for k in range(len(tolerances) - 2, -1, -1):
+            candidates = np.flatnonzero(level == k + 1)
+            buffered_idx, inverse = np.unique(dets_idx[candidates], return_inverse=True)
+            buffers = dets.geometry.values[buffered_idx].buffer(tolerances[k])[inverse]
+            level[candidates[buffers.intersects(gt.geometry.values[gt_idx[candidates]])]] = k
+    else:
+        dets_idx, gt_idx, distance = kdtree_pairs(xy(dets), xy(gt) if gt_kdtree is None else gt_kdtree, tolerances[-1])
+        level = np.searchsorted(tolerances, distance, side='left')
+
+    return dets_idx, gt_idx, level
+
+
+def tag_sweep(gt, dets, tolerances, component_finder='csgraph', matching_method='sjoin', gt_kdtree=None):
+    """
+        Same as tag(), for several tolerances in one pass: pairs are found once, at the largest tolerance, then they are 
+        added to the graph by increasing distance level (cf. sweep_pairs()), components being merged incrementally.
+        Yields (tol_m, tagged_gt, tagged_dets) for each tolerance, by increasing tolerance. 
+        Tagged frames are the same as tag()'s, except that detections always keep their original geometry.
+    """
+
+    assert component_finder in COMPONENT_FINDERS.keys(), f"Unknown component finder: {component_finder}"
+    assert matching_method in MATCHING_METHODS, f"Unknown matching method: {matching_method}"
+    assert 'geohash' in gt.columns.tolist()
+    assert 'geohash' in dets.columns.tolist()
+
+    tolerances = sorted(set(tolerances))
+
+    n_nodes, is_det, dets_nodes, gt_nodes = tag_nodes(gt, dets)
+    dets_idx, gt_idx, level = sweep_pairs(gt, dets, tolerances, matching_method=matching_method, gt_kdtree=gt_kdtree)
+
+    edges_src = dets_nodes[dets_idx]
+    edges_dst = gt_nodes[gt_idx]
+
+    labels = np.arange(n_nodes)
+    n_components = n_nodes
+    for k, tol_m in enumerate(tolerances):
+        # incremental union: the components found so far are contracted into nodes, which the edges of level k link
+        new = level == k
+        labels = COMPONENT_FINDERS[component_finder](n_components, labels[edges_src[new]], labels[edges_dst[new]])[labels]
+        n_components = labels.max() + 1 if n_nodes > 0 else 0
+
+        yield (tol_m, *charge_components(gt, dets, labels, is_det, dets_nodes, gt_nodes, edges_src[level <= k]))
+
+
+def tile_grid(bounds, tile_size):
+    """
+        Returns the (minx, miny, maxx, maxy) bounds of the tiles of a regular grid covering bounds, row by row. 
+        Tiles are half-open (minx <= x < maxx, miny <= y < maxy), hence each point belongs to exactly one tile.
+    """
+
+    minx, miny, maxx, maxy = bounds
+    nx = int((maxx - minx) // tile_size) + 1
+    ny = int((maxy - miny) // tile_size) + 1
+
+    return [
+        (minx + i * tile_size, miny + j * tile_size, minx + (i + 1) * tile_size, miny + (j + 1) * tile_size) 
+        for j in range(ny) for i in range(nx)
+    ]
+
+
+def in_tile(coords, tile, margin=0.):
+    """
+        - coords = (N, 2) array
+        - margin = the tile is shrunk by this margin (ex.: margin > 0 => points lying close to the tile edges are excluded)
+    """
+
+    minx, miny, maxx, maxy = tile
+
+    return (
+        (coords[:, 0] >= minx + margin) & (coords[:, 0] < maxx - margin) & 
+        (coords[:, 1] >= miny + margin) & (coords[:, 1] < maxy - margin)
+    )
+
+
+# group keys of trivial components (i.e. lone GT trees and detections), which are not assigned any group id
+NO_GROUP_KEY = -1
+
+def node_charges(cnt_gt, cnt_dets):
+    """
+        TP, FP and FN charge numerators of the nodes of a component, out of its counts of GT trees and detections (cf. tag()).
+    """
+
+    TP = np.minimum(cnt_gt, cnt_dets)
+    FP = np.maximum(cnt_dets - cnt_gt, 0)
+    FN = np.maximum(cnt_gt - cnt_dets, 0)
+
+    return TP, FP, FN
+
+
+def tag_tile(gt, dets, tile, tol_m, dets_order, component_finder='csgraph', matching_method='sjoin'):
+    """
+        Tags the GT trees and detections of one tile, as a step of a tiled assessment yielding the same output as tag(). 
+        - gt, dets = GT trees and detections lying within the tile augmented by a halo of (at least) tol_m
+        - tile = (minx, miny, maxx, maxy), cf. tile_grid()
+        - dets_order = name of the column of dets holding the rank of each detection in the whole (i.e. non tiled) detections dataset
+        Components which do not include any GT tree lying either within the halo or within tol_m of the tile edges are final ("closed"); 
+        the other ones ("open") may extend to other tiles and are reconciled by reconcile_tiles(). Returns a dict, including
+        - gt, dets = tagged GT trees and detections belonging to the tile (cf. in_tile()), with the 'group_key' column 
+          (the rank of the first matched detection of the component, NO_GROUP_KEY for trivial ones) instead of 'group_id', 
+          and the 'component' column (the label of open components, -1 for closed ones); charges of open components are provisional;
+        - open_components = DataFrame indexed by component, holding the counts of tile detections and GT trees and the group key;
+        - open_links = DataFrame (component, key), listing the GT trees through which open components may be connected to other tiles' ones;
+        - group_keys = group keys of closed non-trivial components.
+    """
+
+    gt_home = in_tile(xy(gt), tile)
+    gt_interior = in_tile(xy(gt), tile, margin=tol_m)
+    _dets = dets[in_tile(xy(dets), tile)].copy()
+    _gt = gt.copy()
+
+    # lookup table: key -> node id; detections come first, then GT trees (cf. tag())
+    dets_keys = pd.Index(_dets.geohash.unique())
+    gt_keys = pd.Index(_gt.geohash.unique())
+    n_nodes = len(dets_keys) + len(gt_keys)
+    is_det = np.arange(n_nodes) < len(dets_keys)
+
+    dets_nodes = dets_keys.get_indexer(_dets.geohash)
+    gt_nodes = len(dets_keys) + gt_keys.get_indexer(_gt.geohash)
+
+    # edges are only computed for the detections of the tile => each edge is found in exactly one tile
+    _dets['geometry'], dets_idx, gt_idx = match_pairs(_gt, _dets, tol_m, matching_method=matching_method)
+    edges_src = dets_nodes[dets_idx]
+    edges_dst = gt_nodes[gt_idx]
+
+    labels = COMPONENT_FINDERS[component_finder](n_nodes, edges_src, edges_dst)
+
+    is_home = is_det.copy()
+    is_home[gt_nodes[gt_home]] = True
+    has_edge = np.zeros(n_nodes, dtype=bool)
+    has_edge[edges_dst] = True
+    # GT trees of the halo matter only if they are matched by some detection of the tile
+    is_shared = np.zeros(n_nodes, dtype=bool)
+    is_shared[gt_nodes[~gt_interior]] = True
+    is_shared &= ~is_det & (is_home | has_edge)
+
+    # per component counts of the nodes belonging to the tile
+    n_labels = labels.max() + 1 if n_nodes > 0 else 0
+    cnt_dets = np.bincount(labels, weights=is_det, minlength=n_labels).astype(np.int64)
+    cnt_gt = np.bincount(labels, weights=~is_det & is_home, minlength=n_labels).astype(np.int64)
+    is_open = np.bincount(labels, weights=is_shared, minlength=n_labels) > 0
+
+    # group key = rank of the first matched detection of the component, as group ids are numbered by order of first appearance (cf. tag())
+    group_key = np.full(n_labels, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(group_key, labels[edges_src], _dets[dets_order].values[dets_idx].astype(np.int64))
+    group_key[group_key == np.iinfo(np.int64).max] = NO_GROUP_KEY
+
+    TP, FP, FN = node_charges(cnt_gt, cnt_dets)
+    component = np.where(is_open, np.arange(n_labels), -1)
+
+    dets_labels = labels[dets_nodes]
+    _dets['group_key'] = group_key[dets_labels]
+    _dets['component'] = component[dets_labels]
+    _dets['TP_charge_num'] = TP[dets_labels].astype(np.int32)
+    _dets['FP_charge_num'] = FP[dets_labels].astype(np.int32)
+    _dets['charge_den'] = cnt_dets[dets_labels].astype(np.int32)
+
+    _gt = _gt[gt_home]
+    gt_labels = labels[gt_nodes[gt_home]]
+    _gt['group_key'] = group_key[gt_labels]
+    _gt['component'] = component[gt_labels]
+    _gt['TP_charge_num'] = TP[gt_labels].astype(np.int32)
+    _gt['FN_charge_num'] = FN[gt_labels].astype(np.int32)
+    _gt['charge_den'] = cnt_gt[gt_labels].astype(np.int32)
+
+    open_labels = np.flatnonzero(is_open)
+    shared_nodes = np.flatnonzero(is_shared)
+
+    return dict(
+        gt=_gt[gt.columns.to_list() + ['group_key', 'component', 'TP_charge_num', 'FN_charge_num', 'charge_den']],
+        dets=_dets[dets.columns.to_list() + ['group_key', 'component', 'TP_charge_num', 'FP_charge_num', 'charge_den']],
+        open_components=pd.DataFrame(
+            {'n_dets': cnt_dets[open_labels], 'n_gt': cnt_gt[open_labels], 'group_key': group_key[open_labels]}, 
+            index=pd.Index(open_labels, name='component')
+        ),
+        open_links=pd.DataFrame({'component': labels[shared_nodes], 'key': gt_keys[shared_nodes - len(dets_keys)]}),
+        group_keys=group_key[~is_open & (group_key != NO_GROUP_KEY)]
+    )
+
+
+def reconcile_tiles(open_components, open_links):
+    """
+        Merges the open components of tag_tile() which share some GT tree.
+        - open_components = DataFrame indexed by (tile, component), with the n_dets, n_gt and group_key columns
+        - open_links = DataFrame with the tile, component and key columns
+        Returns open_components, the counts and group key of which are replaced by the ones of the merged components.
+    """
+
+    comp_idx = open_components.index.get_indexer(pd.MultiIndex.from_frame(open_links[['tile', 'component']]))
+    key_codes, _ = pd.factorize(open_links.key)
+    n_comps = len(open_components)
+
+    # bipartite graph: components <-> GT trees
+    labels = csgraph_components(n_comps + key_codes.max() + 1 if len(key_codes) > 0 else n_comps, comp_idx, n_comps + key_codes)[:n_comps]
+
+    group_key = open_components.group_key.values.copy()
+    group_key[group_key == NO_GROUP_KEY] = np.iinfo(np.int64).max
+    merged_group_key = np.full(labels.max() + 1 if n_comps > 0 else 0, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(merged_group_key, labels, group_key)
+    merged_group_key[merged_group_key == np.iinfo(np.int64).max] = NO_GROUP_KEY
+
+    out = open_components.copy()
+    out['n_dets'] = np.bincount(labels, weights=open_components.n_dets.values).astype(np.int64)[labels]
+    out['n_gt'] = np.bincount(labels, weights=open_components.n_gt.values).astype(np.int64)[labels]
+    out['group_key'] = merged_group_key[labels]
+
+    return out
+
+
+def finalize_tile(tagged_gt, tagged_dets, tile, reconciled_components, group_keys):
+    """
+        Turns the output of tag_tile() into the one of tag(), given 
+        - tile = the tile identifier used in reconciled_components
+        - reconciled_components = output of reconcile_tiles()
+        - group_keys = sorted array of the group keys of all the non-trivial components (closed and reconciled ones), 
+          the rank of which is the group id
+    """
+
+    out = []
+    for _gdf, charge_col in [(tagged_gt, 'FN_charge_num'), (tagged_dets, 'FP_charge_num')]:
+        _gdf = _gdf.copy()
+
+        is_open = (_gdf.component >= 0).values
+        if is_open.any():
+            comps = reconciled_components.loc[pd.MultiIndex.from_arrays([np.full(is_open.sum(), tile), _gdf.component.values[is_open]])]
+            TP, FP, FN = node_charges(comps.n_gt.values, comps.n_dets.values)
+            _gdf.loc[is_open, 'group_key'] = comps.group_key.values
+            _gdf.loc[is_open, 'TP_charge_num'] = TP.astype(np.int32)
+            _gdf.loc[is_open, charge_col] = (FN if charge_col == 'FN_charge_num' else FP).astype(np.int32)
+            _gdf.loc[is_open, 'charge_den'] = (comps.n_gt.values if charge_col == 'FN_charge_num' else comps.n_dets.values).astype(np.int32)
+
+        group_id = np.searchsorted(group_keys, _gdf.group_key.values).astype(float)
+        group_id[_gdf.group_key.values == NO_GROUP_KEY] = np.nan
+        _gdf['group_id'] = group_id
+
+        columns = [col for col in _gdf.columns if col not in ['group_key', 'component', 'group_id', 'TP_charge_num', charge_col, 'charge_den']]
+        out.append(_gdf[columns + ['group_id', 'TP_charge_num', charge_col, 'charge_den']])
+
+    return out[0], out[1]
+
+
+def _attach_shared_arrays(specs):
+    """
+        - specs = dict: name -> (shared memory block name, shape, dtype)
+    """
+
+    blocks, arrays = [], {}
+    for k, (block_name, shape, dtype) in specs.items():
+        blocks.append(shared_memory.SharedMemory(name=block_name))
+        arrays[k] = np.ndarray(shape, dtype=dtype, buffer=blocks[-1].buf)
+
+    return blocks, arrays
+
+
+def _tag_partition(specs, tile, tol_m, component_finder, matching_method):
+    # runs tag_tile() on the coordinates and keys held by shared memory blocks (cf. parallel_tag())
+
+    blocks, arrays = _attach_shared_arrays(specs)
+
+    try:
+        gt_xy, dets_xy = arrays['gt_xy'], arrays['dets_xy']
+        # GT trees lying within the tile augmented by a halo (bounds included), detections lying within the tile
+        gt_rows = np.flatnonzero(
+            (gt_xy[:, 0] >= tile[0] - tol_m) & (gt_xy[:, 0] <= tile[2] + tol_m) & 
+            (gt_xy[:, 1] >= tile[1] - tol_m) & (gt_xy[:, 1] <= tile[3] + tol_m)
+        )
+        dets_rows = np.flatnonzero(in_tile(dets_xy, tile))
+
+        gt = gpd.GeoDataFrame(
+            {'geohash': arrays['gt_keys'][gt_rows], '_row': gt_rows}, 
+            geometry=gpd.points_from_xy(gt_xy[gt_rows, 0], gt_xy[gt_rows, 1])
+        )
+        dets = gpd.GeoDataFrame(
+            {'geohash': arrays['dets_keys'][dets_rows], '_row': dets_rows}, 
+            geometry=gpd.points_from_xy(dets_xy[dets_rows, 0], dets_xy[dets_rows, 1])
+        )
+        # detections are ranked by row, as group ids are numbered by order of first appearance in the join (cf. tag())
+        tagged = tag_tile(gt, dets, tile, tol_m, '_row', component_finder=component_finder, matching_method=matching_method)
+    finally:
+        for block in blocks:
+            block.close()
+
+    # geometries are not sent back
+    tagged['gt'] = pd.DataFrame(tagged['gt'].drop(columns=['geometry', 'geohash']))
+    tagged['dets'] = pd.DataFrame(tagged['dets'].drop(columns=['geometry', 'geohash']))
+
+    return tagged
+
+
+def _same_coordinates(coords, keys):
+    # checks whether rows sharing the same key share the same coordinates, as well
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return (coords == coords[first[inverse]]).all()
+
+
+def parallel_tag(gt, dets, tol_m, n_workers, n_partitions=None, component_finder='csgraph', matching_method='sjoin'):
+    """
+        Same as tag() (same output, group ids included), the join, component and charge stages of which are run by a pool 
+        of n_workers processes, each one handling vertical strips holding equal shares of points (n_partitions strips, 4 per worker by default).
+        Coordinates and keys are passed through shared memory. Components spanning several strips are reconciled as in 
+        tiled assessments (cf. tag_tile(), reconcile_tiles()).
+        Falls back to tag() if n_workers <= 1, if there are fewer points than workers (ex.: no point at all) or if some rows sharing 
+        the same key do not share the same coordinates (which could belong to different strips).
+    """
 
-    _gt = _gt.apply(lambda row: assign_charges(row), axis=1)
-    _dets = _dets.apply(lambda row: assign_charges(row), axis=1)
+    assert 'geohash' in gt.columns.tolist()
+    assert 'geohash' in dets.columns.tolist()
+
+    gt_xy, dets_xy = xy(gt), xy(dets)
+    gt_keys = pd.factorize(gt.geohash)[0].astype(np.int64)
+    dets_keys = pd.factorize(dets.geohash)[0].astype(np.int64)
+
+    if n_workers <= 1 or len(gt_xy) + len(dets_xy) < n_workers or not (_same_coordinates(gt_xy, gt_keys) and _same_coordinates(dets_xy, dets_keys)):
+        return tag(gt, dets, tol_m, component_finder=component_finder, matching_method=matching_method)
+
+    # strips holding equal shares of points; the last strip is extended, as tiles are half-open
+    all_xy = np.vstack([gt_xy, dets_xy])
+    n_partitions = 4 * n_workers if n_partitions is None else n_partitions
+    x_edges = np.unique(np.quantile(all_xy[:, 0], np.linspace(0, 1, n_partitions + 1)))
+    x_edges[-1] += 1.
+    miny, maxy = all_xy[:, 1].min(), all_xy[:, 1].max() + 1.
+    tiles = [(x_edges[i], miny, x_edges[i + 1], maxy) for i in range(len(x_edges) - 1)]
+
+    blocks = []
+    try:
+        specs = {}
+        for k, arr in dict(gt_xy=gt_xy, gt_keys=gt_keys, dets_xy=dets_xy, dets_keys=dets_keys).items():
+            blocks.append(shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1)))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=blocks[-1].buf)[:] = arr
+            specs[k] = (blocks[-1].name, arr.shape, arr.dtype.str)
+
+        args = [(specs, tile, tol_m, component_finder, matching_method) for tile in tiles]
+        if current_process().daemon:
+            # daemonic processes (ex.: the workers of batchEv.py) are not allowed to have children
+            results = [_tag_partition(*_args) for _args in args]
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                results = list(executor.map(_tag_partition, *zip(*args)))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    # deterministic merge: partitions are processed in a fixed order, and group ids only depend on detections ranks
+    reconciled_components = reconcile_tiles(
+        pd.concat([r['open_components'].assign(tile=i).set_index('tile', append=True).swaplevel() for i, r in enumerate(results)]),
+        pd.concat([r['open_links'].assign(tile=i) for i, r in enumerate(results)], ignore_index=True)
+    )
+    reconciled_group_keys = np.unique(reconciled_components.group_key.values)
+    group_keys = np.sort(np.concatenate([r['group_keys'] for r in results] + [reconciled_group_keys[reconciled_group_keys != NO_GROUP_KEY]]))
+
+    _gt = gt.copy()
+    _dets = dets.copy()
+    tagged_gt, tagged_dets = zip(*[finalize_tile(r['gt'], r['dets'], i, reconciled_components, group_keys) for i, r in enumerate(results)])
+    tagged_gt = pd.concat(tagged_gt).set_index('_row').sort_index()
+    tagged_dets = pd.concat(tagged_dets).set_index('_row').sort_index()
 
-    return _gt[gt.columns.to_list() + ['group_id', 'TP_charge', 'FN_charge']], _dets[dets.columns.to_list() + ['group_id', 'TP_charge', 'FP_charge']]
+    if matching_method == 'sjoin':
+        _dets['geometry'] = dets.geometry.buffer(tol_m)
+
+    for col in ['group_id', 'TP_charge_num', 'FP_charge_num', 'charge_den']:
+        _dets[col] = tagged_dets[col].values
+    for col in ['group_id', 'TP_charge_num', 'FN_charge_num', 'charge_den']:
+        _gt[col] = tagged_gt[col].values
+
+    return (
+        _gt[gt.columns.to_list() + ['group_id', 'TP_charge_num', 'FN_charge_num', 'charge_den']], 
+        _dets[dets.columns.to_list() + ['group_id', 'TP_charge_num', 'FP_charge_num', 'charge_den']]
+    )
 
 
 def precision_recall_f1( tp, fp, fn ):
@@ -253,16 +1238,18 @@ def legacy_assess(tagged_gt, tagged_dets):
 
 def assess(tagged_gt, tagged_dets):
 
-    assert 'TP_charge' in tagged_dets.columns.tolist()
-    assert 'TP_charge' in tagged_gt.columns.tolist()
-    assert 'FP_charge' in tagged_dets.columns.tolist()
-    assert 'FN_charge' in tagged_gt.columns.tolist()
+    assert 'TP_charge_num' in tagged_dets.columns.tolist()
+    assert 'TP_charge_num' in tagged_gt.columns.tolist()
+    assert 'FP_charge_num' in tagged_dets.columns.tolist()
+    assert 'FN_charge_num' in tagged_gt.columns.tolist()
+    assert 'charge_den' in tagged_dets.columns.tolist()
+    assert 'charge_den' in tagged_gt.columns.tolist()
     
-    TP = float(tagged_dets.TP_charge.sum())
-    FP = float(tagged_dets.FP_charge.sum())
+    TP = float(sum_charges(tagged_dets.TP_charge_num, tagged_dets.charge_den))
+    FP = float(sum_charges(tagged_dets.FP_charge_num, tagged_dets.charge_den))
 
-    _TP = float(tagged_gt.TP_charge.sum()) # x-check
-    FN = float(tagged_gt.FN_charge.sum())
+    _TP = float(sum_charges(tagged_gt.TP_charge_num, tagged_gt.charge_den)) # x-check
+    FN = float(sum_charges(tagged_gt.FN_charge_num, tagged_gt.charge_den))
     
     try:
         assert _TP == TP, f"{_TP} != {TP}"
@@ -283,4 +1270,170 @@ def assess(tagged_gt, tagged_dets):
     output['TP+FN'] = TP+FN
     output['TP+FP'] = TP+FP
 
-    return output
\ No newline at end of file
+    return output
+
+
+def vectorized_precision_recall_f1(tp, fp, fn):
+
+    tp, fp, fn = [np.asarray(x, dtype=float) for x in [tp, fp, fn]]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.where(tp == 0.0, 0., 1.*tp/(tp+fp))
+        r = np.where(tp == 0.0, 0., 1.*tp/(tp+fn))
+        f1 = np.where((p == 0.0) | (r == 0.0), 0., 2.*p*r/(p+r))
+
+    return dict(p=p, r=r, f1=f1)
+
+
+def metrics_frame(tp, fp, fn, index):
+
+    metrics = vectorized_precision_recall_f1(tp, fp, fn)
+
+    output = pd.DataFrame(
+        OrderedDict(
+            TP=tp,
+            FP=fp,
+            FN=fn,
+            p=metrics['p'],
+            r=metrics['r'],
+            f1=metrics['f1']
+        ),
+        index=index
+    )
+
+    output['TP+FN'] = output.TP + output.FN
+    output['TP+FP'] = output.TP + output.FP
+
+    return output
+
+
+def charge_sums(tagged_gdf, by, num_cols):
+    """
+        Integer sums of the charge numerators <num_col> per (group, denominator). Partial sums (ex.: computed tile by tile) 
+        can be added up by add_charge_sums(), then turned into exact charges by charges_from_sums().
+    """
+
+    return tagged_gdf.groupby(by + ['charge_den'], observed=True, dropna=False)[num_cols].sum().astype(np.int64)
+
+
+def add_charge_sums(sums_A, sums_B):
+
+    if sums_A is None:
+        return sums_B
+
+    return pd.concat([sums_A, sums_B]).groupby(level=sums_A.index.names, observed=True, dropna=False).sum()
+
+
+def charges_from_sums(sums, by, num_cols):
+    """
+        Exact per group sums of the charges <num_col> / charge_den, out of charge_sums().
+        Fraction objects are only built for the (few) (group, denominator) rows.
+    """
+
+    dens = sums.index.get_level_values('charge_den')
+
+    fractions = pd.DataFrame(index=sums.index)
+    for col in num_cols:
+        fractions[col] = [Fraction(int(n), int(d)) for n, d in zip(sums[col], dens)]
+
+    return fractions.groupby(level=by, observed=True, dropna=False).sum().astype(float)
+
+
+def sum_charges_by(tagged_gdf, by, num_cols):
+    """
+        Exact per group sums of the charges <num_col> / charge_den. Numerators are first summed per (group, denominator), 
+        hence Fraction objects are only built for the (few) resulting rows.
+    """
+
+    return charges_from_sums(charge_sums(tagged_gdf, by, num_cols), by, num_cols)
+
+
+def assess_by(tagged_gt, tagged_dets, by='sector', keys=None):
+    """
+        Same as assess(), for all the groups of GT trees and detections sharing the same values along the 'by' column(s), in one pass.
+        - by = column name or list of column names, which must be available in both tagged_gt and tagged_dets
+        - keys = groups to report on, including empty ones (ex.: all the sectors); by default, groups found in data, sorted
+        Returns a DataFrame indexed by group, the columns of which are the keys of the dict returned by assess().
+    """
+
+    by = [by] if isinstance(by, str) else list(by)
+
+    for col in by + ['TP_charge_num', 'FP_charge_num', 'charge_den']:
+        assert col in tagged_dets.columns.tolist()
+    for col in by + ['TP_charge_num', 'FN_charge_num', 'charge_den']:
+        assert col in tagged_gt.columns.tolist()
+
+    return assess_charge_sums(
+        dets_sums=charge_sums(tagged_dets, by, ['TP_charge_num', 'FP_charge_num']),
+        gt_sums=charge_sums(tagged_gt, by, ['TP_charge_num', 'FN_charge_num']),
+        by=by,
+        keys=keys
+    )
+
+
+def assess_charge_sums(dets_sums, gt_sums, by='sector', keys=None):
+    """
+        Same as assess_by(), out of the charge_sums() of tagged detections (TP_charge_num, FP_charge_num) and GT trees (TP_charge_num, FN_charge_num).
+    """
+
+    by = [by] if isinstance(by, str) else list(by)
+
+    dets_sums = charges_from_sums(dets_sums, by, ['TP_charge_num', 'FP_charge_num'])
+    gt_sums = charges_from_sums(gt_sums, by, ['TP_charge_num', 'FN_charge_num'])
+    sums = dets_sums.join(gt_sums, how='outer', lsuffix='_dets', rsuffix='_gt').fillna(0.0)
+
+    if keys is not None:
+        sums = sums.reindex(keys, fill_value=0.0)
+    else:
+        sums = sums.sort_index()
+
+    # x-check
+    mismatches = sums[sums.TP_charge_num_dets != sums.TP_charge_num_gt]
+    for key, row in mismatches.iterrows():
+        print(f"AssertionError: {key}: {row.TP_charge_num_gt} != {row.TP_charge_num_dets}")
+
+    return metrics_frame(
+        tp=sums.TP_charge_num_dets.values, 
+        fp=sums.FP_charge_num.values, 
+        fn=sums.FN_charge_num.values, 
+        index=sums.index
+    )
+
+
+def legacy_assess_by(tagged_gt, tagged_dets, by='sector', keys=None):
+    """
+        Same as legacy_assess(), for all the groups of GT trees and detections sharing the same values along the 'by' column(s), in one pass.
+        Arguments and output: cf. assess_by()
+    """
+
+    by = [by] if isinstance(by, str) else list(by)
+
+    for col in by + ['tag']:
+        assert col in tagged_dets.columns.tolist()
+        assert col in tagged_gt.columns.tolist()
+
+    gt_counts = tagged_gt.groupby(by + ['tag'], observed=True, dropna=False).size().unstack('tag')
+    dets_counts = tagged_dets.groupby(by + ['tag'], observed=True, dropna=False).size().unstack('tag')
+    counts = gt_counts.reindex(columns=['TP', 'FN']).join(
+        dets_counts.reindex(columns=['TP', 'FP']), 
+        how='outer', 
+        lsuffix='_gt', 
+        rsuffix='_dets'
+    ).fillna(0).astype(int)
+
+    if keys is not None:
+        counts = counts.reindex(keys, fill_value=0)
+    else:
+        counts = counts.sort_index()
+
+    # x-check
+    mismatches = counts[counts.TP_dets != counts.TP_gt]
+    for key, row in mismatches.iterrows():
+        print(f"AssertionError: {key}: {row.TP_dets} != {row.TP_gt}")
+
+    return metrics_frame(
+        tp=counts.TP_gt.values, 
+        fp=counts.FP.values, 
+        fn=counts.FN.values, 
+        index=counts.index
+    )
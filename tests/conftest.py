@@ -0,0 +1,4 @@
+import os, sys
+
+# lib modules are imported the same way as by the scripts, i.e. from within the src folder
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
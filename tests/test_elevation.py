@@ -0,0 +1,123 @@
+import json
+import time
+import threading
+import numpy as np
+import pytest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from lib.elevation import RateLimiter, ElevationCache, ElevationClient
+
+
+class StubImageServer(BaseHTTPRequestHandler):
+    """
+        Stub of the getSamples operation of an ArcGIS ImageServer: z = x + y.
+        The first request of each point fails (HTTP 503) if the server's fail_first flag is set.
+    """
+
+    def do_GET(self):
+
+        x, y = [float(v) for v in parse_qs(urlparse(self.path).query)['geometry'][0].split(',')]
+        with self.server.lock:
+            self.server.requests.append((x, y))
+            fail = self.server.fail_first and self.server.requests.count((x, y)) == 1
+
+        if fail:
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        body = json.dumps({'samples': [{'value': str(x + y)}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StubImageServer)
+    httpd.lock = threading.Lock()
+    httpd.requests = []
+    httpd.fail_first = False
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/getSamples?geometry={{x}},{{y}}&f=json"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_retry_on_5xx(server):
+
+    server.fail_first = True
+    x, y = np.array([1., 2.]), np.array([10., 20.])
+
+    client = ElevationClient(url=server.url, max_workers=2, rate_limit=None, retries=2)
+    try:
+        z = client.fetch(x, y)
+    finally:
+        client.close()
+
+    np.testing.assert_allclose(z, x + y)
+    # one failed and one successful request per point
+    assert len(server.requests) == 4
+
+
+def test_cache_hit(server, tmp_path):
+
+    cache_file = str(tmp_path / 'z_cache.sqlite')
+    # the first and the last points share the same 1 cm grid cell
+    x, y = np.array([1., 2., 1.001]), np.array([10., 20., 10.])
+
+    client = ElevationClient(url=server.url, rate_limit=None, cache_file=cache_file)
+    try:
+        z = client.fetch(x, y)
+    finally:
+        client.close()
+    assert client.n_requests == 2
+    np.testing.assert_allclose(z, [11., 22., 11.])
+
+    client = ElevationClient(url=server.url, rate_limit=None, cache_file=cache_file)
+    try:
+        cached_z = client.fetch(x, y)
+    finally:
+        client.close()
+    assert client.n_requests == 0
+    assert len(server.requests) == 2
+    np.testing.assert_array_equal(cached_z, z)
+
+    # entries are keyed by URL, as well
+    cache = ElevationCache(cache_file)
+    try:
+        assert cache.get(server.url, [(100, 1000)]) == {(100, 1000): 11.}
+        assert cache.get('another url', [(100, 1000)]) == {}
+    finally:
+        cache.close()
+
+
+def test_rate_limit(server):
+
+    rate = 20
+    rate_limiter = RateLimiter(rate)
+    tic = time.monotonic()
+    for _ in range(5):
+        rate_limiter.wait()
+    assert time.monotonic() - tic >= 4 / rate
+
+    # the limit is shared by all the workers of a client
+    x, y = np.arange(6, dtype=float), np.zeros(6)
+    client = ElevationClient(url=server.url, max_workers=3, rate_limit=rate)
+    tic = time.monotonic()
+    try:
+        client.fetch(x, y)
+    finally:
+        client.close()
+    assert time.monotonic() - tic >= 5 / rate
+    assert len(server.requests) == 6
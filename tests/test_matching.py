@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from scipy.spatial import cKDTree
+
+from lib.misc import tag, kdtree_pairs, xy
+
+
+TOLERANCE_M = 1.5
+
+
+def points(xs, ys, prefix):
+
+    gdf = gpd.GeoDataFrame(geometry=gpd.points_from_xy(xs, ys), crs='EPSG:2056')
+    gdf['geohash'] = [f"{prefix}{i}" for i in range(len(gdf))]
+
+    return gdf
+
+
+def test_kdtree_equals_sjoin():
+
+    rng = np.random.default_rng(0)
+    gt_xy = rng.uniform(0., 100., size=(1000, 2))
+    dets_xy = np.vstack([gt_xy[:800] + rng.normal(0., 1., size=(800, 2)), rng.uniform(0., 100., size=(200, 2))])
+
+    # buffers are polygons approximating disks: pairs lying within 1% of the tolerance are left out
+    distances = cKDTree(gt_xy).sparse_distance_matrix(cKDTree(dets_xy), 1.01 * TOLERANCE_M, output_type='ndarray')
+    ambiguous = distances['j'][distances['v'] >= 0.99 * TOLERANCE_M]
+    dets_xy = np.delete(dets_xy, ambiguous, axis=0)
+    gt, dets = points(gt_xy[:, 0], gt_xy[:, 1], 'gt_'), points(dets_xy[:, 0], dets_xy[:, 1], 'dt_')
+
+    sjoin_gt, sjoin_dets = tag(gt, dets, TOLERANCE_M, matching_method='sjoin')
+    kdtree_gt, kdtree_dets = tag(gt, dets, TOLERANCE_M, matching_method='kdtree')
+
+    pd.testing.assert_frame_equal(kdtree_gt, sjoin_gt)
+    pd.testing.assert_frame_equal(kdtree_dets.drop(columns='geometry'), sjoin_dets.drop(columns='geometry'))
+    assert kdtree_dets.geometry.geom_equals(dets.geometry).all()
+    assert (kdtree_gt.TP_charge_num > 0).sum() > 500
+
+
+def test_kdtree_boundary():
+
+    # detections lying exactly at the tolerance from a GT tree (along the axes, then along a 3-4-5 triangle)
+    gt = points([0., 10., 20.], [0., 0., 0.], 'gt_')
+    dets = points([TOLERANCE_M, 10., 20. + 0.6 * TOLERANCE_M], [0., -TOLERANCE_M, 0.8 * TOLERANCE_M], 'dt_')
+
+    dets_idx, gt_idx, distance = kdtree_pairs(xy(dets), xy(gt), TOLERANCE_M)
+    assert dets_idx.tolist() == [0, 1, 2] and gt_idx.tolist() == [0, 1, 2]
+    assert (distance <= TOLERANCE_M).all()
+
+    tagged_gt, tagged_dets = tag(gt, dets, TOLERANCE_M, matching_method='kdtree')
+    assert tagged_gt.group_id.tolist() == [0., 1., 2.]
+    assert (tagged_gt.TP_charge_num == tagged_gt.charge_den).all()
+    assert (tagged_dets.TP_charge_num == tagged_dets.charge_den).all()
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+
+from lib import misc
+from lib.misc import tag, parallel_tag, MATCHING_METHODS
+
+
+def points(xs, ys, prefix):
+
+    gdf = gpd.GeoDataFrame(geometry=gpd.points_from_xy(xs, ys), crs='EPSG:2056')
+    gdf['geohash'] = [f"{prefix}{i}" for i in range(len(gdf))]
+
+    return gdf
+
+
+def test_parallel_tag_empty():
+
+    empty_gt, empty_dets = points([], [], 'gt_'), points([], [], 'dt_')
+
+    tagged_gt, tagged_dets = parallel_tag(empty_gt, empty_dets, 1.0, n_workers=2)
+    expected_gt, expected_dets = tag(empty_gt, empty_dets, 1.0)
+
+    assert len(tagged_gt) == 0 and len(tagged_dets) == 0
+    assert tagged_gt.columns.tolist() == expected_gt.columns.tolist()
+    assert tagged_dets.columns.tolist() == expected_dets.columns.tolist()
+
+
+def test_parallel_tag_fewer_points_than_workers():
+
+    gt, dets = points([0.], [0.], 'gt_'), points([0.5], [0.], 'dt_')
+
+    tagged_gt, tagged_dets = parallel_tag(gt, dets, 1.0, n_workers=4)
+    expected_gt, expected_dets = tag(gt, dets, 1.0)
+
+    assert tagged_gt.drop(columns='geometry').equals(expected_gt.drop(columns='geometry'))
+    assert tagged_dets.drop(columns='geometry').equals(expected_dets.drop(columns='geometry'))
+
+
+@pytest.mark.parametrize('matching_method', MATCHING_METHODS)
+def test_parallel_tag_equals_tag(monkeypatch, matching_method):
+
+    rng = np.random.default_rng(0)
+    gt_xy = rng.uniform(0., 200., size=(3000, 2))
+    # detections: jittered GT trees (some of which are missed) and false positives
+    dets_xy = np.vstack([gt_xy[:2400] + rng.normal(0., 1., size=(2400, 2)), rng.uniform(0., 200., size=(600, 2))])
+    gt, dets = points(gt_xy[:, 0], gt_xy[:, 1], 'gt_'), points(dets_xy[:, 0], dets_xy[:, 1], 'dt_')
+
+    expected_gt, expected_dets = tag(gt, dets, 1.5, matching_method=matching_method)
+    # the shared memory path is taken, not the fallback to tag()
+    monkeypatch.setattr(misc, 'tag', None)
+    tagged_gt, tagged_dets = parallel_tag(gt, dets, 1.5, n_workers=2, matching_method=matching_method)
+
+    pd.testing.assert_frame_equal(tagged_gt.drop(columns='geometry'), expected_gt.drop(columns='geometry'))
+    pd.testing.assert_frame_equal(tagged_dets.drop(columns='geometry'), expected_dets.drop(columns='geometry'))
+    assert tagged_dets.geometry.geom_equals(expected_dets.geometry).all()
+    # groups of several GT trees and detections are involved
+    assert (expected_gt.groupby('group_id').size() > 1).sum() > 100
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+
+from lib.misc import tag, tag_sweep, MATCHING_METHODS
+
+
+TOLERANCES = [0.5, 1., 2., 3.]
+
+
+def points(xs, ys, prefix):
+
+    gdf = gpd.GeoDataFrame(geometry=gpd.points_from_xy(xs, ys), crs='EPSG:2056')
+    gdf['geohash'] = [f"{prefix}{i}" for i in range(len(gdf))]
+
+    return gdf
+
+
+@pytest.mark.parametrize('matching_method', MATCHING_METHODS)
+def test_tag_sweep_equals_tag(matching_method):
+
+    rng = np.random.default_rng(0)
+    gt_xy = rng.uniform(0., 100., size=(1000, 2))
+    dets_xy = np.vstack([gt_xy[:800] + rng.normal(0., 1., size=(800, 2)), rng.uniform(0., 100., size=(200, 2))])
+    gt, dets = points(gt_xy[:, 0], gt_xy[:, 1], 'gt_'), points(dets_xy[:, 0], dets_xy[:, 1], 'dt_')
+    # rows sharing the same key (ex.: points lying in overlapping sectors)
+    dets = pd.concat([dets, dets.iloc[:50]], ignore_index=True)
+
+    n_levels = 0
+    for tol_m, tagged_gt, tagged_dets in tag_sweep(gt, dets, TOLERANCES, matching_method=matching_method):
+        expected_gt, expected_dets = tag(gt, dets, tol_m, matching_method=matching_method)
+
+        pd.testing.assert_frame_equal(tagged_gt, expected_gt)
+        pd.testing.assert_frame_equal(tagged_dets.drop(columns='geometry'), expected_dets.drop(columns='geometry'))
+        # detections keep their original geometry
+        assert tagged_dets.geometry.geom_equals(dets.geometry).all()
+        n_levels += 1
+
+    assert n_levels == len(TOLERANCES)
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from assessment_scripts import det_vs_gt
+from benchmarks.synthetic import make_dataset
+from lib.misc import read_gdf, write_gdf
+
+
+TOLERANCE_M = 3.0
+TILE_SIZE_M = 60.0
+
+
+def run(tmp_path, ext, tile_size_m):
+
+    data = make_dataset('park', 600, seed=1)
+    input_files = {}
+    for k in ['gt', 'dets', 'sectors']:
+        input_files[k] = str(tmp_path / f"{k}{ext}")
+        write_gdf(data[k], input_files[k])
+
+    name = 'tiled' if tile_size_m is not None else 'global'
+    parsed_cfg = det_vs_gt.Configuration(
+        input_files=dict(gt_sectors=[input_files['sectors']], gt_trees=[input_files['gt']], detections=[input_files['dets']]),
+        output_files=dict(
+            tagged_gt_trees=str(tmp_path / f"{name}_tagged_gt{ext}"),
+            tagged_detections=str(tmp_path / f"{name}_tagged_dets{ext}"),
+            metrics=str(tmp_path / f"{name}_metrics.csv")
+        ),
+        settings=dict(gt_sectors_buffer_size_in_meters=1.0, tolerance_in_meters=TOLERANCE_M, tile_size_in_meters=tile_size_m)
+    )
+    gt = det_vs_gt.prepare_gt(parsed_cfg)
+    metrics_df = det_vs_gt.assess_detections(parsed_cfg, gt)
+
+    tagged = {
+        k: read_gdf(path).sort_values(['geohash', 'sector']).reset_index(drop=True)
+        for k, path in [('gt', parsed_cfg.output_files.tagged_gt_trees), ('dets', parsed_cfg.output_files.tagged_detections)]
+    }
+
+    return metrics_df, tagged, gt['bbox']
+
+
+@pytest.mark.parametrize('ext', ['.gpkg', '.parquet'])
+def test_tiled_equals_global(tmp_path, ext):
+
+    global_metrics_df, global_tagged, bbox = run(tmp_path, ext, None)
+    tiled_metrics_df, tiled_tagged, _ = run(tmp_path, ext, TILE_SIZE_M)
+
+    pd.testing.assert_frame_equal(tiled_metrics_df.reset_index(drop=True), global_metrics_df.reset_index(drop=True))
+
+    for k in ['gt', 'dets']:
+        assert len(tiled_tagged[k]) == len(global_tagged[k])
+        columns = ['geohash', 'sector', 'group_id', 'TP_charge_num', 'charge_den'] + (['FN_charge_num'] if k == 'gt' else ['FP_charge_num'])
+        pd.testing.assert_frame_equal(tiled_tagged[k][columns], global_tagged[k][columns])
+
+    # the dataset does include groups straddling tile edges (hence, matches found within halos)
+    points = pd.concat([
+        pd.DataFrame({'group_id': global_tagged['gt'].group_id, 'x': global_tagged['gt'].geometry.x, 'y': global_tagged['gt'].geometry.y}),
+        pd.DataFrame({'group_id': global_tagged['dets'].group_id, 'x': global_tagged['dets'].geometry.centroid.x, 'y': global_tagged['dets'].geometry.centroid.y}),
+    ])
+    points['tile'] = list(zip(((points.x - bbox[0]) // TILE_SIZE_M).astype(int), ((points.y - bbox[1]) // TILE_SIZE_M).astype(int)))
+    n_tiles_per_group = points.groupby('group_id').tile.nunique()
+    assert (n_tiles_per_group > 1).sum() > 10